@@ -0,0 +1,85 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_prim_mst.py
+# Purpose:     Benchmark primMST_symmetry against its implementation at an earlier git ref
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import sys
+sys.path.append("./")
+import time
+import types
+import argparse
+import subprocess
+import numpy as np
+from utils.mst_utils import primMST_symmetry, flip
+
+
+def load_baseline(ref):
+    """
+    load utils/mst_utils.py as it is at a git ref, to be used as reference
+    :param ref: git ref, e.g. a commit before the change being measured
+    :return: the module
+    """
+    src = subprocess.check_output(['git', 'show', '{:s}:utils/mst_utils.py'.format(ref)])
+    module = types.ModuleType('mst_utils_baseline')
+    exec(compile(src, '{:s}:utils/mst_utils.py'.format(ref), 'exec'), module.__dict__)
+    return module
+
+
+def best_time(func, repeat):
+    """
+    minimum wall time of repeat calls, and the result of the last call
+    """
+    times = []
+    for _ in range(repeat):
+        time1 = time.time()
+        res = func()
+        times.append(time.time() - time1)
+    return min(times), res
+
+
+def dense_rig(num_joints, rng):
+    """
+    symmetric joints packed in a head-sized volume, like a facial rig, and a dense pairwise cost matrix
+    in the form used by build_skeleton (-log of connectivity probability plus outside-bone penalty)
+    """
+    joints = rng.uniform([-0.3, 0.0, -0.2], [0.3, 0.4, 0.2], size=(num_joints, 3))
+    joints, _ = flip(joints)
+    dist = np.sqrt(np.sum((joints[np.newaxis, ...] - joints[:, np.newaxis, :]) ** 2, axis=2))
+    prob = np.exp(-dist / 0.05) * rng.uniform(0.5, 1.0, size=dist.shape)
+    prob = (prob + prob.T) / 2
+    cost = -np.log(np.clip(prob, 1e-10, 1 - 1e-6))
+    cost[rng.uniform(size=cost.shape) < 0.05] += 10.0
+    cost = np.minimum(cost, cost.T)
+    np.fill_diagonal(cost, 0.0)
+    return joints, cost
+
+
+def main(args):
+    baseline = None if args.baseline_ref == '' else load_baseline(args.baseline_ref)
+    rng = np.random.default_rng(0)
+    for num_joints in args.num_joints:
+        joints, cost = dense_rig(num_joints, rng)
+        root_id = int(rng.integers(len(joints)))
+        t_new, (parent, _, root) = best_time(lambda: primMST_symmetry(cost, root_id, joints), args.repeat)
+        line = 'J={:d}. current: {:.5f}s'.format(len(joints), t_new)
+        if baseline is not None:
+            t_base, (parent_base, _, root_base) = best_time(
+                lambda: baseline.primMST_symmetry(cost, root_id, joints), args.repeat)
+            same = list(parent) == list(parent_base) and root == root_base
+            line += ', {:s}: {:.5f}s, speedup: {:.1f}x, identical tree: {}'.format(
+                args.baseline_ref, t_base, t_base / (t_new + 1e-10), same)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark symmetric prim MST')
+    parser.add_argument('--num_joints', type=int, nargs='+', default=[20, 50, 200, 1000])
+    parser.add_argument('--baseline_ref', type=str, default='',
+                        help='git ref of the utils/mst_utils.py used as reference, e.g. the commit before a change '
+                             'to primMST_symmetry (HEAD~1). Only the current implementation is timed by default')
+    parser.add_argument('--repeat', type=int, default=5, help='best of this many runs is reported')
+    args = parser.parse_args()
+    main(args)
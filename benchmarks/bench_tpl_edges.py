@@ -0,0 +1,80 @@
+#-------------------------------------------------------------------------------
+# Name:        bench_tpl_edges.py
+# Purpose:     Benchmark the vectorized get_tpl_edges against the original per-vertex implementation
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import sys
+sys.path.append("./")
+import time
+import argparse
+import numpy as np
+from gen_dataset import get_tpl_edges
+
+
+def get_tpl_edges_loop(remesh_obj_v, remesh_obj_f):
+    """
+    original implementation, scanning all faces for every vertex. Used as reference.
+    """
+    edge_index = []
+    for v in range(len(remesh_obj_v)):
+        face_ids = np.argwhere(remesh_obj_f == v)[:, 0]
+        neighbor_ids = []
+        for face_id in face_ids:
+            for v_id in range(3):
+                if remesh_obj_f[face_id, v_id] != v:
+                    neighbor_ids.append(remesh_obj_f[face_id, v_id])
+        neighbor_ids = list(set(neighbor_ids))
+        neighbor_ids = [np.array([v, n])[np.newaxis, :] for n in neighbor_ids]
+        if len(neighbor_ids) == 0:
+            continue
+        neighbor_ids = np.concatenate(neighbor_ids, axis=0)
+        edge_index.append(neighbor_ids)
+    edge_index = np.concatenate(edge_index, axis=0)
+    return edge_index
+
+
+def torus_mesh(num_vert):
+    """
+    closed triangulated torus with roughly num_vert vertices
+    """
+    n_u = int(np.sqrt(num_vert * 2))
+    n_v = max(num_vert // n_u, 3)
+    u, v = np.meshgrid(np.linspace(0, 2 * np.pi, n_u, endpoint=False),
+                       np.linspace(0, 2 * np.pi, n_v, endpoint=False), indexing='ij')
+    verts = np.stack(((1 + 0.3 * np.cos(v)) * np.cos(u), (1 + 0.3 * np.cos(v)) * np.sin(u), 0.3 * np.sin(v)), axis=2)
+    verts = verts.reshape(-1, 3)
+    i, j = np.meshgrid(np.arange(n_u), np.arange(n_v), indexing='ij')
+    v00 = i * n_v + j
+    v10 = ((i + 1) % n_u) * n_v + j
+    v01 = i * n_v + (j + 1) % n_v
+    v11 = ((i + 1) % n_u) * n_v + (j + 1) % n_v
+    faces = np.concatenate((np.stack((v00, v10, v11), axis=2).reshape(-1, 3),
+                            np.stack((v00, v11, v01), axis=2).reshape(-1, 3)), axis=0)
+    return verts, faces.astype(np.int32)
+
+
+def main(args):
+    for num_vert in args.num_verts:
+        verts, faces = torus_mesh(num_vert)
+        time1 = time.time()
+        edges = get_tpl_edges(verts, faces)
+        time2 = time.time()
+        line = 'V={:d} F={:d} E={:d}. vectorized: {:.4f}s'.format(len(verts), len(faces), len(edges), time2 - time1)
+        if not args.skip_loop:
+            edges_loop = get_tpl_edges_loop(verts, faces)
+            time3 = time.time()
+            same = np.array_equal(edges, np.unique(edges_loop, axis=0))
+            line += ', loop: {:.4f}s, speedup: {:.1f}x, identical edge set: {}'.format(
+                time3 - time2, (time3 - time2) / (time2 - time1 + 1e-10), same)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='benchmark topological edge extraction')
+    parser.add_argument('--num_verts', type=int, nargs='+', default=[1000, 5000, 10000, 20000, 50000])
+    parser.add_argument('--skip_loop', action='store_true', help='only time the vectorized implementation')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,82 @@
+#-------------------------------------------------------------------------------
+# Name:        check_voxelize.py
+# Purpose:     Check that utils.vox_utils.voxelize keeps the interior of meshes with holes
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import sys
+sys.path.append("./")
+import glob
+import time
+import argparse
+import numpy as np
+from scipy.ndimage import binary_fill_holes
+from utils.vox_utils import voxelize, rasterize_surface
+
+
+def load_obj(filename):
+    """
+    vertices and triangles of an obj file, without normals or textures
+    """
+    verts, faces = [], []
+    with open(filename) as fin:
+        for line in fin:
+            words = line.split()
+            if len(words) == 0:
+                continue
+            if words[0] == 'v':
+                verts.append([float(w) for w in words[1:4]])
+            elif words[0] == 'f':
+                faces.append([int(w.split('/')[0]) - 1 for w in words[1:4]])
+    return np.array(verts), np.array(faces)
+
+
+def punch_holes(verts, faces, num_holes, hole_radius, seed=0):
+    """
+    remove all triangles whose center is within hole_radius (relative to the bounding box diagonal) of one of
+    num_holes random vertices
+    """
+    rng = np.random.RandomState(seed)
+    centers = verts[rng.choice(len(verts), num_holes, replace=False)]
+    radius = hole_radius * np.linalg.norm(verts.max(axis=0) - verts.min(axis=0))
+    tri_center = verts[faces].mean(axis=1)
+    dist = np.linalg.norm(tri_center[:, np.newaxis, :] - centers[np.newaxis, :, :], axis=2).min(axis=1)
+    return faces[dist > radius]
+
+
+def main(args):
+    all_ok = True
+    for filename in sorted(glob.glob(args.mesh_pattern)):
+        verts, faces = load_obj(filename)
+        vox_closed = voxelize(verts, faces, dim=args.dim)
+        faces_holes = punch_holes(verts, faces, args.num_holes, args.hole_radius)
+        time1 = time.time()
+        vox_holes = voxelize(verts, faces_holes, dim=args.dim)
+        time2 = time.time()
+        # flood fill of the outside, which leaks through the holes. Shown for comparison.
+        tris = (verts[faces_holes] - np.array(vox_holes.translate)) / vox_holes.scale * args.dim
+        flood = binary_fill_holes(rasterize_surface(tris, args.dim))
+        kept = np.sum(vox_holes.data & vox_closed.data) / np.sum(vox_closed.data)
+        kept_flood = np.sum(flood & vox_closed.data) / np.sum(vox_closed.data)
+        extra = np.sum(vox_holes.data & ~vox_closed.data) / np.sum(vox_closed.data)
+        ok = kept >= args.min_kept
+        all_ok &= ok
+        print('{:s}: removed {:d}/{:d} faces. carving keeps {:.1%} of the closed voxelization (+{:.1%} extra), '
+              'flood fill keeps {:.1%}. {:.3f}s. {:s}'.format(filename, len(faces) - len(faces_holes), len(faces),
+                                                             kept, extra, kept_flood, time2 - time1,
+                                                             'ok' if ok else 'FAILED'))
+    sys.exit(0 if all_ok else 1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='voxelize meshes with holes punched into them')
+    parser.add_argument('--mesh_pattern', type=str, default='quick_start/*_remesh.obj')
+    parser.add_argument('--dim', type=int, default=88)
+    parser.add_argument('--num_holes', type=int, default=5)
+    parser.add_argument('--hole_radius', type=float, default=0.03, help='relative to the bounding box diagonal')
+    parser.add_argument('--min_kept', type=float, default=0.9,
+                        help='min fraction of the closed voxelization kept when the mesh has holes')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,82 @@
+#-------------------------------------------------------------------------------
+# Name:        columnar_store.py
+# Purpose:     reader of dataset splits stored in the binary columnar format written by gen_dataset.ColumnarWriter
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import os
+import numpy as np
+from utils.cache_utils import unpack_voxels
+
+# Layout of a split folder:
+#     index.npz     model names, and per array kind the row offsets of every model (offsets_{kind}, M+1 entries),
+#                   dtype (dtype_{kind}) and shape of one row (shape_{kind})
+#     {kind}.bin    rows of all models back to back, raw little-endian
+# Array kinds per model:
+#     v             N*6 float32, vertex positions and normals
+#     attn          N float32, pretrained attention
+#     tpl_e, geo_e  E*2 int32, topological and geodesic edges
+#     joints        J*3 float32
+#     adj           J*J uint8, flattened adjacency matrix
+#     vox_data, vox_dims, vox_translate, vox_scale   bit-packed voxels and their metadata, see utils.cache_utils
+#     bones         B*6 float32, starting and ending points of bones
+#     skin_bone     N*5 int32, nearest bones of each vertex (-1 if fewer bones)
+#     skin_dist     N*5 float32, 1 / volumetric geodesic distance to these bones
+#     skin_leaf     N*5 uint8, if these bones are leaf bones
+#     skin_label    N*5 float32, skinning weights of these bones
+
+
+class ColumnarStore:
+    """
+    Read-only access to one split. Columns are memory mapped when first accessed, so opening a store is cheap and
+    every DataLoader worker maps the files on its own.
+    """
+    def __init__(self, folder):
+        self.folder = folder
+        with np.load(os.path.join(folder, 'index.npz')) as index:
+            self.names = index['names']
+            self.kinds = [str(k) for k in index['kinds']]
+            self.offsets = {k: index['offsets_' + k] for k in self.kinds}
+            self.dtypes = {k: np.dtype(str(index['dtype_' + k])) for k in self.kinds}
+            self.shapes = {k: tuple(index['shape_' + k]) for k in self.kinds}
+        self.columns = {}
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, 'index.npz'))
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getstate__(self):
+        # memory maps are not sent to worker processes, they are opened again there
+        state = self.__dict__.copy()
+        state['columns'] = {}
+        return state
+
+    def column(self, kind):
+        if kind not in self.columns:
+            num_rows = int(self.offsets[kind][-1])
+            if num_rows == 0:
+                self.columns[kind] = np.zeros((0,) + self.shapes[kind], dtype=self.dtypes[kind])
+            else:
+                self.columns[kind] = np.memmap(os.path.join(self.folder, kind + '.bin'), dtype=self.dtypes[kind],
+                                               mode='r', shape=(num_rows,) + self.shapes[kind])
+        return self.columns[kind]
+
+    def get(self, kind, i):
+        """
+        :return: rows of model i in column kind, as a read-only view of the memory map
+        """
+        return self.column(kind)[self.offsets[kind][i]:self.offsets[kind][i + 1]]
+
+    def get_model(self, i, kinds=None):
+        """
+        :return: dict of all arrays (or the given kinds) of model i
+        """
+        return {k: self.get(k, i) for k in (kinds or self.kinds)}
+
+    def voxels(self, i):
+        return unpack_voxels(self.get_model(i, ['vox_data', 'vox_dims', 'vox_translate', 'vox_scale']))
@@ -10,9 +10,10 @@ import os
 import torch
 import numpy as np
 import glob
-import itertools as it
 from utils import binvox_rw
-from torch_geometric.data import Data, InMemoryDataset
+from utils.mst_utils import pair_occupancy
+from datasets.columnar_store import ColumnarStore
+from torch_geometric.data import Data, Dataset, InMemoryDataset
 from torch_geometric.utils import add_self_loops
 
 
@@ -37,13 +38,54 @@ class SkeletonData(Data):
             return super(SkeletonData, self).__inc__(key, value)
 
 
+def make_skeleton_data(model, name):
+    """
+    wrap the arrays of one model as SkeletonData
+    :param model: dict of arrays as read from the text files or the columnar store, with the voxels in 'vox'
+    :param name: model ID
+    """
+    v, m, joints, adj, vox = model['v'], model['attn'], model['joints'], model['adj'], model['vox']
+    tpl_e = model['tpl_e'].T
+    geo_e = model['geo_e'].T
+    pairs, num_samples, num_inside = pair_occupancy(joints, vox)
+    dist = np.linalg.norm(joints[pairs[:, 0]] - joints[pairs[:, 1]], axis=1)
+    pair_attr = np.stack((dist, num_inside / (num_samples + 1e-10), adj[pairs[:, 0], pairs[:, 1]]), axis=1)
+
+    v = torch.from_numpy(v).float()
+    m = torch.from_numpy(m).long()
+    tpl_e = torch.from_numpy(tpl_e).long()
+    geo_e = torch.from_numpy(geo_e).long()
+    tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
+    geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
+    joints = torch.from_numpy(joints).float()
+    pairs = torch.from_numpy(pairs).float()
+    pair_attr = torch.from_numpy(pair_attr).float()
+    return SkeletonData(x=v[:, 3:6], pos=v[:, 0:3], name=name, mask=m, joints=joints,
+                        tpl_edge_index=tpl_e, geo_edge_index=geo_e, pairs=pairs, pair_attr=pair_attr)
+
+
+def load_skeleton_columnar(store, i):
+    """
+    read model i of a columnar store, copying the rows out of the memory maps
+    """
+    model = store.get_model(i, ['v', 'attn', 'tpl_e', 'geo_e', 'joints', 'adj'])
+    model = {k: np.array(a, dtype=np.float64) if k in ['v', 'joints'] else np.array(a) for k, a in model.items()}
+    model['adj'] = model['adj'].reshape(len(model['joints']), -1)
+    model['vox'] = store.voxels(i)
+    return model
+
+
 class GraphDataset(InMemoryDataset):
     def __init__(self, root):
+        # splits in binary columnar format (see gen_dataset.ColumnarWriter) are read instead of the text files
+        self.store = ColumnarStore(root) if ColumnarStore.exists(root) else None
         super(GraphDataset, self).__init__(root)
         self.data, self.slices = torch.load(self.processed_paths[0])
 
     @property
     def raw_file_names(self):
+        if self.store is not None:
+            return [os.path.join(self.root, 'index.npz')]
         raw_v_filelist = glob.glob(os.path.join(self.root, '*_v.txt'))
         return raw_v_filelist
 
@@ -52,6 +94,8 @@ class GraphDataset(InMemoryDataset):
         return '{:s}_skeleton_data.pt'.format(self.root.split('/')[-1])
 
     def __len__(self):
+        if self.store is not None:
+            return len(self.store)
         return len(self.raw_paths)
 
     def download(self):
@@ -77,45 +121,58 @@ class GraphDataset(InMemoryDataset):
         pts = pts[ind]
         return pts, np.argwhere(ind).squeeze()
 
+    def load_txt(self, v_filename):
+        """
+        read one model from the text layout, with the same array kinds as the columnar store
+        """
+        model = {'v': np.loadtxt(v_filename),
+                 'attn': np.loadtxt(v_filename.replace('_v.txt', '_attn.txt')),
+                 'tpl_e': np.loadtxt(v_filename.replace('_v.txt', '_tpl_e.txt')),
+                 'geo_e': np.loadtxt(v_filename.replace('_v.txt', '_geo_e.txt')),
+                 'joints': np.loadtxt(v_filename.replace('_v.txt', '_j.txt')),
+                 'adj': np.loadtxt(v_filename.replace('_v.txt', '_adj.txt'), dtype=np.uint8)}
+        vox_file = v_filename.replace('_v.txt', '.binvox')
+        with open(vox_file, 'rb') as fvox:
+            model['vox'] = binvox_rw.read_as_3d_array(fvox)
+        return model
+
+    def load_columnar(self, i):
+        return load_skeleton_columnar(self.store, i)
+
     def process(self):
         data_list = []
-        i = 0.0
-        for v_filename in self.raw_paths:
-            print('preprecessing data complete: {:.4f}%'.format(100 * i / len(self.raw_paths)))
-            i += 1.0
-            v = np.loadtxt(v_filename)
-            m = np.loadtxt(v_filename.replace('_v.txt', '_attn.txt'))
-            tpl_e = np.loadtxt(v_filename.replace('_v.txt', '_tpl_e.txt')).T
-            geo_e = np.loadtxt(v_filename.replace('_v.txt', '_geo_e.txt')).T
-            joints = np.loadtxt(v_filename.replace('_v.txt', '_j.txt'))
-            adj = np.loadtxt(v_filename.replace('_v.txt', '_adj.txt'), dtype=np.uint8)
-
-            vox_file = v_filename.replace('_v.txt', '.binvox')
-            with open(vox_file, 'rb') as fvox:
-                vox = binvox_rw.read_as_3d_array(fvox)
-            pairs = list(it.combinations(range(adj.shape[0]), 2))
-            pair_attr = []
-            for pr in pairs:
-                dist = np.linalg.norm(joints[pr[0]] - joints[pr[1]])
-                bone_samples = self.sample_on_bone(joints[pr[0]], joints[pr[1]])
-                bone_samples_inside, _ = self.inside_check(bone_samples, vox)
-                outside_proportion = len(bone_samples_inside) / (len(bone_samples) + 1e-10)
-                attr = np.array([dist, outside_proportion, adj[pr[0], pr[1]]])
-                pair_attr.append(attr)
-            pairs = np.array(pairs)
-            pair_attr = np.array(pair_attr)
-            name = int(v_filename.split('/')[-1].split('_')[0])
-
-            v = torch.from_numpy(v).float()
-            m = torch.from_numpy(m).long()
-            tpl_e = torch.from_numpy(tpl_e).long()
-            geo_e = torch.from_numpy(geo_e).long()
-            tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
-            geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
-            joints = torch.from_numpy(joints).float()
-            pairs = torch.from_numpy(pairs).float()
-            pair_attr = torch.from_numpy(pair_attr).float()
-            data_list.append(SkeletonData(x=v[:, 3:6], pos=v[:, 0:3], name=name, mask=m, joints=joints,
-                                          tpl_edge_index=tpl_e, geo_edge_index=geo_e, pairs=pairs, pair_attr=pair_attr))
+        if self.store is not None:
+            names = [int(n) for n in self.store.names]
+        else:
+            names = [int(v_filename.split('/')[-1].split('_')[0]) for v_filename in self.raw_paths]
+        for i, name in enumerate(names):
+            print('preprecessing data complete: {:.4f}%'.format(100.0 * i / len(names)))
+            model = self.load_columnar(i) if self.store is not None else self.load_txt(self.raw_paths[i])
+            data_list.append(make_skeleton_data(model, name))
         data, slices = self.collate(data_list)
         torch.save((data, slices), self.processed_paths[0])
+
+
+class GraphDatasetOnDisk(Dataset):
+    """
+    Lazy alternative to GraphDataset for splits in binary columnar format. Nothing is loaded at construction: every
+    access slices the arrays of one model out of the memory-mapped columns, so the split can be larger than memory.
+    Works with torch_geometric DataLoader, also with num_workers > 0.
+    """
+    def __init__(self, root):
+        self.store = ColumnarStore(root)
+        super(GraphDatasetOnDisk, self).__init__(root)
+
+    @property
+    def raw_file_names(self):
+        return [os.path.join(self.root, 'index.npz')]
+
+    @property
+    def processed_file_names(self):
+        return []
+
+    def len(self):
+        return len(self.store)
+
+    def get(self, idx):
+        return make_skeleton_data(load_skeleton_columnar(self.store, idx), int(self.store.names[idx]))
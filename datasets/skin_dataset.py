@@ -10,17 +10,55 @@ import os
 import torch
 import numpy as np
 import glob
-from torch_geometric.data import Data, InMemoryDataset
+from torch_geometric.data import Data, Dataset, InMemoryDataset
 from torch_geometric.utils import add_self_loops
+from datasets.columnar_store import ColumnarStore
+from utils.skin_utils import read_skin_txt, assemble_skin_input
+
+
+def make_skin_data(v, tpl_e, geo_e, skin_input, skin_nn, skin_label, loss_mask, name):
+    """
+    wrap the arrays of one model as Data for the skinning network
+    """
+    v = torch.from_numpy(v).float()
+    tpl_e = torch.from_numpy(tpl_e).long()
+    geo_e = torch.from_numpy(geo_e).long()
+    tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
+    geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
+
+    skin_input = torch.from_numpy(skin_input).float()
+    skin_label = torch.from_numpy(skin_label).float()
+    skin_nn = torch.from_numpy(skin_nn).long()
+    loss_mask = torch.from_numpy(loss_mask).long()
+    num_skin = len(skin_input)
+    return Data(x=v[:, 3:6], pos=v[:, 0:3], skin_input=skin_input, skin_label=skin_label,
+                skin_nn=skin_nn, loss_mask=loss_mask, num_skin=num_skin, name=name,
+                tpl_edge_index=tpl_e, geo_edge_index=geo_e)
+
+
+def load_skin_columnar(store, i):
+    """
+    read model i of a columnar store, copying the rows out of the memory maps
+    :return: vertices, topological and geodesic edges, skinning input, nearest bone ids, labels and loss mask
+    """
+    model = {k: np.array(a) for k, a in store.get_model(i, ['v', 'tpl_e', 'geo_e', 'bones', 'skin_bone',
+                                                            'skin_dist', 'skin_leaf', 'skin_label']).items()}
+    skin_input, skin_nn, loss_mask = assemble_skin_input(model['bones'].astype(np.float64), model['skin_bone'],
+                                                         model['skin_dist'].astype(np.float64), model['skin_leaf'])
+    return model['v'], model['tpl_e'].T, model['geo_e'].T, skin_input, skin_nn, model['skin_label'], loss_mask
 
 
 class SkinDataset(InMemoryDataset):
     def __init__(self, root):
+        # splits in binary columnar format (see gen_dataset.ColumnarWriter) are read instead of the text files
+        self.store = ColumnarStore(root) if ColumnarStore.exists(root) else None
         super(SkinDataset, self).__init__(root)
         self.data, self.slices = torch.load(self.processed_paths[0])
 
     @property
     def raw_file_names(self):
+        if self.store is not None:
+            return [os.path.join(self.root, 'index.npz')]
         raw_v_filelist = glob.glob(os.path.join(self.root, '*_v.txt'))
         return raw_v_filelist
 
@@ -29,82 +67,68 @@ class SkinDataset(InMemoryDataset):
         return '{:s}_skinning_data.pt'.format(self.root.split('/')[-1])
 
     def __len__(self):
+        if self.store is not None:
+            return len(self.store)
         return len(self.raw_paths)
 
     def download(self):
         pass
 
     def load_skin(self, filename):
-        with open(filename, 'r') as fin:
-            lines = fin.readlines()
-        bones = []
-        input = []
-        label = []
-        nearest_bone_ids = []
-        loss_mask_all = []
-        for li in lines:
-            words = li.strip().split()
-            if words[0] == 'bones':
-                bones.append([float(w) for w in words[3:]])
-            elif words[0] == 'bind':
-                words = [float(w) for w in words[1:]]
-                sample_input = []
-                sample_nearest_bone_ids = []
-                loss_mask = []
-                for i in range(self.num_nearest_bone):
-                    if int(words[3 * i + 1]) == -1:
-                        ## walk-round. however words[3] may also be invalid.
-                        sample_nearest_bone_ids.append(int(words[1]))
-                        sample_input += bones[int(words[1])]
-                        sample_input.append(words[2])
-                        sample_input.append(int(words[3]))
-                        loss_mask.append(0)
-                    else:
-                        sample_nearest_bone_ids.append(int(words[3 * i + 1]))
-                        sample_input += bones[int(words[3 * i + 1])]
-                        sample_input.append(words[3 * i + 2])
-                        sample_input.append(int(words[3 * i + 3]))
-                        loss_mask.append(1)
-                input.append(np.array(sample_input)[np.newaxis, :])
-                nearest_bone_ids.append(np.array(sample_nearest_bone_ids)[np.newaxis, :])
-                loss_mask_all.append(np.array(loss_mask)[np.newaxis, :])
-            elif words[0] == 'influence':
-                sample_label = np.array([float(w) for w in words[1:]])[np.newaxis, :]
-                label.append(sample_label)
-
-        input = np.concatenate(input, axis=0)
-        nearest_bone_ids = np.concatenate(nearest_bone_ids, axis=0)
-        label = np.concatenate(label, axis=0)
-        loss_mask_all = np.concatenate(loss_mask_all, axis=0)
-
-        return input, nearest_bone_ids, label, loss_mask_all
+        skin = read_skin_txt(filename)
+        input, nearest_bone_ids, loss_mask_all = assemble_skin_input(
+            skin['bones'], skin['skin_bone'][:, :self.num_nearest_bone], skin['skin_dist'][:, :self.num_nearest_bone],
+            skin['skin_leaf'][:, :self.num_nearest_bone])
+        return input, nearest_bone_ids, skin['skin_label'], loss_mask_all
+
+    def load_columnar(self, i):
+        return load_skin_columnar(self.store, i)
+
+    def load_txt(self, v_filename):
+        v = np.loadtxt(v_filename)
+        tpl_e = np.loadtxt(v_filename.replace('_v.txt', '_tpl_e.txt')).T
+        geo_e = np.loadtxt(v_filename.replace('_v.txt', '_geo_e.txt')).T
+        skin_input, skin_nn, skin_label, loss_mask = self.load_skin(v_filename.replace('_v.txt', '_skin.txt'))
+        return v, tpl_e, geo_e, skin_input, skin_nn, skin_label, loss_mask
 
     def process(self):
         data_list = []
         self.num_nearest_bone = 5
-        i = 0.0
-        for v_filename in self.raw_paths:
-            print('preprecessing data complete: {:.4f}%'.format(100 * i / len(self.raw_paths)))
-            i += 1.0
-            v = np.loadtxt(v_filename)
-            v = torch.from_numpy(v).float()
-            tpl_e = np.loadtxt(v_filename.replace('_v.txt', '_tpl_e.txt')).T
-            geo_e = np.loadtxt(v_filename.replace('_v.txt', '_geo_e.txt')).T
-            tpl_e = torch.from_numpy(tpl_e).long()
-            geo_e = torch.from_numpy(geo_e).long()
-            tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
-            geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
-            skin_input, skin_nn, skin_label, loss_mask = self.load_skin(v_filename.replace('_v.txt', '_skin.txt'))
-            
-            skin_input = torch.from_numpy(skin_input).float()
-            skin_label = torch.from_numpy(skin_label).float()
-            skin_nn = torch.from_numpy(skin_nn).long()
-            loss_mask = torch.from_numpy(loss_mask).long()
-            num_skin = len(skin_input)
-
-            name = int(v_filename.split('/')[-1].split('_')[0])
-            data_list.append(Data(x=v[:, 3:6], pos=v[:, 0:3], skin_input=skin_input, skin_label=skin_label,
-                                  skin_nn=skin_nn, loss_mask=loss_mask, num_skin=num_skin, name=name,
-                                  tpl_edge_index=tpl_e, geo_edge_index=geo_e))
+        if self.store is not None:
+            names = [int(n) for n in self.store.names]
+        else:
+            names = [int(v_filename.split('/')[-1].split('_')[0]) for v_filename in self.raw_paths]
+        for i, name in enumerate(names):
+            print('preprecessing data complete: {:.4f}%'.format(100.0 * i / len(names)))
+            if self.store is not None:
+                v, tpl_e, geo_e, skin_input, skin_nn, skin_label, loss_mask = self.load_columnar(i)
+            else:
+                v, tpl_e, geo_e, skin_input, skin_nn, skin_label, loss_mask = self.load_txt(self.raw_paths[i])
+            data_list.append(make_skin_data(v, tpl_e, geo_e, skin_input, skin_nn, skin_label, loss_mask, name))
         data, slices = self.collate(data_list)
         torch.save((data, slices), self.processed_paths[0])
+
+
+class SkinDatasetOnDisk(Dataset):
+    """
+    Lazy alternative to SkinDataset for splits in binary columnar format. Nothing is loaded at construction: every
+    access slices the arrays of one model out of the memory-mapped columns, so the split can be larger than memory.
+    Works with torch_geometric DataLoader, also with num_workers > 0.
+    """
+    def __init__(self, root):
+        self.store = ColumnarStore(root)
+        super(SkinDatasetOnDisk, self).__init__(root)
+
+    @property
+    def raw_file_names(self):
+        return [os.path.join(self.root, 'index.npz')]
+
+    @property
+    def processed_file_names(self):
+        return []
+
+    def len(self):
+        return len(self.store)
+
+    def get(self, idx):
+        return make_skin_data(*load_skin_columnar(self.store, idx), int(self.store.names[idx]))
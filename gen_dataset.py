@@ -8,31 +8,36 @@
 #-------------------------------------------------------------------------------
 
 import os
+import glob
 import shutil
+import argparse
 import numpy as np
+from functools import partial
 import open3d as o3d
 from multiprocessing import Pool
+from utils import binvox_rw
 from utils.io_utils import mkdir_p
 from utils.rig_parser import Info
-from geometric_proc.common_ops import calc_surface_geodesic, get_bones
+from utils.cache_utils import pack_voxels
+from utils.skin_utils import read_skin_txt
+from geometric_proc.common_ops import calc_surface_geodesic_bounded, get_bones
 
 
 def get_tpl_edges(remesh_obj_v, remesh_obj_f):
-    edge_index = []
-    for v in range(len(remesh_obj_v)):
-        face_ids = np.argwhere(remesh_obj_f == v)[:, 0]
-        neighbor_ids = []
-        for face_id in face_ids:
-            for v_id in range(3):
-                if remesh_obj_f[face_id, v_id] != v:
-                    neighbor_ids.append(remesh_obj_f[face_id, v_id])
-        neighbor_ids = list(set(neighbor_ids))
-        neighbor_ids = [np.array([v, n])[np.newaxis, :] for n in neighbor_ids]
-        if len(neighbor_ids) == 0:
-            continue
-        neighbor_ids = np.concatenate(neighbor_ids, axis=0)
-        edge_index.append(neighbor_ids)
-    edge_index = np.concatenate(edge_index, axis=0)
+    """
+    gather topological edges (in both directions) from mesh faces
+    :param remesh_obj_v: V*3 mesh vertices
+    :param remesh_obj_f: F*3 mesh faces
+    :return: E*2 array of unique directed edges [v, neighbor], sorted by v and then by neighbor.
+             Vertices not used by any face have no edge.
+    """
+    half_edges = remesh_obj_f[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+    edge_index = np.concatenate((half_edges, half_edges[:, ::-1]), axis=0)
+    edge_index = edge_index[edge_index[:, 0] != edge_index[:, 1]]  # degenerated faces
+    # unique on a single integer key per edge, which is also sorted by v and then by neighbor
+    num_v = max(len(remesh_obj_v), int(remesh_obj_f.max()) + 1)
+    edge_key = np.unique(edge_index[:, 0].astype(np.int64) * num_v + edge_index[:, 1])
+    edge_index = np.stack((edge_key // num_v, edge_key % num_v), axis=1)
     return edge_index
 
 
@@ -49,6 +54,181 @@ def get_geo_edges(surface_geodesic, remesh_obj_v):
     return edge_index
 
 
+def get_geo_edges_bounded(geodesic_ball, remesh_obj_v):
+    """
+    same as get_geo_edges, but takes the sparse geodesic ball from calc_surface_geodesic_bounded
+    instead of the full geodesic distance matrix.
+    """
+    edge_index = []
+    for i in range(len(remesh_obj_v)):
+        geodesic_ball_samples = geodesic_ball.indices[geodesic_ball.indptr[i]:geodesic_ball.indptr[i + 1]]
+        geodesic_ball_samples = geodesic_ball_samples[geodesic_ball_samples != i]  # remove self-loop edge here
+        if len(geodesic_ball_samples) > 10:
+            geodesic_ball_samples = np.random.choice(geodesic_ball_samples, 10, replace=False)
+        edge_index.append(np.concatenate((np.repeat(i, len(geodesic_ball_samples))[:, np.newaxis],
+                                          geodesic_ball_samples[:, np.newaxis]), axis=1))
+    edge_index = np.concatenate(edge_index, axis=0)
+    return edge_index
+
+
+class ColumnarWriter:
+    """
+    Write a dataset split in binary columnar format, read by datasets.columnar_store.ColumnarStore. Every array kind
+    goes to its own raw file ({kind}.bin) holding the rows of all models back to back. index.npz keeps the model
+    names, and per kind the row offsets of each model, the dtype and the shape of one row.
+    """
+    def __init__(self, folder, dtypes=None):
+        self.folder = folder
+        self.dtypes = dict(dtypes or COLUMN_DTYPES)
+        self.names = []
+        self.files = {}
+        self.offsets = {}
+        self.shapes = {}
+        mkdir_p(folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, name, arrays):
+        """
+        :param name: model name (ID)
+        :param arrays: dict of arrays of this model. Every model must have the same kinds, and the first axis of
+                       each array is the row axis.
+        """
+        if len(self.names) > 0:
+            assert set(arrays.keys()) == set(self.files.keys()), "model {} has different array kinds".format(name)
+        for kind, arr in arrays.items():
+            arr = np.asarray(arr)
+            if arr.ndim == 0:
+                arr = arr.reshape(1)
+            if kind not in self.files:
+                self.files[kind] = open(os.path.join(self.folder, kind + '.bin'), 'wb')
+                self.offsets[kind] = [0]
+                self.shapes[kind] = arr.shape[1:]
+                self.dtypes.setdefault(kind, arr.dtype)
+            assert arr.shape[1:] == self.shapes[kind], "rows of {:s} have different shapes".format(kind)
+            np.ascontiguousarray(arr, dtype=np.dtype(self.dtypes[kind]).newbyteorder('<')).tofile(self.files[kind])
+            self.offsets[kind].append(self.offsets[kind][-1] + len(arr))
+        self.names.append(name)
+
+    def close(self):
+        index = {'names': np.array(self.names), 'kinds': np.array(list(self.files.keys()))}
+        for kind, fout in self.files.items():
+            fout.close()
+            index['offsets_' + kind] = np.array(self.offsets[kind], dtype=np.int64)
+            index['dtype_' + kind] = np.array(np.dtype(self.dtypes[kind]).newbyteorder('<').str)
+            index['shape_' + kind] = np.array(self.shapes[kind], dtype=np.int64)
+        np.savez(os.path.join(self.folder, 'index.npz'), **index)
+        self.files = {}
+
+
+# dtypes of the array kinds written by genDataset. Positions are stored as float32, the precision used in training.
+COLUMN_DTYPES = {'v': np.float32, 'attn': np.float32, 'tpl_e': np.int32, 'geo_e': np.int32, 'joints': np.float32,
+                 'adj': np.uint8, 'bones': np.float32, 'skin_bone': np.int32, 'skin_dist': np.float32,
+                 'skin_leaf': np.uint8, 'skin_label': np.float32}
+
+
+def genModelData(model_id, dataset_folder, num_nearest_bone=5):
+    """
+    compute all training data of one model
+    :param model_id: model ID
+    :param dataset_folder: folder of the downloaded pre-processed data
+    :return: dict of arrays with the kinds listed in datasets/columnar_store.py, and names of the bones
+    """
+    remeshed_obj_filename = os.path.join(dataset_folder, 'obj_remesh/{:d}.obj'.format(model_id))
+    info_filename = os.path.join(dataset_folder, 'rig_info_remesh/{:d}.txt'.format(model_id))
+    remeshed_obj = o3d.io.read_triangle_mesh(remeshed_obj_filename)
+    remesh_obj_v = np.asarray(remeshed_obj.vertices)
+    if not remeshed_obj.has_vertex_normals():
+        remeshed_obj.compute_vertex_normals()
+    remesh_obj_vn = np.asarray(remeshed_obj.vertex_normals)
+    remesh_obj_f = np.asarray(remeshed_obj.triangles)
+    rig_info = Info(info_filename)
+    arrays = {}
+
+    #vertices
+    arrays['v'] = np.concatenate((remesh_obj_v, remesh_obj_vn), axis=1)
+
+    #topology edges
+    arrays['tpl_e'] = get_tpl_edges(remesh_obj_v, remesh_obj_f)
+
+    # geodesic_edges
+    geodesic_ball = calc_surface_geodesic_bounded(remeshed_obj, limit=0.06)
+    arrays['geo_e'] = get_geo_edges_bounded(geodesic_ball, remesh_obj_v)
+
+    # joints
+    joint_pos = rig_info.get_joint_dict()
+    arrays['joints'] = np.array([np.array(i) for i in joint_pos.values()])
+    arrays['adj'] = rig_info.adjacent_matrix().ravel()
+
+    # pre_trained attn
+    arrays['attn'] = np.loadtxt(os.path.join(dataset_folder, 'pretrain_attention/{:d}.txt'.format(model_id)))
+
+    # voxel
+    with open(os.path.join(dataset_folder, 'vox/{:d}.binvox'.format(model_id)), 'rb') as fvox:
+        arrays.update(pack_voxels(binvox_rw.read_as_3d_array(fvox)))
+
+    #skinning information
+    geo_dist = np.load(os.path.join(dataset_folder, "volumetric_geodesic/{:d}_volumetric_geo.npy".format(model_id)))
+    bone_pos, bone_names, bone_isleaf = get_bones(rig_info)
+    # per vertex and nearest bone: bone_id, 1 / D_g, is_leaf, and the skinning weight as label
+    skin_bone = -np.ones((len(remesh_obj_v), num_nearest_bone), dtype=np.int64)
+    skin_dist = np.zeros((len(remesh_obj_v), num_nearest_bone))
+    skin_leaf = np.zeros((len(remesh_obj_v), num_nearest_bone), dtype=np.int64)
+    skin_label = np.zeros((len(remesh_obj_v), num_nearest_bone))
+    for vert_remesh_id in range(len(remesh_obj_v)):
+        skin = rig_info.joint_skin[vert_remesh_id]
+        skin_w = {}
+        for i in np.arange(1, len(skin), 2):
+            skin_w[skin[i]] = float(skin[i + 1])
+        bone_id_near_to_far = np.argsort(geo_dist[vert_remesh_id, :])
+        for i in range(min(num_nearest_bone, len(bone_id_near_to_far))):
+            bone_id = bone_id_near_to_far[i]
+            skin_bone[vert_remesh_id, i] = bone_id
+            skin_dist[vert_remesh_id, i] = 1.0 / (geo_dist[vert_remesh_id, bone_id] + 1e-10)
+            skin_leaf[vert_remesh_id, i] = bone_isleaf[bone_id]
+            start_joint_name = bone_names[bone_id][0]
+            if start_joint_name in skin_w:
+                skin_label[vert_remesh_id, i] = skin_w[start_joint_name]
+                del skin_w[start_joint_name]
+    arrays.update({'bones': bone_pos.reshape(-1, 6), 'skin_bone': skin_bone, 'skin_dist': skin_dist,
+                   'skin_leaf': skin_leaf, 'skin_label': skin_label})
+    return arrays, bone_names
+
+
+def saveModelTxt(split_folder, model_id, arrays, bone_names):
+    """
+    write the data of one model in the text layout: {id}_v.txt, _tpl_e.txt, _geo_e.txt, _j.txt, _adj.txt, _skin.txt
+    """
+    np.savetxt(os.path.join(split_folder, '{:d}_v.txt'.format(model_id)), arrays['v'], fmt='%.6f')
+    np.savetxt(os.path.join(split_folder, '{:d}_tpl_e.txt'.format(model_id)), arrays['tpl_e'], fmt='%d')
+    np.savetxt(os.path.join(split_folder, '{:d}_geo_e.txt'.format(model_id)), arrays['geo_e'], fmt='%d')
+    np.savetxt(os.path.join(split_folder, '{:d}_adj.txt'.format(model_id)),
+               arrays['adj'].reshape(len(arrays['joints']), -1), fmt='%d')
+    np.savetxt(os.path.join(split_folder, '{:d}_j.txt'.format(model_id)), arrays['joints'], fmt='%.6f')
+    bone_pos = arrays['bones']
+    with open(os.path.join(split_folder, '{:d}_skin.txt'.format(model_id)), 'w') as fout:
+        for i in range(len(bone_pos)):
+            fout.write('bones {:s} {:s} {:.6f} {:.6f} {:.6f} '
+                       '{:.6f} {:.6f} {:.6f}\n'.format(bone_names[i][0], bone_names[i][1],
+                                                       bone_pos[i, 0], bone_pos[i, 1], bone_pos[i, 2],
+                                                       bone_pos[i, 3], bone_pos[i, 4], bone_pos[i, 5]))
+        for i in range(len(arrays['skin_bone'])):
+            fout.write('bind {:d} '.format(i))
+            for j in range(arrays['skin_bone'].shape[1]):
+                fout.write('{:d} {:.6f} {:d} '.format(arrays['skin_bone'][i, j], arrays['skin_dist'][i, j],
+                                                      arrays['skin_leaf'][i, j]))
+            fout.write('\n')
+        for i in range(len(arrays['skin_label'])):
+            fout.write('influence ')
+            for j in range(arrays['skin_label'].shape[1]):
+                fout.write('{:.3f} '.format(arrays['skin_label'][i, j]))
+            fout.write('\n')
+
+
 def genDataset(process_id):
     global dataset_folder
     print("process ID {:d}".format(process_id))
@@ -65,42 +245,8 @@ def genDataset(process_id):
 
     mkdir_p(os.path.join(dataset_folder, split_name))
     for model_id in model_list:
-        remeshed_obj_filename = os.path.join(dataset_folder, 'obj_remesh/{:d}.obj'.format(model_id))
-        info_filename = os.path.join(dataset_folder, 'rig_info_remesh/{:d}.txt'.format(model_id))
-        remeshed_obj = o3d.io.read_triangle_mesh(remeshed_obj_filename)
-        remesh_obj_v = np.asarray(remeshed_obj.vertices)
-        if not remeshed_obj.has_vertex_normals():
-            remeshed_obj.compute_vertex_normals()
-        remesh_obj_vn = np.asarray(remeshed_obj.vertex_normals)
-        remesh_obj_f = np.asarray(remeshed_obj.triangles)
-        rig_info = Info(info_filename)
-
-        #vertices
-        vert_filename = os.path.join(dataset_folder, '{:s}/{:d}_v.txt'.format(split_name, model_id))
-        input_feature = np.concatenate((remesh_obj_v, remesh_obj_vn), axis=1)
-        np.savetxt(vert_filename, input_feature, fmt='%.6f')
-
-        #topology edges
-        edge_index = get_tpl_edges(remesh_obj_v, remesh_obj_f)
-        graph_filename = os.path.join(dataset_folder, '{:s}/{:d}_tpl_e.txt'.format(split_name, model_id))
-        np.savetxt(graph_filename, edge_index, fmt='%d')
-
-        # geodesic_edges
-        surface_geodesic = calc_surface_geodesic(remeshed_obj)
-        edge_index = get_geo_edges(surface_geodesic, remesh_obj_v)
-        graph_filename = os.path.join(dataset_folder, '{:s}/{:d}_geo_e.txt'.format(split_name, model_id))
-        np.savetxt(graph_filename, edge_index, fmt='%d')
-
-        # joints
-        joint_pos = rig_info.get_joint_dict()
-        joint_name_list = list(joint_pos.keys())
-        joint_pos_list = list(joint_pos.values())
-        joint_pos_list = [np.array(i) for i in joint_pos_list]
-        adjacent_matrix = rig_info.adjacent_matrix()
-        joint_filename = os.path.join(dataset_folder, '{:s}/{:d}_j.txt'.format(split_name, model_id))
-        adj_filename = os.path.join(dataset_folder, '{:s}/{:d}_adj.txt'.format(split_name, model_id))
-        np.savetxt(adj_filename, adjacent_matrix, fmt='%d')
-        np.savetxt(joint_filename, np.array(joint_pos_list), fmt='%.6f')
+        arrays, bone_names = genModelData(model_id, dataset_folder)
+        saveModelTxt(os.path.join(dataset_folder, split_name), model_id, arrays, bone_names)
 
         # pre_trained attn
         shutil.copyfile(os.path.join(dataset_folder, 'pretrain_attention/{:d}.txt'.format(model_id)), 
@@ -110,60 +256,57 @@ def genDataset(process_id):
         shutil.copyfile(os.path.join(dataset_folder, 'vox/{:d}.binvox'.format(model_id)), 
                         os.path.join(dataset_folder, '{:s}/{:d}.binvox'.format(split_name, model_id)))
 
-        #skinning information
-        num_nearest_bone = 5
-        geo_dist = np.load(os.path.join(dataset_folder, "volumetric_geodesic/{:d}_volumetric_geo.npy".format(model_id)))
-        bone_pos, bone_names, bone_isleaf = get_bones(rig_info)
-
-        input_samples = []  # mesh_vertex_id, (bone_id, 1 / D_g, is_leaf) * N
-        ground_truth_labels = []  # w_1, w_2, ..., w_N
-        for vert_remesh_id in range(len(remesh_obj_v)):
-            this_sample = [vert_remesh_id]
-            this_label = []
-            skin = rig_info.joint_skin[vert_remesh_id]
-            skin_w = {}
-            for i in np.arange(1, len(skin), 2):
-                skin_w[skin[i]] = float(skin[i + 1])
-            bone_id_near_to_far = np.argsort(geo_dist[vert_remesh_id, :])
-            for i in range(num_nearest_bone):
-                if i >= len(bone_id_near_to_far):
-                    this_sample += [-1, 0, 0]
-                    this_label.append(0.0)
-                    continue
-                bone_id = bone_id_near_to_far[i]
-                this_sample.append(bone_id)
-                this_sample.append(1.0 / (geo_dist[vert_remesh_id, bone_id] + 1e-10))
-                this_sample.append(bone_isleaf[bone_id])
-                start_joint_name = bone_names[bone_id][0]
-                if start_joint_name in skin_w:
-                    this_label.append(skin_w[start_joint_name])
-                    del skin_w[start_joint_name]
-                else:
-                    this_label.append(0.0)
-
-            input_samples.append(this_sample)
-            ground_truth_labels.append(this_label)
-
-        with open(os.path.join(dataset_folder, '{:s}/{:d}_skin.txt'.format(split_name, model_id)), 'w') as fout:
-            for i in range(len(bone_pos)):
-                fout.write('bones {:s} {:s} {:.6f} {:.6f} {:.6f} '
-                           '{:.6f} {:.6f} {:.6f}\n'.format(bone_names[i][0], bone_names[i][1],
-                                                           bone_pos[i, 0], bone_pos[i, 1], bone_pos[i, 2],
-                                                           bone_pos[i, 3], bone_pos[i, 4], bone_pos[i, 5]))
-            for i in range(len(input_samples)):
-                fout.write('bind {:d} '.format(input_samples[i][0]))
-                for j in np.arange(1, len(input_samples[i]), 3):
-                    fout.write('{:d} {:.6f} {:d} '.format(input_samples[i][j], input_samples[i][j + 1], input_samples[i][j + 2]))
-                fout.write('\n')
-            for i in range(len(ground_truth_labels)):
-                fout.write('influence ')
-                for j in range(len(ground_truth_labels[i])):
-                    fout.write('{:.3f} '.format(ground_truth_labels[i][j]))
-                fout.write('\n')
+
+def genDatasetColumnar(split_name, dataset_folder, num_workers=8):
+    """
+    generate one split in binary columnar format. Models are processed in a pool, and written by this process.
+    The dataset folder is passed to the workers with each task, so they don't rely on globals inherited by fork.
+    """
+    model_list = np.loadtxt(os.path.join(dataset_folder, '{:s}_final.txt'.format(split_name)), dtype=int)
+    with ColumnarWriter(os.path.join(dataset_folder, split_name)) as writer, Pool(num_workers) as p:
+        for model_id, (arrays, _) in zip(model_list, p.imap(partial(genModelData, dataset_folder=dataset_folder), model_list)):
+            print("{:s}: model ID {:d}".format(split_name, model_id))
+            writer.add(model_id, arrays)
+
+
+def convertTextSplit(split_folder, out_folder=None):
+    """
+    convert a split in the text layout ({id}_v.txt, ... {id}.binvox) to binary columnar format
+    :param split_folder: folder with the text files
+    :param out_folder: output folder, the split folder itself by default
+    """
+    v_filelist = sorted(glob.glob(os.path.join(split_folder, '*_v.txt')))
+    with ColumnarWriter(out_folder or split_folder) as writer:
+        for v_filename in v_filelist:
+            model_id = int(os.path.basename(v_filename).split('_')[0])
+            arrays = {'v': np.loadtxt(v_filename),
+                      'attn': np.loadtxt(v_filename.replace('_v.txt', '_attn.txt')),
+                      'tpl_e': np.loadtxt(v_filename.replace('_v.txt', '_tpl_e.txt'), dtype=np.int64).reshape(-1, 2),
+                      'geo_e': np.loadtxt(v_filename.replace('_v.txt', '_geo_e.txt'), dtype=np.int64).reshape(-1, 2),
+                      'joints': np.loadtxt(v_filename.replace('_v.txt', '_j.txt')).reshape(-1, 3),
+                      'adj': np.loadtxt(v_filename.replace('_v.txt', '_adj.txt'), dtype=np.uint8).ravel()}
+            with open(v_filename.replace('_v.txt', '.binvox'), 'rb') as fvox:
+                arrays.update(pack_voxels(binvox_rw.read_as_3d_array(fvox)))
+            arrays.update(read_skin_txt(v_filename.replace('_v.txt', '_skin.txt')))
+            writer.add(model_id, arrays)
 
 
 if __name__ == '__main__':
-    dataset_folder = "/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/"
-    p = Pool(8)
-    p.map(genDataset, [0, 1, 2, 3, 4, 5, 6, 7])
-    #genDataset(0)
+    parser = argparse.ArgumentParser(description='generate data for the skeleton and skinning stages')
+    parser.add_argument('--dataset_folder', type=str, default="/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/")
+    parser.add_argument('--format', type=str, default='txt', choices=['txt', 'columnar'],
+                        help='per-model text files, or one binary file per array kind and split')
+    parser.add_argument('--convert', action='store_true',
+                        help='convert the existing text splits to binary columnar format')
+    args = parser.parse_args()
+    dataset_folder = args.dataset_folder
+    if args.convert:
+        for split_name in ['train', 'val', 'test']:
+            convertTextSplit(os.path.join(dataset_folder, split_name))
+    elif args.format == 'columnar':
+        for split_name in ['train', 'val', 'test']:
+            genDatasetColumnar(split_name, dataset_folder)
+    else:
+        p = Pool(8)
+        p.map(genDataset, [0, 1, 2, 3, 4, 5, 6, 7])
+        #genDataset(0)
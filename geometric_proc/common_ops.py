@@ -9,8 +9,10 @@
 import numpy as np
 import time
 import open3d as o3d
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import dijkstra
+from scipy.spatial import cKDTree
+from utils.tree_utils import SkeletonArray
 
 
 def get_bones(skel):
@@ -22,48 +24,63 @@ def get_bones(skel):
              leaf_bones indicate if this bone is a virtual "leaf" bone.
              We add virtual "leaf" bones to the leaf joints since they always have skinning weights as well
     """
-    bones = []
-    bone_name = []
-    leaf_bones = []
-    this_level = [skel.root]
-    while this_level:
-        next_level = []
-        for p_node in this_level:
-            p_pos = np.array(p_node.pos)
-            next_level += p_node.children
-            for c_node in p_node.children:
-                c_pos = np.array(c_node.pos)
-                bones.append(np.concatenate((p_pos, c_pos))[np.newaxis, :])
-                bone_name.append([p_node.name, c_node.name])
-                leaf_bones.append(False)
-                if len(c_node.children) == 0:
-                    bones.append(np.concatenate((c_pos, c_pos))[np.newaxis, :])
-                    bone_name.append([c_node.name, c_node.name+'_leaf'])
-                    leaf_bones.append(True)
-        this_level = next_level
-    bones = np.concatenate(bones, axis=0)
-    return bones, bone_name, leaf_bones
+    return SkeletonArray.from_tree(skel.root).get_bones()
 
 
-def calc_surface_geodesic(mesh):
+def surface_knn_graph(pts, pts_normal, k=5, cos_thres=-0.5):
+    """
+    build the sparse neighbor graph over surface samples used for geodesic calculation.
+    Each sample connects to its k nearest neighbors, skipping neighbors whose normal points to the opposite direction.
+    :param pts: N*3 sample positions
+    :param pts_normal: N*3 sample normals
+    :param k: number of nearest neighbors per sample
+    :param cos_thres: neighbors with normal cosine similarity not larger than this are dropped
+    :return: N*N sparse matrix in CSR format, where (p, q) stores the euclidean distance from p to its neighbor q
+    """
+    N = len(pts)
+    kdtree = cKDTree(pts)
+    nn_dist, nn_ids = kdtree.query(pts, k=k + 1)
+    # the first neighbor is the sample itself
+    nn_dist, nn_ids = nn_dist[:, 1:], nn_ids[:, 1:]
+    norm_p = np.linalg.norm(pts_normal, axis=1)
+    cos_similar = np.sum(pts_normal[nn_ids] * pts_normal[:, np.newaxis, :], axis=2) / \
+                  (norm_p[nn_ids] * norm_p[:, np.newaxis] + 1e-10)
+    # zero-length edges are not stored, the same as assigning them to a lil_matrix
+    valid = np.logical_and(cos_similar > cos_thres, nn_dist > 0)
+    rows = np.repeat(np.arange(N), k).reshape(N, k)
+    conn_matrix = csr_matrix((nn_dist[valid].astype(np.float32), (rows[valid], nn_ids[valid])), shape=(N, N))
+    return conn_matrix
+
+
+def build_surface_graph(mesh):
+    """
+    densely sample the surface and connect the samples into a graph for geodesic calculation
+    :param mesh: input mesh loaded by open3d
+    :return: pts are N*3 sample positions
+             conn_matrix is the N*N sparse neighbor graph between samples
+             vert_pts_nn is the nearest sample id for each mesh vertex
+    """
     # We denselu sample 4000 points to be more accuracy.
     samples = mesh.sample_points_poisson_disk(number_of_points=4000)
     pts = np.asarray(samples.points)
     pts_normal = np.asarray(samples.normals)
+    conn_matrix = surface_knn_graph(pts, pts_normal)
+    verts = np.array(mesh.vertices)
+    _, vert_pts_nn = cKDTree(pts).query(verts)
+    return pts, conn_matrix, vert_pts_nn
 
+
+def calc_surface_geodesic(mesh, surface_graph=None):
+    """
+    surface geodesic distance between all pairs of vertices
+    :param mesh: input mesh loaded by open3d. Not used if surface_graph is given.
+    :param surface_graph: optional output of build_surface_graph on the same mesh, to share the samples with other
+                          geodesic queries. Built here if not given.
+    :return: V*V geodesic distance matrix
+    """
     time1 = time.time()
+    pts, conn_matrix, vert_pts_nn = surface_graph if surface_graph is not None else build_surface_graph(mesh)
     N = len(pts)
-    verts_dist = np.sqrt(np.sum((pts[np.newaxis, ...] - pts[:, np.newaxis, :]) ** 2, axis=2))
-    verts_nn = np.argsort(verts_dist, axis=1)
-    conn_matrix = lil_matrix((N, N), dtype=np.float32)
-
-    for p in range(N):
-        nn_p = verts_nn[p, 1:6]
-        norm_nn_p = np.linalg.norm(pts_normal[nn_p], axis=1)
-        norm_p = np.linalg.norm(pts_normal[p])
-        cos_similar = np.dot(pts_normal[nn_p], pts_normal[p]) / (norm_nn_p * norm_p + 1e-10)
-        nn_p = nn_p[cos_similar > -0.5]
-        conn_matrix[p, nn_p] = verts_dist[p, nn_p]
     [dist, predecessors] = dijkstra(conn_matrix, directed=False, indices=range(N),
                                     return_predecessors=True, unweighted=False)
 
@@ -71,13 +88,50 @@ def calc_surface_geodesic(mesh):
     # 6.12 is the maximal geodesic distance without considering inf, I add 8 to be safer.
     inf_pos = np.argwhere(np.isinf(dist))
     if len(inf_pos) > 0:
-        euc_distance = np.sqrt(np.sum((pts[np.newaxis, ...] - pts[:, np.newaxis, :]) ** 2, axis=2))
-        dist[inf_pos[:, 0], inf_pos[:, 1]] = 8.0 + euc_distance[inf_pos[:, 0], inf_pos[:, 1]]
+        euc_distance = np.linalg.norm(pts[inf_pos[:, 0]] - pts[inf_pos[:, 1]], axis=1)
+        dist[inf_pos[:, 0], inf_pos[:, 1]] = 8.0 + euc_distance
 
-    verts = np.array(mesh.vertices)
-    vert_pts_distance = np.sqrt(np.sum((verts[np.newaxis, ...] - pts[:, np.newaxis, :]) ** 2, axis=2))
-    vert_pts_nn = np.argmin(vert_pts_distance, axis=0)
     surface_geodesic = dist[vert_pts_nn, :][:, vert_pts_nn]
     time2 = time.time()
     print('surface geodesic calculation: {} seconds'.format((time2 - time1)))
     return surface_geodesic
+
+
+def calc_surface_geodesic_bounded(mesh, limit=0.06, chunk_size=256, surface_graph=None):
+    """
+    surface geodesic distance truncated at a radius. Only vertex pairs closer than limit are kept,
+    so the full V*V matrix is never built.
+    :param mesh: input mesh loaded by open3d
+    :param limit: maximal geodesic distance to calculate
+    :param chunk_size: number of samples used as Dijkstra sources at once
+    :param surface_graph: optional output of build_surface_graph on the same mesh. Built here if not given.
+    :return: V*V sparse matrix in CSR format. A vertex pair is within the geodesic ball iff it is stored,
+             and the stored value is the geodesic distance (it can be an explicit zero when two vertices
+             share the same nearest sample, including the vertex itself).
+    """
+    time1 = time.time()
+    pts, conn_matrix, vert_pts_nn = surface_graph if surface_graph is not None else build_surface_graph(mesh)
+    V = len(vert_pts_nn)
+    # group vertices by their nearest sample
+    vert_order = np.argsort(vert_pts_nn, kind='stable')
+    src_pts, src_start, src_count = np.unique(vert_pts_nn[vert_order], return_index=True, return_counts=True)
+
+    rows, cols, vals = [], [], []
+    for c in range(0, len(src_pts), chunk_size):
+        chunk = slice(c, c + chunk_size)
+        dist = dijkstra(conn_matrix, directed=False, indices=src_pts[chunk], limit=limit)
+        dist = dist[:, vert_pts_nn]
+        src_id, col = np.nonzero(dist <= limit)
+        val = dist[src_id, col]
+        # expand each source sample to all vertices mapped to it
+        num_rep = src_count[chunk][src_id]
+        offsets = np.arange(num_rep.sum()) - np.repeat(np.cumsum(num_rep) - num_rep, num_rep)
+        rows.append(vert_order[np.repeat(src_start[chunk][src_id], num_rep) + offsets])
+        cols.append(np.repeat(col, num_rep))
+        vals.append(np.repeat(val, num_rep))
+    rows, cols, vals = np.concatenate(rows), np.concatenate(cols), np.concatenate(vals)
+    geodesic_ball = csr_matrix((vals, (rows, cols)), shape=(V, V))
+    geodesic_ball.sort_indices()
+    time2 = time.time()
+    print('bounded surface geodesic calculation: {} seconds'.format((time2 - time1)))
+    return geodesic_ball
@@ -14,12 +14,15 @@ import os
 import trimesh
 import numpy as np
 import open3d as o3d
+from multiprocessing import Pool
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import dijkstra
 from utils.os_utils import mkdir_p
 from utils.rig_parser import Info
-from geometric_proc.common_ops import get_bones, calc_surface_geodesic
+from geometric_proc.common_ops import get_bones, calc_surface_geodesic, build_surface_graph
 
 
-def pts2line(pts, lines):
+def pts2line(pts, lines, max_memory=None):
     '''
     Calculate points-to-bone distance. Point to line segment distance refer to
     https://stackoverflow.com/questions/849211/shortest-distance-between-a-point-and-a-line-segment
@@ -29,27 +32,63 @@ def pts2line(pts, lines):
              ends are the points themselves.
              dist is the distance in between, which is the distance from points to lines.
              Origins and ends will be used for generate rays.
+    :param max_memory: optional bound (in bytes) of temporary arrays. Bones are then processed in chunks.
     '''
     l2 = np.sum((lines[:, 3:6] - lines[:, 0:3]) ** 2, axis=1)
-    origins = np.zeros((len(pts) * len(lines), 3))
-    ends = np.zeros((len(pts) * len(lines), 3))
-    dist = np.zeros((len(pts) * len(lines)))
-    for l in range(len(lines)):
-        if np.abs(l2[l]) < 1e-8:  # for zero-length edges
-            origins[l * len(pts):(l + 1) * len(pts)] = lines[l][0:3]
-        else:  # for other edges
-            t = np.sum((pts - lines[l][0:3][np.newaxis, :]) * (lines[l][3:6] - lines[l][0:3])[np.newaxis, :], axis=1) / \
-                l2[l]
-            t = np.clip(t, 0, 1)
-            t_pos = lines[l][0:3][np.newaxis, :] + t[:, np.newaxis] * (lines[l][3:6] - lines[l][0:3])[np.newaxis, :]
-            origins[l * len(pts):(l + 1) * len(pts)] = t_pos
-        ends[l * len(pts):(l + 1) * len(pts)] = pts
-        dist[l * len(pts):(l + 1) * len(pts)] = np.linalg.norm(
-            origins[l * len(pts):(l + 1) * len(pts)] - ends[l * len(pts):(l + 1) * len(pts)], axis=1)
-    return origins, ends, dist
-
-
-def calc_pts2bone_visible_mat(mesh, origins, ends):
+    origins = np.zeros((len(lines), len(pts), 3))
+    ends = np.zeros((len(lines), len(pts), 3))
+    dist = np.zeros((len(lines), len(pts)))
+    if max_memory is None:
+        chunk_size = max(len(lines), 1)
+    else:
+        # about 8 float64 values of temporary storage for each point-bone pair
+        chunk_size = int(max(max_memory // (64 * max(len(pts), 1)), 1))
+    ends[:] = pts[np.newaxis, ...]
+    for l_start in range(0, len(lines), chunk_size):
+        # all points against a chunk of bones at once. Outputs are laid out bone by bone.
+        l_end = min(l_start + chunk_size, len(lines))
+        line_start = lines[l_start:l_end, np.newaxis, 0:3]
+        line_dir = lines[l_start:l_end, np.newaxis, 3:6] - line_start
+        zero_length = np.abs(l2[l_start:l_end]) < 1e-8  # for zero-length edges
+        diff = pts[np.newaxis, ...] - line_start
+        t = diff[..., 0] * line_dir[..., 0] + diff[..., 1] * line_dir[..., 1] + diff[..., 2] * line_dir[..., 2]
+        t /= np.where(zero_length, 1.0, l2[l_start:l_end])[:, np.newaxis]
+        t[zero_length] = 0.0
+        np.clip(t, 0, 1, out=t)
+        t_pos = origins[l_start:l_end]
+        np.multiply(t[..., np.newaxis], line_dir, out=t_pos)
+        t_pos += line_start
+        np.subtract(t_pos, pts[np.newaxis, ...], out=diff)
+        diff *= diff
+        dist[l_start:l_end] = np.sqrt(diff[..., 0] + diff[..., 1] + diff[..., 2])
+    return origins.reshape(-1, 3), ends.reshape(-1, 3), dist.reshape(-1)
+
+
+def _first_hit_distance(mesh, origins, ray_dir):
+    '''
+    distance from the origin to the nearest intersection of each ray with the mesh, inf if the ray misses it
+    '''
+    RayMeshIntersector = trimesh.ray.ray_triangle.RayMeshIntersector(mesh)
+    locations, index_ray, _ = RayMeshIntersector.intersects_location(origins, ray_dir + 1e-15, multiple_hits=False)
+    min_hit_distance = np.full(len(ray_dir), np.inf)
+    # group hits by ray. Usually one hit per ray, but keep the nearest in case several are returned.
+    np.minimum.at(min_hit_distance, index_ray, np.linalg.norm(locations - origins[index_ray], axis=1))
+    return min_hit_distance
+
+
+_pool_mesh = None
+
+
+def _pool_init(mesh):
+    global _pool_mesh
+    _pool_mesh = mesh
+
+
+def _pool_first_hit_distance(args):
+    return _first_hit_distance(_pool_mesh, *args)
+
+
+def calc_pts2bone_visible_mat(mesh, origins, ends, num_workers=1, chunk_size=100000):
     '''
     Check whether the surface point is visible by the internal bone.
     Visible is defined as no occlusion on the path between.
@@ -57,24 +96,90 @@ def calc_pts2bone_visible_mat(mesh, origins, ends):
     :param surface_pts: points on the surface (n*3)
     :param origins: origins of rays
     :param ends: ends of the rays, together with origins, we can decide the direction of the ray.
+    :param num_workers: number of processes casting chunks of rays in parallel
+    :param chunk_size: number of rays per chunk
     :return: binary visibility matrix (n*m), where 1 indicate the n-th surface point is visible to the m-th ray
     '''
     ray_dir = ends - origins
-    RayMeshIntersector = trimesh.ray.ray_triangle.RayMeshIntersector(mesh)
-    locations, index_ray, index_tri = RayMeshIntersector.intersects_location(origins, ray_dir + 1e-15)
-    locations_per_ray = [locations[index_ray == i] for i in range(len(ray_dir))]
-    min_hit_distance = []
-    for i in range(len(locations_per_ray)):
-        if len(locations_per_ray[i]) == 0:
-            min_hit_distance.append(np.linalg.norm(ray_dir[i]))
-        else:
-            min_hit_distance.append(np.min(np.linalg.norm(locations_per_ray[i] - origins[i], axis=1)))
-    min_hit_distance = np.array(min_hit_distance)
+    chunks = [(origins[i:i + chunk_size], ray_dir[i:i + chunk_size]) for i in range(0, len(ray_dir), chunk_size)]
+    if num_workers > 1 and len(chunks) > 1:
+        with Pool(num_workers, initializer=_pool_init, initargs=(mesh,)) as p:
+            min_hit_distance = p.map(_pool_first_hit_distance, chunks)
+    else:
+        min_hit_distance = [_first_hit_distance(mesh, *chunk) for chunk in chunks]
+    min_hit_distance = np.concatenate(min_hit_distance) if len(chunks) > 0 else np.zeros(0)
     distance = np.linalg.norm(ray_dir, axis=1)
+    # rays without any hit reach their ends
+    min_hit_distance = np.where(np.isinf(min_hit_distance), distance, min_hit_distance)
     vis_mat = (np.abs(min_hit_distance - distance) < 1e-4)
     return vis_mat
 
 
+def propagate_invisible(pts_bone_dist, pts_bone_visibility, surface_geodesic, max_memory=None):
+    '''
+    Volumetric geodesic distance from vertices to bones. Visible vertices go straight to the bone. Invisible vertices
+    go along the surface to the nearest visible vertex (by surface geodesic distance), and then to the bone.
+    :param pts_bone_dist: V*B distance from vertices to bones
+    :param pts_bone_visibility: V*B visibility of bones from vertices
+    :param surface_geodesic: V*V surface geodesic distance between vertices
+    :param max_memory: optional bound (in bytes) of temporary arrays. Invisible vertices are then processed in chunks.
+    :return: V*B volumetric geodesic distance
+    '''
+    visible_matrix = np.zeros(pts_bone_visibility.shape)
+    visible_matrix[pts_bone_visibility == 1] = pts_bone_dist[pts_bone_visibility == 1]
+    for c in range(visible_matrix.shape[1]):
+        unvisible_pts = np.flatnonzero(pts_bone_visibility[:, c] == 0)
+        visible_pts = np.flatnonzero(pts_bone_visibility[:, c] == 1)
+        if len(visible_pts) == 0:
+            visible_matrix[:, c] = pts_bone_dist[:, c]
+            continue
+        if max_memory is None:
+            chunk_size = max(len(unvisible_pts), 1)
+        else:
+            chunk_size = int(max(max_memory // (16 * len(visible_pts)), 1))
+        for r_start in range(0, len(unvisible_pts), chunk_size):
+            r = unvisible_pts[r_start:r_start + chunk_size]
+            geo_sub = surface_geodesic[np.ix_(r, visible_pts)]
+            nn_id = np.argmin(geo_sub, axis=1)
+            dist1 = geo_sub[np.arange(len(r)), nn_id]
+            visible_matrix[r, c] = np.where(np.isinf(dist1), 8.0 + pts_bone_dist[r, c],
+                                            dist1 + pts_bone_dist[visible_pts[nn_id], c])
+    return visible_matrix
+
+
+def propagate_invisible_dijkstra(pts_bone_dist, pts_bone_visibility, conn_matrix, vert_pts_nn):
+    '''
+    Volumetric geodesic distance from vertices to bones, by a multi-source Dijkstra over the surface graph per bone.
+    Sources are the visible vertices, starting at their distance to the bone, so invisible vertices take the shortest
+    surface + interior path over all visible vertices, instead of going through the nearest visible vertex.
+    The dense surface geodesic matrix is not needed.
+    :param pts_bone_dist: V*B distance from vertices to bones
+    :param pts_bone_visibility: V*B visibility of bones from vertices
+    :param conn_matrix: sparse graph on surface samples, as returned by build_surface_graph
+    :param vert_pts_nn: nearest surface sample of each vertex
+    :return: V*B volumetric geodesic distance
+    '''
+    num_pts = conn_matrix.shape[0]
+    graph = conn_matrix.maximum(conn_matrix.T).tocoo()
+    visible_matrix = np.zeros(pts_bone_visibility.shape)
+    for c in range(visible_matrix.shape[1]):
+        visible_pts = np.flatnonzero(pts_bone_visibility[:, c] == 1)
+        if len(visible_pts) == 0:
+            visible_matrix[:, c] = pts_bone_dist[:, c]
+            continue
+        # a virtual source node linked to the samples of visible vertices
+        source_dist = np.full(num_pts, np.inf)
+        np.minimum.at(source_dist, vert_pts_nn[visible_pts], pts_bone_dist[visible_pts, c])
+        source_nn = np.flatnonzero(np.isfinite(source_dist))
+        graph_c = csr_matrix((np.concatenate((graph.data, np.maximum(source_dist[source_nn], 1e-10))),
+                              (np.concatenate((graph.row, np.full(len(source_nn), num_pts))),
+                               np.concatenate((graph.col, source_nn)))), shape=(num_pts + 1, num_pts + 1))
+        dist = dijkstra(graph_c, directed=True, indices=num_pts)[vert_pts_nn]
+        visible_matrix[:, c] = np.where(np.isinf(dist), 8.0 + pts_bone_dist[:, c], dist)
+        visible_matrix[visible_pts, c] = pts_bone_dist[visible_pts, c]
+    return visible_matrix
+
+
 def show_visible_mat(mesh_filename, joint_pos, vis_mat, joint_id):
     from utils.vis_utils import drawSphere
 
@@ -96,7 +201,7 @@ def show_visible_mat(mesh_filename, joint_pos, vis_mat, joint_id):
     vis.destroy_window()
 
 
-def one_process(dataset_folder, start_id, end_id):
+def one_process(dataset_folder, start_id, end_id, geodesic_mode='nearest'):
     model_list = np.loadtxt(os.path.join(dataset_folder, 'model_list.txt'), dtype=int)
     model_list = model_list[start_id: end_id]
     remesh_obj_folder = os.path.join(dataset_folder, "obj_remesh")
@@ -145,29 +250,18 @@ def one_process(dataset_folder, start_id, end_id):
             #np.save(os.path.join(dataset_folder, "volumetric_geodesic/{:d}_visibility_filtered.npy".format(model_id)), pts_bone_visibility)
 
         mesh = o3d.io.read_triangle_mesh(os.path.join(remesh_obj_folder, '{:d}.obj'.format(model_id)))
-        surface_geodesic = calc_surface_geodesic(mesh)
-
-        visible_matrix = np.zeros(pts_bone_visibility.shape)
-        visible_matrix[np.where(pts_bone_visibility == 1)] = pts_bone_dist[np.where(pts_bone_visibility == 1)]
-        euc_dist = np.sqrt(np.sum((pts[np.newaxis, ...] - pts[:, np.newaxis, :]) ** 2, axis=2))
-        for c in range(visible_matrix.shape[1]):
-            unvisible_pts = np.argwhere(pts_bone_visibility[:, c] == 0).squeeze(1)
-            visible_pts = np.argwhere(pts_bone_visibility[:, c] == 1).squeeze(1)
-            if len(visible_pts) == 0:
-                visible_matrix[:, c] = pts_bone_dist[:, c]
-                continue
-            for r in unvisible_pts:
-                dist1 = np.min(surface_geodesic[r, visible_pts])
-                nn_visible = visible_pts[np.argmin(surface_geodesic[r, visible_pts])]
-                if np.isinf(dist1):
-                    visible_matrix[r, c] = 8.0 + pts_bone_dist[r, c]
-                else:
-                    visible_matrix[r, c] = dist1 + visible_matrix[nn_visible, c]
+        if geodesic_mode == 'dijkstra':
+            _, conn_matrix, vert_pts_nn = build_surface_graph(mesh)
+            visible_matrix = propagate_invisible_dijkstra(pts_bone_dist, pts_bone_visibility, conn_matrix, vert_pts_nn)
+        else:
+            surface_geodesic = calc_surface_geodesic(mesh)
+            visible_matrix = propagate_invisible(pts_bone_dist, pts_bone_visibility, surface_geodesic)
         np.save(os.path.join(dataset_folder, "volumetric_geodesic/{:d}_volumetric_geo.npy".format(model_id)), visible_matrix)
 
 
 if __name__ == '__main__':
     start_id = int(sys.argv[1])
     end_id = int(sys.argv[2])
+    geodesic_mode = sys.argv[3] if len(sys.argv) > 3 else 'nearest'  # 'nearest' or 'dijkstra'
     dataset_folder = "/media/zhanxu/4T1/ModelResource_Dataset/"
-    one_process(dataset_folder, start_id, end_id)
+    one_process(dataset_folder, start_id, end_id, geodesic_mode)
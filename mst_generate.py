@@ -16,10 +16,10 @@ from utils.tree_utils import TreeNode
 from utils.rig_parser import Skel
 from utils.vis_utils import show_obj_skel, draw_shifted_pts
 from utils.io_utils import readPly
-from utils.cluster_utils import meanshift_cluster, nms_meanshift
-from utils.mst_utils import primMST_symmetry, loadSkel_recur, increase_cost_for_outside_bone, flip, inside_check, sample_on_bone
-from gen_dataset import get_geo_edges, get_tpl_edges
-from geometric_proc.common_ops import calc_surface_geodesic
+from utils.cluster_utils import meanshift_cluster_grid, kernel_density, nms_meanshift_grid
+from utils.mst_utils import primMST_symmetry, loadSkel_recur, increase_cost_for_outside_bone, flip, inside_check, pair_occupancy
+from gen_dataset import get_geo_edges_bounded, get_tpl_edges
+from geometric_proc.common_ops import calc_surface_geodesic_bounded
 
 import torch
 from torch_geometric.data import Data
@@ -64,15 +64,12 @@ def predict_joints(model_id, args):
     # img = draw_shifted_pts(mesh_file, pred_joints, weights=pred_attn)
     # cv2.imwrite(os.path.join(res_folder, '{:s}_raw.jpg'.format(model_id)), img[:, :, ::-1])
 
-    pred_joints = meanshift_cluster(pred_joints, bandwidth, pred_attn, max_iter=20)
-    Y_dist = np.sum(((pred_joints[np.newaxis, ...] - pred_joints[:, np.newaxis, :]) ** 2), axis=2)
-    density = np.maximum(bandwidth ** 2 - Y_dist, np.zeros(Y_dist.shape))
-    # density = density * pred_attn
-    density = np.sum(density, axis=0)
+    pred_joints = meanshift_cluster_grid(pred_joints, bandwidth, pred_attn, max_iter=20)
+    density = kernel_density(pred_joints, bandwidth)
     density_sum = np.sum(density)
     pred_joints_ = pred_joints[density / density_sum > args.threshold_best]
     density_ = density[density / density_sum > args.threshold_best]
-    pred_joints_ = nms_meanshift(pred_joints_, density_, bandwidth)
+    pred_joints_ = nms_meanshift_grid(pred_joints_, density_, bandwidth)
     pred_joints_, _ = flip(pred_joints_)
 
     reduce_threshold = args.threshold_best
@@ -81,10 +78,10 @@ def predict_joints(model_id, args):
         reduce_threshold = reduce_threshold / 1.3
         pred_joints_ = pred_joints[density / density_sum >= reduce_threshold]
         density_ = density[density / density_sum > reduce_threshold]
-        pred_joints_ = nms_meanshift(pred_joints_, density_, bandwidth)
+        pred_joints_ = nms_meanshift_grid(pred_joints_, density_, bandwidth)
         pred_joints_, _ = flip(pred_joints_)
     if reduce_threshold <= 1e-7:
-        pred_joints_ = nms_meanshift(pred_joints_, density, bandwidth)
+        pred_joints_ = nms_meanshift_grid(pred_joints_, density, bandwidth)
         pred_joints_, _ = flip(pred_joints_)
 
     pred_joints = pred_joints_
@@ -108,12 +105,12 @@ def getInitId(data, model):
     return root_id
 
 
-def create_single_data(mesh, vox, surface_geodesic, pred_joints):
+def create_single_data(mesh, vox, geodesic_ball, pred_joints):
     """
     create data used as input to networks, wrapped by Data structure in pytorch-gemetric library
     :param mesh: input mesh loaded by open3d
     :param vox: voxelized mesh
-    :param surface_geodesic: geodesic distance matrix of all vertices
+    :param geodesic_ball: sparse surface geodesic distance between vertices within the geodesic ball
     :param pred_joints: predicted joints
     :return: wrapped data structure
     """
@@ -133,23 +130,17 @@ def create_single_data(mesh, vox, surface_geodesic, pred_joints):
 
     # geodesic edges
     print("     gathering geodesic edges.")
-    geo_e = get_geo_edges(surface_geodesic, mesh_v).T
+    geo_e = get_geo_edges_bounded(geodesic_ball, mesh_v).T
     geo_e = torch.from_numpy(geo_e).long()
     geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
 
     batch = np.zeros(len(v))
     batch = torch.from_numpy(batch).long()
 
-    pair_all = []
-    for joint1_id in range(len(pred_joints)):
-        for joint2_id in range(joint1_id + 1, len(pred_joints)):
-            dist = np.linalg.norm(pred_joints[joint1_id] - pred_joints[joint2_id])
-            bone_samples = sample_on_bone(pred_joints[joint1_id], pred_joints[joint2_id])
-            bone_samples_inside, _ = inside_check(bone_samples, vox)
-            outside_proportion = len(bone_samples_inside) / (len(bone_samples) + 1e-10)
-            pair = np.array([joint1_id, joint2_id, dist, outside_proportion, 1])
-            pair_all.append(pair)
-    pair_all = np.array(pair_all)
+    pairs, num_samples, num_inside = pair_occupancy(pred_joints, vox)
+    dist = np.linalg.norm(pred_joints[pairs[:, 0]] - pred_joints[pairs[:, 1]], axis=1)
+    pair_all = np.concatenate((pairs, dist[:, np.newaxis], (num_inside / (num_samples + 1e-10))[:, np.newaxis],
+                               np.ones((len(pairs), 1))), axis=1)
     pair_all = torch.from_numpy(pair_all).float()
     num_pair = len(pair_all)
     num_joint = len(pred_joints)
@@ -187,8 +178,8 @@ def run_mst_generate(args):
         pred_joints, vox = predict_joints(model_id, args)
         mesh_filename = os.path.join(args.dataset_folder, 'obj_remesh/{:d}.obj'.format(model_id))
         mesh = o3d.io.read_triangle_mesh(mesh_filename)
-        surface_geodesic = calc_surface_geodesic(mesh)
-        data = create_single_data(mesh, vox, surface_geodesic, pred_joints)
+        geodesic_ball = calc_surface_geodesic_bounded(mesh, limit=0.06)
+        data = create_single_data(mesh, vox, geodesic_ball, pred_joints)
         root_id = getInitId(data, root_select_model)
         with torch.no_grad():
             cost_matrix, _ = connectivity_model.forward(data)
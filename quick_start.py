@@ -23,13 +23,13 @@ from utils.tree_utils import TreeNode
 from utils.io_utils import assemble_skel_skin
 from utils.vis_utils import draw_shifted_pts, show_obj_skel, show_mesh_vox
 from utils.cluster_utils import meanshift_cluster, nms_meanshift
-from utils.mst_utils import increase_cost_for_outside_bone, primMST_symmetry, loadSkel_recur, inside_check, flip
+from utils.mst_utils import increase_cost_for_outside_bone, primMST_symmetry, loadSkel_recur, inside_check, flip, sample_on_bone
 
 from geometric_proc.common_ops import get_bones, calc_surface_geodesic
 from geometric_proc.compute_volumetric_geodesic import pts2line, calc_pts2bone_visible_mat
 
 from gen_dataset import get_tpl_edges, get_geo_edges
-from mst_generate import sample_on_bone, getInitId
+from mst_generate import getInitId
 from run_skinning import post_filter
 
 from models.GCN import JOINTNET_MASKNET_MEANSHIFT as JOINTNET
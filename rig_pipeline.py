@@ -0,0 +1,271 @@
+#-------------------------------------------------------------------------------
+# Name:        rig_pipeline.py
+# Purpose:     staged executor rigging many meshes at once, overlapping geometry processing with network inference
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import sys
+sys.path.append("./")
+import os
+import glob
+import time
+import queue
+import argparse
+import threading
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from rig_predictor import RigPredictor
+
+# marks the end of the input of a stage
+_STOP = object()
+
+
+def _preprocess(predictor, item, config):
+    item.update(predictor.prepare_single_data(item['input_folder'], item['model_id']))
+
+
+def _extract_joints(predictor, item, config):
+    predictor.extract_joints(item, config['threshold'], config['bandwidth'])
+
+
+def _build_skeleton(predictor, item, config):
+    item['pred_skel'] = predictor.build_skeleton(item['data'], item['vox'], item.pop('root_id'),
+                                                 item.pop('connect_prob'), item.pop('pair_outside'))
+    predictor.prepare_skinning(item)
+    # the surface graph and cache entry are only needed for the skinning input, drop them before the network
+    for k in ['artefacts', 'surface_graph']:
+        item.pop(k, None)
+
+
+def _save(predictor, item, config):
+    predictor.finish_skinning(item)
+    predictor.save_single_result(item)
+    # release the per-mesh arrays, only the rig and the timing are kept
+    for k in ['data', 'vox', 'artefacts', 'surface_graph']:
+        item.pop(k, None)
+
+
+_GEOMETRY_STAGES = {'preprocess': _preprocess, 'joints': _extract_joints, 'skeleton': _build_skeleton, 'save': _save}
+# (keys read, keys added or changed) by each geometry stage. Only these are sent to and back from a worker process,
+# keys read and removed by a stage are removed from the item as well.
+_STAGE_KEYS = {
+    'preprocess': (['input_folder', 'model_id'],
+                   ['mesh_filename', 'cache_key', 'artefacts', 'surface_graph', 'data', 'vox',
+                    'translation_normalize', 'scale_normalize']),
+    'joints': (['data', 'vox', 'y_pred', 'attn_pred', 'bandwidth_pred'], ['data', 'pair_outside']),
+    'skeleton': (['data', 'vox', 'root_id', 'connect_prob', 'pair_outside', 'mesh_filename', 'cache_key',
+                  'artefacts', 'surface_graph'], ['data', 'pred_skel', 'skin_info']),
+    'save': (['data', 'vox', 'pred_skel', 'skin_info', 'skin_pred', 'input_folder', 'model_id', 'mesh_filename',
+              'translation_normalize', 'scale_normalize'], ['pred_rig'])}
+# state of a geometry worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(predictor, config):
+    _worker['predictor'] = predictor
+    _worker['config'] = config
+
+
+def _run_in_worker(name, item):
+    """
+    :return: the entries added or changed by the stage, and the keys it removed
+    """
+    read_keys, write_keys = _STAGE_KEYS[name]
+    _GEOMETRY_STAGES[name](_worker['predictor'], item, _worker['config'])
+    return {k: item[k] for k in write_keys if k in item}, [k for k in read_keys if k not in item]
+
+
+class RigPipeline:
+    """
+    Rig a stream of meshes with a RigPredictor. Every step of rigging is a stage with its own worker threads,
+    and stages are connected by bounded queues:
+        preprocess -> joint_net -> joints -> skeleton_net -> skeleton -> skin_net -> save
+    Network stages run a single thread in this process, which batches whatever meshes are waiting in its queue
+    (up to batch_size). Geometry stages run several threads, each handing one mesh at a time to a shared pool of
+    num_workers processes, since much of remeshing, edge gathering, MST and skin assembly is Python-level code
+    holding the GIL. While one mesh is in skin inference the next ones are remeshed or computing their geodesic
+    matrices. With processes=False the geometry stages run in the threads themselves.
+    """
+    def __init__(self, predictor, num_workers=None, batch_size=4, queue_size=8, bandwidth=None, threshold=None,
+                 processes=True):
+        self.predictor = predictor
+        self.num_workers = num_workers or max(os.cpu_count() // 2, 1)
+        self.batch_size = batch_size
+        self.config = {'bandwidth': bandwidth or 0.045, 'threshold': threshold or 0.75e-5}
+        self.processes = processes
+        # (name, function, number of workers, batched)
+        self.stages = [('preprocess', _preprocess, self.num_workers, False),
+                       ('joint_net', predictor.run_joint_net, 1, True),
+                       ('joints', _extract_joints, self.num_workers, False),
+                       ('skeleton_net', predictor.run_skeleton_net, 1, True),
+                       ('skeleton', _build_skeleton, self.num_workers, False),
+                       ('skin_net', predictor.run_skin_net, 1, True),
+                       ('save', _save, self.num_workers, False)]
+        # joints clustered on the device of the networks stay in this process
+        self.local_stages = ['joints'] if predictor.torch_clustering else []
+        self.queues = [queue.Queue(queue_size) for _ in self.stages]
+        self.pool = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.stage_time = {s[0]: 0.0 for s in self.stages}
+        self.num_done = 0
+        self.num_failed = 0
+
+    def start(self):
+        assert len(self.threads) == 0, "pipeline is already running"
+        if self.processes:
+            # spawn, since the parent may hold CUDA state which must not be forked
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(self.predictor, self.config))
+        for s, (name, func, num_workers, batched) in enumerate(self.stages):
+            out_queue = self.queues[s + 1] if s + 1 < len(self.stages) else None
+            threads = [threading.Thread(target=self._worker, args=(name, func, batched, self.queues[s], out_queue),
+                                        name='{:s}_{:d}'.format(name, i), daemon=True) for i in range(num_workers)]
+            for t in threads:
+                t.start()
+            self.threads.append(threads)
+
+    def stop(self):
+        """
+        finish all submitted meshes, then stop the workers stage by stage
+        """
+        for s, threads in enumerate(self.threads):
+            for _ in threads:
+                self.queues[s].put(_STOP)
+            for t in threads:
+                t.join()
+        self.threads = []
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def submit(self, input_folder, model_id):
+        """
+        add one mesh to the pipeline. Blocks while the first queue is full.
+        :return: dict holding the state of this mesh. item['done'] is set once it leaves the pipeline.
+                 The rig is then in item['pred_rig'], or the error message in item['error'].
+        """
+        item = {'input_folder': input_folder, 'model_id': model_id, 'error': None, 'pred_rig': None,
+                'timing': {}, 'done': threading.Event(), 'submit_time': time.time()}
+        self.queues[0].put(item)
+        return item
+
+    def run(self, inputs):
+        """
+        rig a list of meshes
+        :param inputs: list of (input_folder, model_id)
+        :return: list of items in the same order as inputs
+        """
+        self.start()
+        items = [self.submit(input_folder, model_id) for input_folder, model_id in inputs]
+        self.stop()
+        return items
+
+    def queue_depth(self):
+        """
+        :return: number of meshes waiting in front of each stage
+        """
+        return {name: q.qsize() for (name, _, _, _), q in zip(self.stages, self.queues)}
+
+    def stats(self):
+        with self.lock:
+            return {'done': self.num_done, 'failed': self.num_failed, 'queue_depth': self.queue_depth(),
+                    'stage_time': dict(self.stage_time)}
+
+    def _worker(self, name, func, batched, in_queue, out_queue):
+        stop = False
+        while not stop:
+            item = in_queue.get()
+            if item is _STOP:
+                break
+            items = [item]
+            while batched and len(items) < self.batch_size:
+                try:
+                    item = in_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                items.append(item)
+            self._process(name, func, batched, [item for item in items if item['error'] is None])
+            for item in items:
+                if out_queue is not None and item['error'] is None:
+                    out_queue.put(item)
+                else:
+                    self._finish(item)
+
+    def _process(self, name, func, batched, items):
+        if len(items) == 0:
+            return
+        time1 = time.time()
+        try:
+            if batched:
+                func(items)
+            elif self.pool is not None and name not in self.local_stages:
+                self._run_in_pool(name, items[0])
+            else:
+                func(self.predictor, items[0], self.config)
+        except Exception:
+            for item in items:
+                item['error'] = '{:s}: {:s}'.format(name, traceback.format_exc())
+        elapsed = time.time() - time1
+        for item in items:
+            item['timing'][name] = elapsed
+        with self.lock:
+            self.stage_time[name] += elapsed
+
+    def _run_in_pool(self, name, item):
+        """
+        run a geometry stage on one item in a worker process, and merge back the entries it added, changed or removed.
+        Only the keys listed for the stage in _STAGE_KEYS cross the process boundary.
+        """
+        payload = {k: item[k] for k in _STAGE_KEYS[name][0] if k in item}
+        result, removed = self.pool.submit(_run_in_worker, name, payload).result()
+        for k in removed:
+            item.pop(k, None)
+        item.update(result)
+
+    def _finish(self, item):
+        item['timing']['total'] = time.time() - item['submit_time']
+        with self.lock:
+            if item['error'] is None:
+                self.num_done += 1
+            else:
+                self.num_failed += 1
+        item['done'].set()
+
+
+def main(args):
+    if args.model_ids is None:
+        model_ids = sorted([os.path.basename(f)[:-len('_ori.obj')]
+                            for f in glob.glob(os.path.join(args.input_folder, '*_ori.obj'))])
+    else:
+        model_ids = args.model_ids
+    predictor = RigPredictor(downsample_skinning=True, cache_folder=args.cache_folder)
+    pipeline = RigPipeline(predictor, num_workers=args.num_workers, batch_size=args.batch_size)
+    time1 = time.time()
+    items = pipeline.run([(args.input_folder, model_id) for model_id in model_ids])
+    time2 = time.time()
+    for item in items:
+        if item['error'] is not None:
+            print('{:s} failed in {:s}'.format(item['model_id'], item['error']))
+        else:
+            print('{:s}: {:s}'.format(item['model_id'], ', '.join(
+                ['{:s} {:.2f}s'.format(k, v) for k, v in item['timing'].items()])))
+    print('rigged {:d} meshes in {:.2f}s'.format(len(items), time2 - time1))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='rig all meshes in a folder')
+    parser.add_argument('--input_folder', type=str, default='quick_start/')
+    parser.add_argument('--model_ids', type=str, nargs='+', default=None,
+                        help='model IDs to rig. All {id}_ori.obj in input_folder by default')
+    parser.add_argument('--num_workers', type=int, default=None, help='workers per geometry stage')
+    parser.add_argument('--batch_size', type=int, default=4, help='max number of meshes per network batch')
+    parser.add_argument('--cache_folder', type=str, default=None, help='folder of the preprocessing cache')
+    args = parser.parse_args()
+    main(args)
@@ -1,23 +1,26 @@
 import os
-from sys import platform
 import trimesh
 import numpy as np
 import open3d as o3d
-import itertools as it
+from scipy.spatial import cKDTree
 import torch
 from torch_geometric.data import Data
 from torch_geometric.utils import add_self_loops
-from utils import binvox_rw
 from utils.rig_parser import Skel, Info
 from utils.tree_utils import TreeNode
 from utils.io_utils import assemble_skel_skin
+from utils.cache_utils import PreprocessCache, pack_voxels, unpack_voxels
+from utils.vox_utils import voxelize
 from utils.vis_utils import draw_shifted_pts, show_obj_skel, show_mesh_vox
-from utils.cluster_utils import meanshift_cluster, nms_meanshift
-from utils.mst_utils import increase_cost_for_outside_bone, primMST_symmetry, loadSkel_recur, inside_check, flip
-from geometric_proc.common_ops import get_bones, calc_surface_geodesic
-from geometric_proc.compute_volumetric_geodesic import pts2line, calc_pts2bone_visible_mat
-from gen_dataset import get_tpl_edges, get_geo_edges
-from mst_generate import sample_on_bone, getInitId
+from utils.cluster_utils import meanshift_cluster_grid, density_nms
+from utils.cluster_utils_torch import cluster_joints as cluster_joints_torch, cluster_joints_batch
+from utils.mst_utils import increase_cost_for_outside_bone, primMST_symmetry, loadSkel_recur, inside_check, flip, \
+    pair_occupancy
+from geometric_proc.common_ops import get_bones, build_surface_graph, calc_surface_geodesic, \
+    calc_surface_geodesic_bounded
+from geometric_proc.compute_volumetric_geodesic import pts2line, calc_pts2bone_visible_mat, propagate_invisible
+from gen_dataset import get_tpl_edges, get_geo_edges_bounded
+from mst_generate import getInitId
 from run_skinning import post_filter
 from models.GCN import JOINTNET_MASKNET_MEANSHIFT as JOINTNET
 from models.ROOT_GCN import ROOTNET
@@ -26,12 +29,28 @@ from models.SKINNING import SKINNET
 
 
 class RigPredictor:
-    def __init__(self, device='cuda:0', downsample_skinning=True):
+    def __init__(self, device='cuda:0', downsample_skinning=True, cache_folder=None, cache_size=4 * 1024 ** 3,
+                 torch_clustering=False, skin_transfer='nearest', vox_dim=88):
         self.device = torch.device(device if torch.cuda.is_available() else 'cpu')
         self.downsample_skinning = downsample_skinning
+        # cluster joints in float32 on self.device instead of float64 numpy on cpu
+        self.torch_clustering = torch_clustering
+        # how skinning weights are transferred to the original mesh, 'nearest' or 'barycentric'
+        self.skin_transfer = skin_transfer
+        # resolution of the voxel grid used for inside/outside checks
+        self.vox_dim = vox_dim
+        # optional persistent cache of preprocessing results, so re-rigging the same mesh skips to inference
+        self.cache = PreprocessCache(cache_folder, cache_size) if cache_folder is not None else None
 
         self._load_models()
 
+    def __getstate__(self):
+        # copies sent to the geometry worker processes of RigPipeline do not carry the networks
+        state = self.__dict__.copy()
+        for k in ['jointNet', 'rootNet', 'boneNet', 'skinNet']:
+            state.pop(k, None)
+        return state
+
     def _load_models(self):
         # Joint prediction network
         self.jointNet = JOINTNET().to(self.device)
@@ -58,52 +77,263 @@ class RigPredictor:
         self.skinNet.eval()
 
     def predict(self, input_folder, model_id, bandwidth=None, threshold=None):
+        return self.predict_many([(input_folder, model_id)], bandwidth=bandwidth, threshold=threshold)[0]
+
+    def predict_many(self, inputs, bandwidth=None, threshold=None, batch_size=8):
+        """
+        Rig several meshes. Each network runs once per group of batch_size meshes, with the meshes collated
+        into one pytorch-geometric batch. Geometry processing is still done per mesh.
+        :param inputs: list of (input_folder, model_id)
+        :param bandwidth: bandwidth for meanshift clustering
+        :param threshold: density threshold to filter out shifted points
+        :param batch_size: number of meshes per network batch
+        :return: list of predicted rigs in the same order as inputs
+        """
         bandwidth = bandwidth or 0.045
         threshold = threshold or 0.75e-5
-
+        pred_rigs = []
+        for b in range(0, len(inputs), batch_size):
+            items = [self.prepare_single_data(input_folder, model_id) for input_folder, model_id in inputs[b:b + batch_size]]
+            print("predicting joints")
+            self.predict_joints_many(items, threshold, bandwidth)
+            print("predicting connectivity")
+            self.predict_skeleton_many(items)
+            print("predicting skinning")
+            self.predict_skinning_many(items)
+            for item in items:
+                pred_rigs.append(self.save_single_result(item))
+        return pred_rigs
+
+    def prepare_single_data(self, input_folder, model_id):
+        """
+        remesh (if needed) and preprocess one mesh, or load the preprocessing results from cache
+        :return: dict holding the state of this mesh through the pipeline
+        """
         # create data used for inferece
         print("creating data for model ID {:s}".format(model_id))
-        self.mesh_filename = os.path.join(input_folder, '{:s}_remesh.obj'.format(model_id))
-        if not os.path.exists(self.mesh_filename):
-            mesh_ori_filename = os.path.join(input_folder, '{:s}_ori.obj'.format(model_id))
-            mesh_ori = o3d.io.read_triangle_mesh(mesh_ori_filename)
-            if len(np.asarray(mesh_ori.vertices)) == 0:
-                print(f"Please name your input model as {model_id}_ori.obj")
-                exit()
-            mesh_remesh = mesh_ori.simplify_quadric_decimation(4000)  # adjust vertices between 1K - 5K
-            o3d.io.write_triangle_mesh(self.mesh_filename, mesh_remesh)
-
-        data, vox, surface_geodesic, translation_normalize, scale_normalize = self.create_single_data(self.mesh_filename)
-        data.to(self.device)
-
-        print("predicting joints")
-        data = self.predict_joints(data, vox, self.jointNet, threshold, bandwidth=bandwidth,
-                              mesh_filename=self.mesh_filename.replace("_remesh.obj", "_normalized.obj"))
-        data.to(self.device)
-        print("predicting connectivity")
-        pred_skeleton = self.predict_skeleton(data, vox, self.rootNet, self.boneNet,
-                                         mesh_filename=self.mesh_filename.replace("_remesh.obj", "_normalized.obj"))
-        print("predicting skinning")
-        pred_rig = self.predict_skinning(data, pred_skeleton, self.skinNet, surface_geodesic,
-                                    self.mesh_filename.replace("_remesh.obj", "_normalized.obj"),
-                                    subsampling=self.downsample_skinning)
-
+        # the mesh filename is kept per item, so several meshes can be processed at the same time
+        mesh_filename = os.path.join(input_folder, '{:s}_remesh.obj'.format(model_id))
+        mesh_ori_filename = os.path.join(input_folder, '{:s}_ori.obj'.format(model_id))
+        item = {'input_folder': input_folder, 'model_id': model_id, 'mesh_filename': mesh_filename,
+                'cache_key': None, 'artefacts': None, 'surface_graph': None}
+        if self.cache is not None:
+            # the cache is keyed by the original mesh. An existing remeshed file is assumed to be derived from it.
+            key_filename = mesh_ori_filename if os.path.exists(mesh_ori_filename) else mesh_filename
+            item['cache_key'] = self.cache.make_key(key_filename, remesh=4000, vox_dim=self.vox_dim,
+                                                    geo_radius=0.06)
+            item['artefacts'] = self.cache.load(item['cache_key'])
+
+        if item['artefacts'] is not None:
+            print("     loading preprocessed data from cache.")
+            data, vox, translation_normalize, scale_normalize = self.load_single_data(item['artefacts'], mesh_filename)
+            # the geodesic matrix is read from the cache again by prepare_skinning, so the V*V matrix is not carried
+            # with the item between stages
+            item['artefacts'] = None
+        else:
+            if not os.path.exists(mesh_filename):
+                mesh_ori = o3d.io.read_triangle_mesh(mesh_ori_filename)
+                if len(np.asarray(mesh_ori.vertices)) == 0:
+                    raise ValueError(f"Please name your input model as {model_id}_ori.obj")
+                mesh_remesh = mesh_ori.simplify_quadric_decimation(4000)  # adjust vertices between 1K - 5K
+                o3d.io.write_triangle_mesh(mesh_filename, mesh_remesh)
+
+            # only the graph of surface samples is kept from the normalized mesh, it is all the geodesic matrix needs
+            data, vox, _, item['surface_graph'], translation_normalize, scale_normalize = \
+                self.create_single_data(mesh_filename)
+            if self.cache is not None:
+                item['artefacts'] = self.dump_single_data(data, vox, translation_normalize, scale_normalize,
+                                                          mesh_filename)
+        item.update({'data': data, 'vox': vox, 'translation_normalize': translation_normalize,
+                     'scale_normalize': scale_normalize})
+        return item
+
+    def save_single_result(self, item):
+        """
+        bring the predicted rig back to the original mesh and save it next to the input
+        """
+        mesh_filename = item['mesh_filename']
+        pred_rig = item['pred_rig']
         # here we reverse the normalization to the original scale and position
-        pred_rig.normalize(scale_normalize, -translation_normalize)
+        pred_rig.normalize(item['scale_normalize'], -item['translation_normalize'])
 
         print("Saving result")
         if True:
             # here we use original mesh tesselation (without remeshing)
-            mesh_filename_ori = os.path.join(input_folder, '{:s}_ori.obj'.format(model_id))
-            pred_rig = self.tranfer_to_ori_mesh(mesh_filename_ori, self.mesh_filename, pred_rig)
+            mesh_filename_ori = os.path.join(item['input_folder'], '{:s}_ori.obj'.format(item['model_id']))
+            pred_rig = self.tranfer_to_ori_mesh(mesh_filename_ori, mesh_filename, pred_rig,
+                                                interpolation=self.skin_transfer)
             pred_rig.save(mesh_filename_ori.replace('.obj', '_rig.txt'))
         else:
             # here we use remeshed mesh
-            pred_rig.save(self.mesh_filename.replace('.obj', '_rig.txt'))
+            pred_rig.save(mesh_filename.replace('.obj', '_rig.txt'))
         print("Done!")
-
         return pred_rig
 
+    def prepare_skinning(self, item):
+        """
+        compute the surface geodesic matrix (or load it from cache) and the input of skinning network for one mesh.
+        Loss mask, ids of the nearest bones per vertex and bone names are stored as item['skin_info'].
+        """
+        # the full geodesic matrix is only needed by skinning, geodesic edges are built from a bounded query on the
+        # same surface graph
+        surface_geodesic = None
+        if item['surface_graph'] is None and item['cache_key'] is not None:
+            artefacts = self.cache.load(item['cache_key'])
+            if artefacts is not None:
+                surface_geodesic = artefacts['surface_geodesic'].astype(np.float64)
+        if surface_geodesic is None:
+            print("     calculating surface geodesic matrix.")
+            if item['surface_graph'] is not None:
+                surface_geodesic = calc_surface_geodesic(None, surface_graph=item.pop('surface_graph'))
+            else:
+                # cache entry evicted since preprocessing
+                mesh = o3d.io.read_triangle_mesh(item['mesh_filename'])
+                mesh.compute_vertex_normals()
+                surface_geodesic = calc_surface_geodesic(mesh)
+            if item['artefacts'] is not None:
+                item['artefacts']['surface_geodesic'] = surface_geodesic.astype(np.float16)
+                self.cache.save(item['cache_key'], item.pop('artefacts'))
+        item['skin_info'] = self.create_skin_input(item['data'], item['pred_skel'], surface_geodesic,
+                                                   item['mesh_filename'].replace("_remesh.obj", "_normalized.obj"),
+                                                   subsampling=self.downsample_skinning)
+
+    def collate(self, data_list):
+        """
+        collate several meshes into one batch. Edge indices are shifted by the number of vertices,
+        and pairs by the number of joints, of the preceding meshes.
+        :param data_list: list of wrapped data of single meshes
+        :return: wrapped batch on self.device
+        """
+        num_v = [len(d.pos) for d in data_list]
+        v_offset = np.concatenate(([0], np.cumsum(num_v)[:-1]))
+        batch = Data(x=torch.cat([d.x for d in data_list], dim=0), pos=torch.cat([d.pos for d in data_list], dim=0),
+                     tpl_edge_index=torch.cat([d.tpl_edge_index + int(o) for d, o in zip(data_list, v_offset)], dim=1),
+                     geo_edge_index=torch.cat([d.geo_edge_index + int(o) for d, o in zip(data_list, v_offset)], dim=1),
+                     batch=torch.cat([torch.full((n,), i, dtype=torch.long) for i, n in enumerate(num_v)]))
+        if getattr(data_list[0], 'joints', None) is not None:
+            num_j = [len(d.joints) for d in data_list]
+            j_offset = np.concatenate(([0], np.cumsum(num_j)[:-1]))
+            batch.joints = torch.cat([d.joints for d in data_list], dim=0)
+            batch.joints_batch = torch.cat([torch.full((n,), i, dtype=torch.long) for i, n in enumerate(num_j)])
+            batch.pairs = torch.cat([d.pairs + int(o) for d, o in zip(data_list, j_offset)], dim=0)
+            batch.pair_attr = torch.cat([d.pair_attr for d in data_list], dim=0)
+            batch.pairs_batch = torch.cat([torch.full((len(d.pairs),), i, dtype=torch.long)
+                                           for i, d in enumerate(data_list)])
+        if getattr(data_list[0], 'skin_input', None) is not None:
+            batch.skin_input = torch.cat([d.skin_input for d in data_list], dim=0)
+        return batch.to(self.device)
+
+    def predict_joints_many(self, items, threshold, bandwidth=None):
+        """
+        batched version of predict_joints. Predicted joints and pairs are added to the data of each item.
+        """
+        if self.torch_clustering:
+            # cluster the whole batch on the device of the network
+            y_pred, attn_pred, batch, bandwidth_pred = self.joint_forward(items)
+            pred_joints = cluster_joints_batch(y_pred, attn_pred, batch, [item['vox'] for item in items], threshold,
+                                               bandwidth or bandwidth_pred.item())
+            for item, pred_joints_i in zip(items, pred_joints):
+                _, item['pair_outside'] = self.add_joint_data(item['data'], flip(pred_joints_i)[0], item['vox'])
+            return
+        self.run_joint_net(items)
+        for item in items:
+            self.extract_joints(item, threshold, bandwidth)
+
+    def joint_forward(self, items):
+        """
+        joint prediction network on a batch of meshes
+        :return: shifted vertices, attention, mesh index of each vertex, and predicted bandwidth, on self.device
+        """
+        input_batch = self.collate([item['data'] for item in items])
+        with torch.no_grad():
+            data_displacement, _, attn_pred, bandwidth_pred = self.jointNet(input_batch)
+        return data_displacement + input_batch.pos, attn_pred, input_batch.batch, bandwidth_pred
+
+    def run_joint_net(self, items):
+        """
+        run joint prediction network on a batch of meshes. Shifted vertices and attention are stored per item,
+        kept on self.device if joints are clustered there.
+        """
+        y_pred, attn_pred, batch, bandwidth_pred = self.joint_forward(items)
+        if not self.torch_clustering:
+            y_pred, attn_pred, batch = y_pred.data.cpu().numpy(), attn_pred.data.cpu().numpy(), batch.data.cpu().numpy()
+        for i, item in enumerate(items):
+            item['y_pred'] = y_pred[batch == i]
+            item['attn_pred'] = attn_pred[batch == i]
+            item['bandwidth_pred'] = bandwidth_pred.item()
+
+    def extract_joints(self, item, threshold, bandwidth=None):
+        """
+        cluster joints from the output of run_joint_net, and add joints and pairs to the data of the item.
+        The number of bone samples outside the mesh per pair is stored as item['pair_outside'].
+        """
+        if bandwidth is None:
+            bandwidth = item['bandwidth_pred']
+        if self.torch_clustering:
+            pred_joints = cluster_joints_torch(item.pop('y_pred'), item.pop('attn_pred'), item['vox'], threshold,
+                                               bandwidth)
+            pred_joints, _ = flip(pred_joints)
+        else:
+            pred_joints = self.cluster_joints(item.pop('y_pred'), item.pop('attn_pred'), item['vox'], threshold,
+                                              bandwidth)
+        _, item['pair_outside'] = self.add_joint_data(item['data'], pred_joints, item['vox'])
+
+    def predict_skeleton_many(self, items):
+        """
+        batched version of predict_skeleton. The predicted skeleton is stored as item['pred_skel'].
+        """
+        self.run_skeleton_net(items)
+        for item in items:
+            item['pred_skel'] = self.build_skeleton(item['data'], item['vox'], item.pop('root_id'),
+                                                    item.pop('connect_prob'), item.pop('pair_outside'))
+
+    def run_skeleton_net(self, items):
+        """
+        run root and bone prediction networks on a batch of meshes. Root id and pair-wise connectivity
+        probability are stored per item.
+        """
+        input_batch = self.collate([item['data'] for item in items])
+        with torch.no_grad():
+            root_prob, _ = self.rootNet(input_batch, shuffle=False)
+            root_prob = torch.sigmoid(root_prob).data.cpu().numpy().squeeze(1)
+            connect_prob, _ = self.boneNet(input_batch, permute_joints=False)
+            connect_prob = torch.sigmoid(connect_prob).data.cpu().numpy().squeeze(1)
+        joints_batch = input_batch.joints_batch.data.cpu().numpy()
+        pairs_batch = input_batch.pairs_batch.data.cpu().numpy()
+        for i, item in enumerate(items):
+            item['root_id'] = np.argmax(root_prob[joints_batch == i])
+            item['connect_prob'] = connect_prob[pairs_batch == i]
+
+    def predict_skinning_many(self, items):
+        """
+        batched version of predict_skinning. The predicted rig is stored as item['pred_rig'].
+        """
+        for item in items:
+            self.prepare_skinning(item)
+        self.run_skin_net(items)
+        for item in items:
+            self.finish_skinning(item)
+
+    def run_skin_net(self, items):
+        """
+        run skinning network on a batch of meshes prepared by prepare_skinning. Softmax output is stored per item.
+        """
+        input_batch = self.collate([item['data'] for item in items])
+        with torch.no_grad():
+            skin_pred = self.skinNet(input_batch)
+            skin_pred = torch.softmax(skin_pred, dim=1).data.cpu().numpy()
+        batch = input_batch.batch.data.cpu().numpy()
+        for i, item in enumerate(items):
+            item['skin_pred'] = skin_pred[batch == i]
+
+    def finish_skinning(self, item):
+        """
+        turn the skinning network output of one mesh into the predicted rig, stored as item['pred_rig']
+        """
+        loss_mask, skin_nn, bone_names = item.pop('skin_info')
+        item['pred_rig'] = self.assemble_skinning(item['data'], item['pred_skel'], item.pop('skin_pred'),
+                                                  loss_mask, skin_nn, bone_names)
+
     def normalize_obj(self, mesh_v):
         dims = [max(mesh_v[:, 0]) - min(mesh_v[:, 0]),
                 max(mesh_v[:, 1]) - min(mesh_v[:, 1]),
@@ -121,7 +351,8 @@ class RigPredictor:
         """
         create input data for the network. The data is wrapped by Data structure in pytorch-geometric library
         :param mesh_filaname: name of the input mesh
-        :return: wrapped data, voxelized mesh, and geodesic distance matrix of all vertices
+        :return: wrapped data, voxelized mesh, normalized mesh (open3d) with vertex normals, and the graph of surface
+                 samples (see build_surface_graph), reused for the geodesic matrix of skinning
         """
         mesh = o3d.io.read_triangle_mesh(mesh_filaname)
         mesh.compute_vertex_normals()
@@ -132,7 +363,7 @@ class RigPredictor:
         mesh_v, translation_normalize, scale_normalize = self.normalize_obj(mesh_v)
         mesh_normalized = o3d.geometry.TriangleMesh(vertices=o3d.utility.Vector3dVector(mesh_v),
                                                     triangles=o3d.utility.Vector3iVector(mesh_f))
-        o3d.io.write_triangle_mesh(self.mesh_filename.replace("_remesh.obj", "_normalized.obj"), mesh_normalized)
+        o3d.io.write_triangle_mesh(mesh_filaname.replace("_remesh.obj", "_normalized.obj"), mesh_normalized)
 
         # vertices
         v = np.concatenate((mesh_v, mesh_vn), axis=1)
@@ -144,13 +375,11 @@ class RigPredictor:
         tpl_e = torch.from_numpy(tpl_e).long()
         tpl_e, _ = add_self_loops(tpl_e, num_nodes=v.size(0))
 
-        # surface geodesic distance matrix
-        print("     calculating surface geodesic matrix.")
-        surface_geodesic = calc_surface_geodesic(mesh)
-
         # geodesic edges
         print("     gathering geodesic edges.")
-        geo_e = get_geo_edges(surface_geodesic, mesh_v).T
+        surface_graph = build_surface_graph(mesh)
+        geodesic_ball = calc_surface_geodesic_bounded(mesh, limit=0.06, surface_graph=surface_graph)
+        geo_e = get_geo_edges_bounded(geodesic_ball, mesh_v).T
         geo_e = torch.from_numpy(geo_e).long()
         geo_e, _ = add_self_loops(geo_e, num_nodes=v.size(0))
 
@@ -158,19 +387,49 @@ class RigPredictor:
         batch = torch.zeros(len(v), dtype=torch.long)
 
         # voxel
-        if not os.path.exists(mesh_filaname.replace('_remesh.obj', '_normalized.binvox')):
-            if platform == "linux" or platform == "linux2":
-                os.system("./binvox -d 88 -pb " + mesh_filaname.replace("_remesh.obj", "_normalized.obj"))
-            elif platform == "win32":
-                os.system("binvox.exe -d 88 " + mesh_filaname.replace("_remesh.obj", "_normalized.obj"))
-            else:
-                raise Exception('Sorry, we currently only support windows and linux.')
-
-        with open(mesh_filaname.replace('_remesh.obj', '_normalized.binvox'), 'rb') as fvox:
-            vox = binvox_rw.read_as_3d_array(fvox)
+        vox = voxelize(mesh_v, mesh_f, dim=self.vox_dim)
 
         data = Data(x=v[:, 3:6], pos=v[:, 0:3], tpl_edge_index=tpl_e, geo_edge_index=geo_e, batch=batch)
-        return data, vox, surface_geodesic, translation_normalize, scale_normalize
+        return data, vox, mesh, surface_graph, translation_normalize, scale_normalize
+
+    def dump_single_data(self, data, vox, translation_normalize, scale_normalize, mesh_filename):
+        """
+        collect preprocessing results as numpy arrays to be stored in the cache
+        """
+        mesh_remesh = o3d.io.read_triangle_mesh(mesh_filename)
+        artefacts = {'x': data.x.numpy(), 'pos': data.pos.numpy(),
+                     'tpl_edge_index': data.tpl_edge_index.numpy(), 'geo_edge_index': data.geo_edge_index.numpy(),
+                     'translation_normalize': translation_normalize, 'scale_normalize': np.array(scale_normalize),
+                     'remesh_v': np.asarray(mesh_remesh.vertices), 'remesh_f': np.asarray(mesh_remesh.triangles)}
+        artefacts.update(pack_voxels(vox))
+        return artefacts
+
+    def load_single_data(self, artefacts, mesh_filename):
+        """
+        rebuild the output of create_single_data from cached artefacts
+        :param artefacts: dict of arrays produced by dump_single_data, plus the surface geodesic matrix
+        :param mesh_filename: name of the remeshed mesh
+        :return: wrapped data, voxelized mesh, and normalization parameters. The geodesic matrix is left in the
+                 artefacts, see prepare_skinning
+        """
+        # the remeshed and normalized meshes are read again when computing skinning and transferring the rig
+        if not os.path.exists(mesh_filename):
+            mesh_remesh = o3d.geometry.TriangleMesh(vertices=o3d.utility.Vector3dVector(artefacts['remesh_v']),
+                                                    triangles=o3d.utility.Vector3iVector(artefacts['remesh_f']))
+            o3d.io.write_triangle_mesh(mesh_filename, mesh_remesh)
+        if not os.path.exists(mesh_filename.replace("_remesh.obj", "_normalized.obj")):
+            mesh_v = (artefacts['remesh_v'] - artefacts['translation_normalize']) * artefacts['scale_normalize']
+            mesh_normalized = o3d.geometry.TriangleMesh(vertices=o3d.utility.Vector3dVector(mesh_v),
+                                                        triangles=o3d.utility.Vector3iVector(artefacts['remesh_f']))
+            o3d.io.write_triangle_mesh(mesh_filename.replace("_remesh.obj", "_normalized.obj"), mesh_normalized)
+        x = torch.from_numpy(artefacts['x']).float()
+        pos = torch.from_numpy(artefacts['pos']).float()
+        tpl_e = torch.from_numpy(artefacts['tpl_edge_index']).long()
+        geo_e = torch.from_numpy(artefacts['geo_edge_index']).long()
+        batch = torch.zeros(len(pos), dtype=torch.long)
+        data = Data(x=x, pos=pos, tpl_edge_index=tpl_e, geo_edge_index=geo_e, batch=batch)
+        vox = unpack_voxels(artefacts)
+        return data, vox, artefacts['translation_normalize'], float(artefacts['scale_normalize'])
 
     def predict_joints(self, input_data, vox, joint_pred_net, threshold, bandwidth=None, mesh_filename=None):
         """
@@ -185,8 +444,23 @@ class RigPredictor:
         """
         data_displacement, _, attn_pred, bandwidth_pred = joint_pred_net(input_data)
         y_pred = data_displacement + input_data.pos
-        y_pred_np = y_pred.data.cpu().numpy()
-        attn_pred_np = attn_pred.data.cpu().numpy()
+        if bandwidth is None:
+            bandwidth = bandwidth_pred.item()
+        pred_joints = self.cluster_joints(y_pred.data.cpu().numpy(), attn_pred.data.cpu().numpy(), vox,
+                                          threshold, bandwidth)
+        input_data, _ = self.add_joint_data(input_data, pred_joints, vox)
+        return input_data
+
+    def cluster_joints(self, y_pred_np, attn_pred_np, vox, threshold, bandwidth):
+        """
+        extract joints from the shifted vertices of one mesh by meanshift clustering
+        :param y_pred_np: shifted vertices
+        :param attn_pred_np: predicted attention per vertex
+        :param vox: voxelized mesh
+        :param threshold: density threshold to filter out shifted points
+        :param bandwidth: bandwidth for meanshift clustering
+        :return: predicted joints J*3
+        """
         y_pred_np, index_inside = inside_check(y_pred_np, vox)
         attn_pred_np = attn_pred_np[index_inside, :]
         y_pred_np = y_pred_np[attn_pred_np.squeeze() > 1e-3]
@@ -198,36 +472,23 @@ class RigPredictor:
         attn_pred_np = np.tile(attn_pred_np, (2, 1))
 
         # img = draw_shifted_pts(self.mesh_filename, y_pred_np, weights=attn_pred_np)
-        if bandwidth is None:
-            bandwidth = bandwidth_pred.item()
-        y_pred_np = meanshift_cluster(y_pred_np, bandwidth, attn_pred_np, max_iter=40)
+        y_pred_np = meanshift_cluster_grid(y_pred_np, bandwidth, attn_pred_np, max_iter=40)
         # img = draw_shifted_pts(self.mesh_filename, y_pred_np, weights=attn_pred_np)
 
-        Y_dist = np.sum(((y_pred_np[np.newaxis, ...] - y_pred_np[:, np.newaxis, :]) ** 2), axis=2)
-        density = np.maximum(bandwidth ** 2 - Y_dist, np.zeros(Y_dist.shape))
-        density = np.sum(density, axis=0)
-        density_sum = np.sum(density)
-        y_pred_np = y_pred_np[density / density_sum > threshold]
-        attn_pred_np = attn_pred_np[density / density_sum > threshold][:, 0]
-        density = density[density / density_sum > threshold]
-
-        # img = draw_shifted_pts(self.mesh_filename, y_pred_np, weights=attn_pred_np)
-        pred_joints = nms_meanshift(y_pred_np, density, bandwidth)
+        pred_joints = density_nms(y_pred_np, bandwidth, threshold)
         pred_joints, _ = flip(pred_joints)
         # img = draw_shifted_pts(self.mesh_filename, pred_joints)
+        return pred_joints
 
-        # prepare and add new data members
-        pairs = list(it.combinations(range(pred_joints.shape[0]), 2))
-        pair_attr = []
-        for pr in pairs:
-            dist = np.linalg.norm(pred_joints[pr[0]] - pred_joints[pr[1]])
-            bone_samples = sample_on_bone(pred_joints[pr[0]], pred_joints[pr[1]])
-            bone_samples_inside, _ = inside_check(bone_samples, vox)
-            outside_proportion = len(bone_samples_inside) / (len(bone_samples) + 1e-10)
-            attr = np.array([dist, outside_proportion, 1])
-            pair_attr.append(attr)
-        pairs = np.array(pairs)
-        pair_attr = np.array(pair_attr)
+    def add_joint_data(self, input_data, pred_joints, vox):
+        """
+        add predicted joints and pair-wise bone representation to the wrapped data
+        :return: wrapped data, and number of bone samples outside the mesh for each pair, to be passed to
+                 build_skeleton
+        """
+        pairs, num_samples, num_inside = pair_occupancy(pred_joints, vox)
+        dist = np.linalg.norm(pred_joints[pairs[:, 0]] - pred_joints[pairs[:, 1]], axis=1)
+        pair_attr = np.stack((dist, num_inside / (num_samples + 1e-10), np.ones(len(pairs))), axis=1)
         pairs = torch.from_numpy(pairs).float()
         pair_attr = torch.from_numpy(pair_attr).float()
         pred_joints = torch.from_numpy(pred_joints).float()
@@ -239,7 +500,7 @@ class RigPredictor:
         input_data.pair_attr = pair_attr
         input_data.joints_batch = joints_batch
         input_data.pairs_batch = pairs_batch
-        return input_data
+        return input_data, num_samples - num_inside
 
     def predict_skeleton(self, input_data, vox, root_pred_net, bone_pred_net, mesh_filename):
         """
@@ -252,17 +513,29 @@ class RigPredictor:
         :return: predicted skeleton structure
         """
         root_id = getInitId(input_data, root_pred_net)
-        pred_joints = input_data.joints.data.cpu().numpy()
-
         with torch.no_grad():
             connect_prob, _ = bone_pred_net(input_data, permute_joints=False)
             connect_prob = torch.sigmoid(connect_prob)
+        return self.build_skeleton(input_data, vox, root_id, connect_prob.data.cpu().numpy().squeeze())
+
+    def build_skeleton(self, input_data, vox, root_id, connect_prob, num_outside=None):
+        """
+        build the skeleton tree from predicted root and pair-wise connectivity probability
+        :param input_data: wrapped data of one mesh with predicted joints and pairs
+        :param vox: voxelized mesh
+        :param root_id: predicted root joint id
+        :param connect_prob: connectivity probability of each pair
+        :param num_outside: number of bone samples outside the mesh for each pair, as returned by add_joint_data.
+                            Computed again from the joints if not given.
+        :return: predicted skeleton structure
+        """
+        pred_joints = input_data.joints.data.cpu().numpy()
         pair_idx = input_data.pairs.long().data.cpu().numpy()
         prob_matrix = np.zeros((len(input_data.joints), len(input_data.joints)))
-        prob_matrix[pair_idx[:, 0], pair_idx[:, 1]] = connect_prob.data.cpu().numpy().squeeze()
+        prob_matrix[pair_idx[:, 0], pair_idx[:, 1]] = connect_prob
         prob_matrix = prob_matrix + prob_matrix.transpose()
         cost_matrix = -np.log(prob_matrix + 1e-10)
-        cost_matrix = increase_cost_for_outside_bone(cost_matrix, pred_joints, vox)
+        cost_matrix = increase_cost_for_outside_bone(cost_matrix, pred_joints, vox, num_outside)
 
         pred_skel = Info()
         parent, key, root_id = primMST_symmetry(cost_matrix, root_id, pred_joints)
@@ -287,20 +560,20 @@ class RigPredictor:
         :param bones: B*6 numpy array where each row stores the starting and ending joint position of a bone
         :param mesh_v: V*3 mesh vertices
         :param surface_geodesic: geodesic distance matrix of all vertices
-        :param self.mesh_filename: mesh filename
+        :param mesh_filename: mesh filename
         :return: an approaximate volumetric geodesic distance matrix V*B, were (v,b) is the distance from vertex v to bone b
         """
 
         if subsampling:
-            mesh0 = o3d.io.read_triangle_mesh(self.mesh_filename)
+            mesh0 = o3d.io.read_triangle_mesh(mesh_filename)
             mesh0 = mesh0.simplify_quadric_decimation(3000)
-            o3d.io.write_triangle_mesh(self.mesh_filename.replace(".obj", "_simplified.obj"), mesh0)
-            mesh_trimesh = trimesh.load(self.mesh_filename.replace(".obj", "_simplified.obj"))
+            o3d.io.write_triangle_mesh(mesh_filename.replace(".obj", "_simplified.obj"), mesh0)
+            mesh_trimesh = trimesh.load(mesh_filename.replace(".obj", "_simplified.obj"))
             subsamples_ids = np.random.choice(len(mesh_v), np.min((len(mesh_v), 1500)), replace=False)
             subsamples = mesh_v[subsamples_ids, :]
             surface_geodesic = surface_geodesic[subsamples_ids, :][:, subsamples_ids]
         else:
-            mesh_trimesh = trimesh.load(self.mesh_filename)
+            mesh_trimesh = trimesh.load(mesh_filename)
             subsamples = mesh_v
         origins, ends, pts_bone_dist = pts2line(subsamples, bones)
         pts_bone_visibility = calc_pts2bone_visible_mat(mesh_trimesh, origins, ends)
@@ -314,26 +587,12 @@ class RigPredictor:
             threshold_b = np.percentile(pts_bone_dist[visible_pts, b], 15)
             pts_bone_visibility[pts_bone_dist[:, b] > 1.3 * threshold_b, b] = False
 
-        visible_matrix = np.zeros(pts_bone_visibility.shape)
-        visible_matrix[np.where(pts_bone_visibility == 1)] = pts_bone_dist[np.where(pts_bone_visibility == 1)]
-        for c in range(visible_matrix.shape[1]):
-            unvisible_pts = np.argwhere(pts_bone_visibility[:, c] == 0).squeeze(1)
-            visible_pts = np.argwhere(pts_bone_visibility[:, c] == 1).squeeze(1)
-            if len(visible_pts) == 0:
-                visible_matrix[:, c] = pts_bone_dist[:, c]
-                continue
-            for r in unvisible_pts:
-                dist1 = np.min(surface_geodesic[r, visible_pts])
-                nn_visible = visible_pts[np.argmin(surface_geodesic[r, visible_pts])]
-                if np.isinf(dist1):
-                    visible_matrix[r, c] = 8.0 + pts_bone_dist[r, c]
-                else:
-                    visible_matrix[r, c] = dist1 + visible_matrix[nn_visible, c]
+        visible_matrix = propagate_invisible(pts_bone_dist, pts_bone_visibility, surface_geodesic)
         if subsampling:
             nn_dist = np.sum((mesh_v[:, np.newaxis, :] - subsamples[np.newaxis, ...]) ** 2, axis=2)
             nn_ind = np.argmin(nn_dist, axis=1)
             visible_matrix = visible_matrix[nn_ind, :]
-            os.remove(self.mesh_filename.replace(".obj", "_simplified.obj"))
+            os.remove(mesh_filename.replace(".obj", "_simplified.obj"))
         return visible_matrix
 
     def predict_skinning(self, input_data, pred_skel, skin_pred_net, surface_geodesic, mesh_filename, subsampling=False):
@@ -343,59 +602,59 @@ class RigPredictor:
         :param pred_skel: predicted skeleton
         :param skin_pred_net: network to predict skinning weights
         :param surface_geodesic: geodesic distance matrix of all vertices
-        :param self.mesh_filename: mesh filename
+        :param mesh_filename: normalized mesh filename
         :return: predicted rig with skinning weights information
         """
-        global device, output_folder
+        loss_mask, skin_nn, bone_names = self.create_skin_input(input_data, pred_skel, surface_geodesic, mesh_filename,
+                                                                subsampling=subsampling)
+        input_data.to(self.device)
+        skin_pred = skin_pred_net(input_data)
+        skin_pred = torch.softmax(skin_pred, dim=1)
+        skin_pred = skin_pred.data.cpu().numpy()
+        return self.assemble_skinning(input_data, pred_skel, skin_pred, loss_mask, skin_nn, bone_names)
+
+    def create_skin_input(self, input_data, pred_skel, surface_geodesic, mesh_filename, subsampling=False):
+        """
+        compute the input of skinning network and add it to the wrapped data as skin_input
+        :param input_data: wrapped input data
+        :param pred_skel: predicted skeleton
+        :param surface_geodesic: geodesic distance matrix of all vertices
+        :param mesh_filename: normalized mesh filename, used for visibility between vertices and bones
+        :return: loss mask and ids of the nearest bones per vertex, and bone names
+        """
         num_nearest_bone = 5
         bones, bone_names, bone_isleaf = get_bones(pred_skel)
         mesh_v = input_data.pos.data.cpu().numpy()
         print("     calculating volumetric geodesic distance from vertices to bone. This step takes some time...")
-        geo_dist = self.calc_geodesic_matrix(bones, mesh_v, surface_geodesic, self.mesh_filename, subsampling=subsampling)
-        input_samples = []  # joint_pos (x, y, z), (bone_id, 1/D)*5
-        loss_mask = []
-        skin_nn = []
-        for v_id in range(len(mesh_v)):
-            geo_dist_v = geo_dist[v_id]
-            bone_id_near_to_far = np.argsort(geo_dist_v)
-            this_sample = []
-            this_nn = []
-            this_mask = []
-            for i in range(num_nearest_bone):
-                if i >= len(bones):
-                    this_sample += bones[bone_id_near_to_far[0]].tolist()
-                    this_sample.append(1.0 / (geo_dist_v[bone_id_near_to_far[0]] + 1e-10))
-                    this_sample.append(bone_isleaf[bone_id_near_to_far[0]])
-                    this_nn.append(0)
-                    this_mask.append(0)
-                else:
-                    skel_bone_id = bone_id_near_to_far[i]
-                    this_sample += bones[skel_bone_id].tolist()
-                    this_sample.append(1.0 / (geo_dist_v[skel_bone_id] + 1e-10))
-                    this_sample.append(bone_isleaf[skel_bone_id])
-                    this_nn.append(skel_bone_id)
-                    this_mask.append(1)
-            input_samples.append(np.array(this_sample)[np.newaxis, :])
-            skin_nn.append(np.array(this_nn)[np.newaxis, :])
-            loss_mask.append(np.array(this_mask)[np.newaxis, :])
-
-        skin_input = np.concatenate(input_samples, axis=0)
-        loss_mask = np.concatenate(loss_mask, axis=0)
-        skin_nn = np.concatenate(skin_nn, axis=0)
+        geo_dist = self.calc_geodesic_matrix(bones, mesh_v, surface_geodesic, mesh_filename, subsampling=subsampling)
+        # input per vertex: (bone start (x, y, z), bone end (x, y, z), 1/D, is leaf) of the 5 nearest bones.
+        # Full argsort instead of argpartition keeps the order of bones at the same distance (e.g. sharing a joint).
+        bone_id_near_to_far = np.argsort(geo_dist, axis=1)
+        nn_valid = np.arange(num_nearest_bone) < len(bones)  # fewer bones than nn are padded by the nearest one
+        skin_nn = bone_id_near_to_far[:, np.where(nn_valid, np.arange(num_nearest_bone), 0)]
+        inv_dist = 1.0 / (np.take_along_axis(geo_dist, skin_nn, axis=1) + 1e-10)
+        skin_input = np.concatenate((bones[skin_nn], inv_dist[..., np.newaxis],
+                                     np.asarray(bone_isleaf, dtype=float)[skin_nn][..., np.newaxis]), axis=2)
+        skin_input = skin_input.reshape(len(mesh_v), -1)
+        skin_nn = skin_nn * nn_valid[np.newaxis, :]
+        loss_mask = np.repeat(nn_valid[np.newaxis, :].astype(int), len(mesh_v), axis=0)
         skin_input = torch.from_numpy(skin_input).float()
         input_data.skin_input = skin_input
-        input_data.to(self.device)
+        return loss_mask, skin_nn, bone_names
 
-        skin_pred = skin_pred_net(input_data)
-        skin_pred = torch.softmax(skin_pred, dim=1)
-        skin_pred = skin_pred.data.cpu().numpy()
+    def assemble_skinning(self, input_data, pred_skel, skin_pred, loss_mask, skin_nn, bone_names):
+        """
+        expand the network output to all bones, filter it and attach it to the skeleton
+        :param skin_pred: softmax output of skinning network, V*K
+        :return: predicted rig with skinning weights information
+        """
+        num_nearest_bone = 5
         skin_pred = skin_pred * loss_mask
 
         skin_nn = skin_nn[:, 0:num_nearest_bone]
         skin_pred_full = np.zeros((len(skin_pred), len(bone_names)))
-        for v in range(len(skin_pred)):
-            for nn_id in range(len(skin_nn[v, :])):
-                skin_pred_full[v, skin_nn[v, nn_id]] = skin_pred[v, nn_id]
+        # padded nearest bones point to bone 0 with zero weight, written last as in a per-entry loop
+        np.put_along_axis(skin_pred_full, skin_nn, skin_pred, axis=1)
         print("     filtering skinning prediction")
         tpl_e = input_data.tpl_edge_index.data.cpu().numpy()
         skin_pred_full = post_filter(skin_pred_full, tpl_e, num_ring=1)
@@ -404,13 +663,17 @@ class RigPredictor:
         skel_res = assemble_skel_skin(pred_skel, skin_pred_full)
         return skel_res
 
-    def tranfer_to_ori_mesh(self, filename_ori, filename_remesh, pred_rig):
+    def tranfer_to_ori_mesh(self, filename_ori, filename_remesh, pred_rig, interpolation='nearest', chunk_size=65536):
         """
         convert the predicted rig of remeshed model to the rig of the original model.
-        Just assign skinning weight based on nearest neighbor
+        Skinning weights are taken from the nearest remeshed vertex, found by a kd-tree, or interpolated at the
+        closest point on the triangles around it. Original vertices are processed in chunks, so no distance matrix
+        between the two meshes is built.
         :param filename_ori: original mesh filename
         :param filename_remesh: remeshed mesh filename
         :param pred_rig: predicted rig
+        :param interpolation: 'nearest' or 'barycentric'
+        :param chunk_size: number of original vertices processed together
         :return: predicted rig for original mesh
         """
         mesh_remesh = o3d.io.read_triangle_mesh(filename_remesh)
@@ -419,20 +682,57 @@ class RigPredictor:
 
         vert_remesh = np.asarray(mesh_remesh.vertices)
         vert_ori = np.asarray(mesh_ori.vertices)
-
-        vertice_distance = np.sqrt(np.sum((vert_ori[np.newaxis, ...] - vert_remesh[:, np.newaxis, :]) ** 2, axis=2))
-        vertice_raw_id = np.argmin(vertice_distance,
-                                   axis=0)  # nearest vertex id on the fixed mesh for each vertex on the remeshed mesh
+        tree = cKDTree(vert_remesh)
 
         tranfer_rig.root = pred_rig.root
         tranfer_rig.joint_pos = pred_rig.joint_pos
-        new_skin = []
-        for v in range(len(vert_ori)):
-            skin_v = [v]
-            v_nn = vertice_raw_id[v]
-            skin_v += pred_rig.joint_skin[v_nn][1:]
-            new_skin.append(skin_v)
-        tranfer_rig.joint_skin = new_skin
+        if interpolation == 'nearest':
+            new_skin = []
+            for c_start in range(0, len(vert_ori), chunk_size):
+                # nearest vertex id on the remeshed mesh for each vertex on the original mesh
+                _, vertice_raw_id = tree.query(vert_ori[c_start:c_start + chunk_size])
+                for v, v_nn in enumerate(vertice_raw_id):
+                    new_skin.append([c_start + v] + pred_rig.joint_skin[v_nn][1:])
+            tranfer_rig.joint_skin = new_skin
+            return tranfer_rig
+
+        # dense weights of the remeshed vertices
+        vert_ids, skin, joint_names = pred_rig.get_skin_arrays()
+        weights_remesh = np.zeros((len(vert_remesh), len(joint_names)))
+        weights_remesh[vert_ids] = skin
+        # faces around each vertex, padded by repeating the first one. Rows of vertices without faces are not used.
+        faces = np.asarray(mesh_remesh.triangles)
+        vert_face = np.repeat(np.arange(len(faces)), 3)
+        order = np.argsort(faces.reshape(-1), kind='stable')
+        valence = np.bincount(faces.reshape(-1), minlength=len(vert_remesh))
+        ring_start = np.cumsum(valence) - valence
+        ring_id = np.minimum(np.arange(valence.max())[np.newaxis, :], np.maximum(valence - 1, 0)[:, np.newaxis])
+        vert_faces = vert_face[order][np.minimum(ring_start[:, np.newaxis] + ring_id, len(order) - 1)]
+        tranfer_rig.joint_skin = []
+        for c_start in range(0, len(vert_ori), chunk_size):
+            pts = vert_ori[c_start:c_start + chunk_size]
+            _, vertice_raw_id = tree.query(pts)
+            # nearest vertices without faces (valence 0) have no triangles to interpolate on, their weights are kept
+            weights = weights_remesh[vertice_raw_id]
+            on_faces = valence[vertice_raw_id] > 0
+            if np.any(on_faces):
+                pts_f = pts[on_faces]
+                # closest point on the triangles around the nearest vertex
+                cand_faces = vert_faces[vertice_raw_id[on_faces]]
+                cand_tris = vert_remesh[faces[cand_faces.reshape(-1)]]
+                cand_pts = np.repeat(pts_f, cand_faces.shape[1], axis=0)
+                closest = trimesh.triangles.closest_point(cand_tris, cand_pts)
+                best = np.argmin(np.sum((closest - cand_pts) ** 2, axis=1).reshape(cand_faces.shape), axis=1)
+                best_face = cand_faces[np.arange(len(pts_f)), best]
+                best_pts = closest.reshape(len(pts_f), -1, 3)[np.arange(len(pts_f)), best]
+                bary = trimesh.triangles.points_to_barycentric(vert_remesh[faces[best_face]], best_pts)
+                bary = np.clip(bary, 0.0, 1.0)
+                bary = bary / (bary.sum(axis=1, keepdims=True) + 1e-10)
+                weights[on_faces] = np.einsum('nk,nkj->nj', bary, weights_remesh[faces[best_face]])
+            weights = weights / (weights.sum(axis=1, keepdims=True) + 1e-10)
+            # skin lines are written per chunk, so no weight matrix over all original vertices is built
+            tranfer_rig.set_skin_arrays(c_start + np.arange(len(pts)), weights, joint_names, min_weight=1e-5,
+                                        append=True)
         return tranfer_rig
 
 
@@ -0,0 +1,152 @@
+#-------------------------------------------------------------------------------
+# Name:        rig_server.py
+# Purpose:     local rigging daemon keeping the networks loaded between jobs
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import sys
+sys.path.append("./")
+import os
+import json
+import time
+import uuid
+import shutil
+import argparse
+import tempfile
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from rig_predictor import RigPredictor
+from rig_pipeline import RigPipeline
+
+# Endpoints:
+#     POST /rig       body is either the .obj file itself, or json {"mesh_path": "/path/to/mesh.obj"}.
+#                     Responds with the rig in the text format of Info.save. Per-stage timing (seconds) is in the
+#                     X-Rig-Timing header as json. Optional query parameter: keep=1 keeps the job folder.
+#     GET  /status    json with queue depth in front of each stage, finished/failed jobs and accumulated stage time.
+# Example:
+#     curl --data-binary @quick_start/17872_ori.obj http://127.0.0.1:8765/rig
+
+
+class RigServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, pipeline, work_folder):
+        super(RigServer, self).__init__(address, RigRequestHandler)
+        self.pipeline = pipeline
+        self.work_folder = work_folder
+        self.start_time = time.time()
+        self.num_pending = 0
+        self.lock = threading.Lock()
+
+    def rig(self, mesh_bytes=None, mesh_path=None, keep=False):
+        """
+        rig one mesh with the resident pipeline. Each job gets its own folder, since the predictor writes
+        the remeshed, normalized and voxelized meshes next to the input.
+        :return: rig text, per-stage timing and error message (None if succeeded)
+        """
+        job_folder = os.path.join(self.work_folder, uuid.uuid4().hex)
+        os.makedirs(job_folder)
+        mesh_filename = os.path.join(job_folder, 'model_ori.obj')
+        if mesh_path is not None:
+            shutil.copyfile(mesh_path, mesh_filename)
+        else:
+            with open(mesh_filename, 'wb') as fout:
+                fout.write(mesh_bytes)
+        with self.lock:
+            self.num_pending += 1
+        try:
+            item = self.pipeline.submit(job_folder, 'model')
+            item['done'].wait()
+        finally:
+            with self.lock:
+                self.num_pending -= 1
+        rig_text = None
+        if item['error'] is None:
+            with open(mesh_filename.replace('.obj', '_rig.txt')) as fin:
+                rig_text = fin.read()
+        if not keep:
+            shutil.rmtree(job_folder, ignore_errors=True)
+        return rig_text, item['timing'], item['error']
+
+    def status(self):
+        stats = self.pipeline.stats()
+        stats['pending'] = self.num_pending
+        stats['uptime'] = time.time() - self.start_time
+        return stats
+
+
+class RigRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if urlparse(self.path).path != '/status':
+            self.send_error(404)
+            return
+        self.reply(200, json.dumps(self.server.status()), 'application/json')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/rig':
+            self.send_error(404)
+            return
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        mesh_path = None
+        if self.headers.get('Content-Type', '').startswith('application/json'):
+            try:
+                mesh_path = json.loads(body.decode())['mesh_path']
+            except (ValueError, KeyError, TypeError):
+                self.reply(400, 'expected json {"mesh_path": ...}\n')
+                return
+            if not os.path.isfile(mesh_path):
+                self.reply(400, 'mesh not found: {:s}\n'.format(mesh_path))
+                return
+        elif len(body) == 0:
+            self.reply(400, 'empty mesh\n')
+            return
+        rig_text, timing, error = self.server.rig(mesh_bytes=body, mesh_path=mesh_path,
+                                                  keep=query.get('keep', ['0'])[0] == '1')
+        if error is not None:
+            self.reply(500, error, headers={'X-Rig-Timing': json.dumps(timing)})
+        else:
+            self.reply(200, rig_text, headers={'X-Rig-Timing': json.dumps(timing)})
+
+    def reply(self, code, text, content_type='text/plain', headers=None):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def main(args):
+    work_folder = args.work_folder or tempfile.mkdtemp(prefix='rignet_')
+    predictor = RigPredictor(device=args.device, downsample_skinning=True, cache_folder=args.cache_folder)
+    pipeline = RigPipeline(predictor, num_workers=args.num_workers, batch_size=args.batch_size)
+    pipeline.start()
+    server = RigServer((args.host, args.port), pipeline, work_folder)
+    print('rigging server listening on {:s}:{:d}, job folder {:s}'.format(args.host, args.port, work_folder))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        pipeline.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='local rigging server')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--device', type=str, default='cuda:0')
+    parser.add_argument('--num_workers', type=int, default=None, help='workers per geometry stage')
+    parser.add_argument('--batch_size', type=int, default=4, help='max number of meshes per network batch')
+    parser.add_argument('--cache_folder', type=str, default=None, help='folder of the preprocessing cache')
+    parser.add_argument('--work_folder', type=str, default=None, help='folder of job files. A temp folder by default')
+    args = parser.parse_args()
+    main(args)
@@ -16,6 +16,7 @@ import argparse
 from utils.log_utils import AverageMeter
 from utils.os_utils import isdir, mkdir_p, isfile
 from utils.io_utils import output_point_cloud_ply
+from utils.cluster_utils_torch import meanshift_cluster
 
 import torch
 import torch.backends.cudnn as cudnn
@@ -23,7 +24,7 @@ from torch_geometric.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from models.GCN import JOINTNET_MASKNET_MEANSHIFT
-from datasets.skeleton_dataset import GraphDataset
+from datasets.skeleton_dataset import GraphDataset, GraphDatasetOnDisk
 from models.supplemental_layers.pytorch_chamfer_dist import chamfer_distance_with_average
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -40,39 +41,6 @@ def save_checkpoint(state, is_best, checkpoint='checkpoint', filename='checkpoin
         shutil.copyfile(filepath, os.path.join(checkpoint, 'model_best.pth.tar'))
 
 
-def pairwise_distances(x, y):
-    #Input: x is a Nxd matrix
-    #       y is an optional Mxd matirx
-    #Output: dist is a NxM matrix where dist[i,j] is the square norm between x[i,:] and y[j,:]
-    #        if y is not given then use 'y=x'.
-    #i.e. dist[i,j] = ||x[i,:]-y[j,:]||^2
-    x_norm = (x ** 2).sum(1).view(-1, 1)
-    y_t = torch.transpose(y, 0, 1)
-    y_norm = (y ** 2).sum(1).view(1, -1)
-    dist = x_norm + y_norm - 2.0 * torch.mm(x, y_t)
-    return torch.clamp(dist, 0.0, np.inf)
-
-
-def meanshift_cluster(pts, bandwidth, weights, args):
-    """
-    meanshift written in pytorch
-    :param pts: input points
-    :param weights: weight per point during clustering
-    :return: clustered points
-    """
-    pts_steps = []
-    for i in range(args.meanshift_step):
-        Y = pairwise_distances(pts, pts)
-        K = torch.nn.functional.relu(bandwidth ** 2 - Y)
-        if weights is not None:
-            K = K * weights
-        P = torch.nn.functional.normalize(K, p=1, dim=0, eps=1e-10)
-        P = P.transpose(0, 1)
-        pts = args.step_size * (torch.matmul(P, pts) - pts) + pts
-        pts_steps.append(pts)
-    return pts_steps
-
-
 def main(args):
     global device
     lowest_loss = 1e20
@@ -115,9 +83,10 @@ def main(args):
 
     cudnn.benchmark = True
     print('    Total params: %.2fM' % (sum(p.numel() for p in model.parameters()) / 1000000.0))
-    train_loader = DataLoader(GraphDataset(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints'])
-    val_loader = DataLoader(GraphDataset(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'])
-    test_loader = DataLoader(GraphDataset(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'])
+    dataset_class = GraphDatasetOnDisk if args.on_disk else GraphDataset
+    train_loader = DataLoader(dataset_class(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints'], num_workers=args.num_workers)
+    val_loader = DataLoader(dataset_class(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'], num_workers=args.num_workers)
+    test_loader = DataLoader(dataset_class(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'], num_workers=args.num_workers)
     if args.evaluate:
         print('\nEvaluation only')
         test_loss = test(test_loader, model, args, save_result=True, best_epoch=args.start_epoch)
@@ -238,6 +207,9 @@ if __name__ == '__main__':
     parser.add_argument('--train_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/train/', type=str, help='folder of training data')
     parser.add_argument('--val_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/val/', type=str, help='folder of validation data')
     parser.add_argument('--test_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/test/', type=str, help='folder of testing data')
+    parser.add_argument('--on_disk', action='store_true',
+                        help='read the splits lazily from their binary columnar files instead of loading them in memory')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of data loading workers')
     ######################
     parser.add_argument('--jointnet_lr', default=5e-5, type=float)
     parser.add_argument('--masknet_lr', default=5e-5, type=float)
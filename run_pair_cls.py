@@ -19,7 +19,7 @@ from torch_geometric.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 
 from models.PairCls_GCN import PairCls
-from datasets.skeleton_dataset import GraphDataset
+from datasets.skeleton_dataset import GraphDataset, GraphDatasetOnDisk
 from utils.os_utils import isdir, mkdir_p, isfile
 from utils.log_utils import AverageMeter
 
@@ -71,9 +71,10 @@ def main(args):
 
     cudnn.benchmark = True
     print('    Total params: %.2fM' % (sum(p.numel() for p in model.parameters()) / 1000000.0))
-    train_loader = DataLoader(GraphDataset(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints', 'pairs'])
-    val_loader = DataLoader(GraphDataset(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints', 'pairs'])
-    test_loader = DataLoader(GraphDataset(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints', 'pairs'])
+    dataset_class = GraphDatasetOnDisk if args.on_disk else GraphDataset
+    train_loader = DataLoader(dataset_class(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints', 'pairs'], num_workers=args.num_workers)
+    val_loader = DataLoader(dataset_class(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints', 'pairs'], num_workers=args.num_workers)
+    test_loader = DataLoader(dataset_class(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints', 'pairs'], num_workers=args.num_workers)
 
     if args.evaluate:
         print('\nEvaluation only')
@@ -188,6 +189,9 @@ if __name__ == '__main__':
                         type=str, help='folder of validation data')
     parser.add_argument('--test_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/test/',
                         type=str, help='folder of testing data')
+    parser.add_argument('--on_disk', action='store_true',
+                        help='read the splits lazily from their binary columnar files instead of loading them in memory')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of data loading workers')
 
     parser.add_argument('--topk', default=0.3, type=float, help='topk ratio for ohem')
     print(parser.parse_args())
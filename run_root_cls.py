@@ -21,7 +21,7 @@ from models.ROOT_GCN import ROOTNET
 from utils.log_utils import AverageMeter
 from utils.os_utils import isdir, mkdir_p, isfile
 from torch.utils.tensorboard import SummaryWriter
-from datasets.skeleton_dataset import GraphDataset
+from datasets.skeleton_dataset import GraphDataset, GraphDatasetOnDisk
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -72,9 +72,10 @@ def main(args):
 
     cudnn.benchmark = True
     print('    Total params: %.2fM' % (sum(p.numel() for p in model.parameters()) / 1000000.0))
-    train_loader = DataLoader(GraphDataset(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints'])
-    val_loader = DataLoader(GraphDataset(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'])
-    test_loader = DataLoader(GraphDataset(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'])
+    dataset_class = GraphDatasetOnDisk if args.on_disk else GraphDataset
+    train_loader = DataLoader(dataset_class(root=args.train_folder), batch_size=args.train_batch, shuffle=True, follow_batch=['joints'], num_workers=args.num_workers)
+    val_loader = DataLoader(dataset_class(root=args.val_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'], num_workers=args.num_workers)
+    test_loader = DataLoader(dataset_class(root=args.test_folder), batch_size=args.test_batch, shuffle=False, follow_batch=['joints'], num_workers=args.num_workers)
     if args.evaluate:
         print('\nEvaluation only')
         test_loss, test_acc = test(test_loader, model)
@@ -178,6 +179,9 @@ if __name__ == '__main__':
                         type=str, help='folder of validation data')
     parser.add_argument('--test_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/test/',
                         type=str, help='folder of testing data')
+    parser.add_argument('--on_disk', action='store_true',
+                        help='read the splits lazily from their binary columnar files instead of loading them in memory')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of data loading workers')
     parser.add_argument('--pos_weight', default=10.0, type=float, help='weight for positive class')
     parser.add_argument('--topk', default=0.3, type=float, help='topk ratio for ohem')
     print(parser.parse_args())
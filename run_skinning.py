@@ -11,6 +11,7 @@ sys.path.append("./")
 import shutil
 import argparse
 import numpy as np
+from scipy.sparse import csr_matrix
 
 from utils.log_utils import AverageMeter
 from utils.os_utils import isdir, mkdir_p, isfile
@@ -23,7 +24,7 @@ from torch.utils.tensorboard import SummaryWriter
 
 import models
 from models.supplemental_layers.cross_entropy_with_probs import cross_entropy_with_probs
-from datasets.skin_dataset import SkinDataset
+from datasets.skin_dataset import SkinDataset, SkinDatasetOnDisk
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
@@ -51,32 +52,36 @@ def get_bone_names(skin_filename):
 
 
 def post_filter(skin_weights, topology_edge, num_ring=1):
-    skin_weights_new = np.zeros_like(skin_weights)
-    for v in range(len(skin_weights)):
-        adj_verts_multi_ring = []
-        current_seeds = [v]
-        for r in range(num_ring):
-            adj_verts = []
-            for seed in current_seeds:
-                adj_edges = topology_edge[:, np.argwhere(topology_edge == seed)[:, 1]]
-                adj_verts_seed = list(set(adj_edges.flatten().tolist()))
-                adj_verts_seed.remove(seed)
-                adj_verts += adj_verts_seed
-            adj_verts_multi_ring += adj_verts
-            current_seeds = adj_verts
-        adj_verts_multi_ring = list(set(adj_verts_multi_ring))
-        if v in adj_verts_multi_ring:
-            adj_verts_multi_ring.remove(v)
-        skin_weights_neighbor = [skin_weights[int(i), :][np.newaxis, :] for i in adj_verts_multi_ring]
-        skin_weights_neighbor = np.concatenate(skin_weights_neighbor, axis=0)
-        #max_bone_id = np.argmax(skin_weights[v, :])
-        #if np.sum(skin_weights_neighbor[:, max_bone_id]) < 0.17 * len(skin_weights_neighbor):
-        #    skin_weights_new[v, :] = np.mean(skin_weights_neighbor, axis=0)
-        #else:
-        #    skin_weights_new[v, :] = skin_weights[v, :]
-        skin_weights_new[v, :] = np.mean(skin_weights_neighbor, axis=0)
-
-    #skin_weights_new[skin_weights_new.sum(axis=1) == 0, :] = skin_weights[skin_weights_new.sum(axis=1) == 0, :]
+    """
+    smooth skinning weights by averaging them over the k-ring neighbors of each vertex (the vertex excluded)
+    :param skin_weights: V*B skinning weights
+    :param topology_edge: 2*E topology edges
+    :param num_ring: size of the neighborhood in rings
+    :return: smoothed skinning weights
+    """
+    num_v = len(skin_weights)
+    topology_edge = np.asarray(topology_edge).astype(int)
+    # symmetric binary adjacency without self loops
+    edges = topology_edge[:, topology_edge[0] != topology_edge[1]]
+    adj = csr_matrix((np.ones(2 * edges.shape[1]), (np.concatenate((edges[0], edges[1])),
+                                                     np.concatenate((edges[1], edges[0])))), shape=(num_v, num_v))
+    adj.data[:] = 1.0
+    # k-ring neighbors by sparse matrix powers, binarized at each step
+    ring = adj
+    neighbors = adj
+    for r in range(1, num_ring):
+        ring = ring @ adj
+        ring.data[:] = 1.0
+        neighbors = neighbors + ring
+    neighbors = neighbors.tocoo()
+    not_self = neighbors.row != neighbors.col
+    neighbors = csr_matrix((np.ones(np.sum(not_self)), (neighbors.row[not_self], neighbors.col[not_self])),
+                           shape=(num_v, num_v))
+    neighbors.data[:] = 1.0
+    num_neighbors = np.asarray(neighbors.sum(axis=1)).squeeze(1)
+    skin_weights_new = neighbors @ skin_weights / np.maximum(num_neighbors, 1)[:, np.newaxis]
+    # isolated vertices keep their weights
+    skin_weights_new[num_neighbors == 0] = skin_weights[num_neighbors == 0]
     return skin_weights_new
 
 
@@ -115,9 +120,10 @@ def main(args):
 
     cudnn.benchmark = True
     print('    Total params: %.2fM' % (sum(p.numel() for p in model.parameters()) / 1000000.0))
-    train_loader = DataLoader(SkinDataset(root=args.train_folder), batch_size=args.train_batch, shuffle=True)
-    val_loader = DataLoader(SkinDataset(root=args.val_folder), batch_size=args.test_batch, shuffle=False)
-    test_loader = DataLoader(SkinDataset(root=args.test_folder), batch_size=args.test_batch, shuffle=False)
+    dataset_class = SkinDatasetOnDisk if args.on_disk else SkinDataset
+    train_loader = DataLoader(dataset_class(root=args.train_folder), batch_size=args.train_batch, shuffle=True, num_workers=args.num_workers)
+    val_loader = DataLoader(dataset_class(root=args.val_folder), batch_size=args.test_batch, shuffle=False, num_workers=args.num_workers)
+    test_loader = DataLoader(dataset_class(root=args.test_folder), batch_size=args.test_batch, shuffle=False, num_workers=args.num_workers)
     if args.evaluate:
         print('\nEvaluation only')
         test_loss = test(test_loader, model, args, save_result=True)
@@ -238,6 +244,9 @@ if __name__ == '__main__':
                         type=str, help='folder of validation data')
     parser.add_argument('--test_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/test/',
                         type=str, help='folder of testing data')
+    parser.add_argument('--on_disk', action='store_true',
+                        help='read the splits lazily from their binary columnar files instead of loading them in memory')
+    parser.add_argument('--num_workers', type=int, default=0, help='number of data loading workers')
     parser.add_argument('--nearest_bone', type=int, default=5)
     parser.add_argument('--info_folder', default='/media/zhanxu/4T/ModelResource_RigNetv1_preproccessed/rig_info_remesh/',
                         type=str, help='folder of skeleton information')
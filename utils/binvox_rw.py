@@ -17,7 +17,6 @@
 
 
 import numpy as np
-import struct
 
 
 class Voxels(object):
@@ -190,25 +189,66 @@ def sparse_to_dense(voxel_data, dims, dtype=np.bool):
 def bwrite(fp,s):
     fp.write(s.encode())
 
-def write_pair(fp,state, ctr):
-    fp.write(struct.pack('B',state))
-    fp.write(struct.pack('B',ctr))
+def runs_to_rle(values, lengths):
+    """ Split runs longer than 255 and interleave (value, count) pairs as
+    bytes, as laid out in the binvox data section.
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    num_pairs = (lengths + 254) // 255
+    pair_values = np.repeat(np.asarray(values, dtype=np.uint8), num_pairs)
+    pair_counts = np.full(num_pairs.sum(), 255, dtype=np.uint8)
+    # the last pair of each run holds the remainder
+    pair_counts[np.cumsum(num_pairs) - 1] = lengths - 255 * (num_pairs - 1)
+    return np.stack((pair_values, pair_counts), axis=1).tobytes()
+
+def dense_to_rle(voxels_flat):
+    """ Run length encoding of a flat voxel array. Runs are found at the
+    points where the value changes.
+    """
+    voxels_flat = np.asarray(voxels_flat).astype(np.uint8)
+    starts = np.concatenate(([0], np.flatnonzero(voxels_flat[1:] != voxels_flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, len(voxels_flat)))
+    return runs_to_rle(voxels_flat[starts], lengths)
+
+def sparse_to_rle(voxel_data, dims, axis_order):
+    """ Run length encoding of a model in coordinate representation,
+    without converting it to dense format first. Coordinates are truncated
+    and voxels outside dims are discarded, as in sparse_to_dense.
+    """
+    if voxel_data.ndim!=2 or voxel_data.shape[0]!=3:
+        raise ValueError('voxel_data is wrong shape; should be 3xN array.')
+    if np.isscalar(dims):
+        dims = [dims]*3
+    dims = [int(d) for d in dims]
+    xyz = voxel_data.astype(np.int64)
+    valid_ix = ~np.any((xyz < 0) | (xyz >= np.atleast_2d(dims).T), 0)
+    xyz = xyz[:,valid_ix]
+    # linear index in the order voxels are written (x, z, y)
+    if axis_order=='xzy':
+        index = (xyz[0]*dims[1] + xyz[1])*dims[2] + xyz[2]
+    else:
+        index = (xyz[0]*dims[2] + xyz[2])*dims[1] + xyz[1]
+    index = np.unique(index)
+    sz = int(np.prod(dims))
+    # runs of filled voxels are made of consecutive indices
+    breaks = np.flatnonzero(np.diff(index) != 1) + 1
+    on_starts = index[np.concatenate(([0], breaks))] if len(index) else index
+    on_ends = index[np.append(breaks - 1, len(index) - 1)] + 1 if len(index) else index
+    # alternate empty and filled runs, then drop the empty runs of length 0
+    bounds = np.concatenate(([0], np.stack((on_starts, on_ends), axis=1).ravel(), [sz]))
+    lengths = np.diff(bounds)
+    values = np.arange(len(lengths)) % 2
+    return runs_to_rle(values[lengths > 0], lengths[lengths > 0])
 
 def write(voxel_model, fp):
     """ Write binary binvox format.
 
-    Note that when saving a model in sparse (coordinate) format, it is first
-    converted to dense format.
+    Models in sparse (coordinate) format are encoded directly, without
+    conversion to dense format.
 
     Doesn't check if the model is 'sane'.
 
     """
-    if voxel_model.data.ndim==2:
-        # TODO avoid conversion to dense
-        dense_voxel_data = sparse_to_dense(voxel_model.data, voxel_model.dims)
-    else:
-        dense_voxel_data = voxel_model.data
-
     bwrite(fp, '#binvox 1\n')
     bwrite(fp, 'dim ' + ' '.join(map(str, voxel_model.dims)) + '\n')
     bwrite(fp, 'translate ' + ' '.join(map(str, voxel_model.translate)) + '\n')
@@ -217,29 +257,15 @@ def write(voxel_model, fp):
     if not voxel_model.axis_order in ('xzy', 'xyz'):
         raise ValueError('Unsupported voxel model axis order')
 
+    if voxel_model.data.ndim==2:
+        fp.write(sparse_to_rle(voxel_model.data, voxel_model.dims, voxel_model.axis_order))
+        return
+
     if voxel_model.axis_order=='xzy':
-        voxels_flat = dense_voxel_data.flatten()
+        voxels_flat = voxel_model.data.flatten()
     elif voxel_model.axis_order=='xyz':
-        voxels_flat = np.transpose(dense_voxel_data, (0, 2, 1)).flatten()
-
-    # keep a sort of state machine for writing run length encoding
-    state = voxels_flat[0]
-    ctr = 0
-    for c in voxels_flat:
-        if c==state:
-            ctr += 1
-            # if ctr hits max, dump
-            if ctr==255:
-                write_pair(fp, state, ctr)
-                ctr = 0
-        else:
-            # if switch state, dump
-            write_pair(fp, state, ctr)
-            state = c
-            ctr = 1
-    # flush out remainders
-    if ctr > 0:
-        write_pair(fp, state, ctr)
+        voxels_flat = np.transpose(voxel_model.data, (0, 2, 1)).flatten()
+    fp.write(dense_to_rle(voxels_flat))
 
 if __name__ == '__main__':
     import doctest
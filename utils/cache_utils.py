@@ -0,0 +1,94 @@
+#-------------------------------------------------------------------------------
+# Name:        cache_utils.py
+# Purpose:     content-addressed on-disk cache for per-mesh preprocessing results
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import os
+import hashlib
+import numpy as np
+from utils.os_utils import mkdir_p
+from utils import binvox_rw
+
+
+class PreprocessCache:
+    """
+    Cache of preprocessing artefacts (remesh, normalization, edges, geodesic matrix, voxels) keyed by the hash
+    of the input mesh bytes and the preprocessing parameters. Each entry is one uncompressed .npz file.
+    Entries are evicted in least-recently-used order once the cache folder grows beyond max_size bytes.
+    """
+    def __init__(self, cache_folder, max_size=4 * 1024 ** 3):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        mkdir_p(cache_folder)
+
+    def make_key(self, filename, **params):
+        h = hashlib.sha1()
+        with open(filename, 'rb') as fin:
+            for block in iter(lambda: fin.read(1 << 20), b''):
+                h.update(block)
+        for k in sorted(params.keys()):
+            h.update('{:s}={}'.format(k, params[k]).encode())
+        return h.hexdigest()
+
+    def entry_filename(self, key):
+        return os.path.join(self.cache_folder, '{:s}.npz'.format(key))
+
+    def load(self, key):
+        """
+        :return: dict of artefacts, or None if the key is not cached
+        """
+        filename = self.entry_filename(key)
+        if not os.path.exists(filename):
+            return None
+        try:
+            with np.load(filename) as fin:
+                artefacts = {k: fin[k] for k in fin.files}
+        except (IOError, ValueError, EOFError):
+            # truncated or corrupted entry
+            os.remove(filename)
+            return None
+        os.utime(filename, None)  # mark as recently used
+        return artefacts
+
+    def save(self, key, artefacts):
+        filename = self.entry_filename(key)
+        tmp_filename = filename + '.tmp.{:d}.npz'.format(os.getpid())
+        np.savez(tmp_filename, **artefacts)
+        os.replace(tmp_filename, filename)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_folder):
+            if not name.endswith('.npz') or '.tmp.' in name:
+                continue
+            filename = os.path.join(self.cache_folder, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+        total_size = sum([e[1] for e in entries])
+        for _, size, filename in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total_size -= size
+
+
+def pack_voxels(vox):
+    return {'vox_data': np.packbits(vox.data.astype(bool).ravel()), 'vox_dims': np.array(vox.dims),
+            'vox_translate': np.array(vox.translate), 'vox_scale': np.array(vox.scale)}
+
+
+def unpack_voxels(artefacts):
+    dims = [int(d) for d in artefacts['vox_dims']]
+    data = np.unpackbits(artefacts['vox_data'], count=int(np.prod(dims))).astype(bool).reshape(dims)
+    return binvox_rw.Voxels(data, dims, [float(t) for t in artefacts['vox_translate']],
+                            float(artefacts['vox_scale']), 'xyz')
@@ -9,6 +9,7 @@
 import sys
 sys.path.append("./")
 import numpy as np
+from scipy.spatial import cKDTree
 
 
 def meanshift_cluster(pts_in, bandwidth, weights=None, max_iter=20):
@@ -36,6 +37,39 @@ def meanshift_cluster(pts_in, bandwidth, weights=None, max_iter=20):
     return pts_in
 
 
+def meanshift_cluster_grid(pts_in, bandwidth, weights=None, max_iter=20):
+    """
+    Meanshift clustering with neighbor lists. Same as meanshift_cluster, but the kernel max(bandwidth^2 - d^2, 0)
+    is only evaluated for pairs closer than bandwidth, found by a kd-tree rebuilt at every iteration.
+    Memory and time are linear in the number of pairs instead of N^2.
+    :param pts_in: input points
+    :param bandwidth: bandwidth
+    :param weights: weights per pts indicting its importance in the clustering
+    :return: points after clustering
+    """
+    num_pts = len(pts_in)
+    self_ids = np.arange(num_pts)
+    diff = 1e10
+    num_iter = 1
+    while diff > 1e-3 and num_iter < max_iter:
+        pairs = cKDTree(pts_in).query_pairs(bandwidth, output_type='ndarray')
+        # K[i, j] for i in neighbors of j, including j itself
+        i = np.concatenate((pairs[:, 0], pairs[:, 1], self_ids))
+        j = np.concatenate((pairs[:, 1], pairs[:, 0], self_ids))
+        K = np.maximum(bandwidth ** 2 - np.sum((pts_in[i] - pts_in[j]) ** 2, axis=1), 0.0)
+        if weights is not None:
+            # same broadcasting as K * weights in meanshift_cluster
+            K = K * (weights[i, 0] if weights.ndim == 2 else weights[j])
+        row_sums = np.bincount(j, weights=K, minlength=num_pts)
+        shifted = np.stack([np.bincount(j, weights=K * pts_in[i, d], minlength=num_pts)
+                            for d in range(pts_in.shape[1])], axis=1) / (row_sums[:, np.newaxis] + 1e-10)
+        pts_in_prim = 0.3 * (shifted - pts_in) + pts_in
+        diff = np.sqrt(np.sum((pts_in_prim - pts_in)**2))
+        pts_in = pts_in_prim
+        num_iter += 1
+    return pts_in
+
+
 def nms_meanshift(pts_in, density, bandwidth):
     """
     NMS to extract modes after meanshift. Code refers to sci-kit-learn.
@@ -57,3 +91,61 @@ def nms_meanshift(pts_in, density, bandwidth):
     return pts_in
 
 
+def kernel_density(pts_in, bandwidth, pairs=None):
+    """
+    density at each point with the kernel max(bandwidth^2 - d^2, 0), summed over pairs within bandwidth only
+    :param pts_in: input points
+    :param bandwidth: bandwidth
+    :param pairs: pairs (i < j) within bandwidth, found by a kd-tree if not given
+    :return: density at each point
+    """
+    if pairs is None:
+        pairs = cKDTree(pts_in).query_pairs(bandwidth, output_type='ndarray')
+    K = np.maximum(bandwidth ** 2 - np.sum((pts_in[pairs[:, 0]] - pts_in[pairs[:, 1]]) ** 2, axis=1), 0.0)
+    density = np.full(len(pts_in), bandwidth ** 2)
+    density += np.bincount(pairs[:, 0], weights=K, minlength=len(pts_in))
+    density += np.bincount(pairs[:, 1], weights=K, minlength=len(pts_in))
+    return density
+
+
+def nms_meanshift_grid(pts_in, density, bandwidth, pairs=None):
+    """
+    Same as nms_meanshift, but neighbors are looked up in a list of pairs within bandwidth
+    instead of a full distance matrix.
+    :param pts_in: input points
+    :param density: density at each point
+    :param bandwidth: bandwidth used in meanshift. Used here as neighbor region for NMS
+    :param pairs: pairs (i < j) within bandwidth, found by a kd-tree if not given
+    :return: extracted clusters.
+    """
+    if pairs is None:
+        pairs = cKDTree(pts_in).query_pairs(bandwidth, output_type='ndarray')
+    # neighbor lists in CSR layout
+    i = np.concatenate((pairs[:, 0], pairs[:, 1]))
+    j = np.concatenate((pairs[:, 1], pairs[:, 0]))
+    order = np.argsort(i, kind='stable')
+    neighbors = j[order]
+    indptr = np.searchsorted(i[order], np.arange(len(pts_in) + 1))
+    sorted_ids = np.argsort(density)[::-1]
+    unique = np.ones(len(sorted_ids), dtype=bool)
+    for p in sorted_ids:
+        if unique[p]:
+            unique[neighbors[indptr[p]:indptr[p + 1]]] = False
+    return pts_in[unique]
+
+
+def density_nms(pts_in, bandwidth, threshold):
+    """
+    Fused density filtering and NMS after meanshift, sharing one neighbor search. Replaces the N*N density
+    computation followed by nms_meanshift.
+    :param pts_in: points after meanshift
+    :param bandwidth: bandwidth used in meanshift
+    :param threshold: points with density / total density below it are discarded before NMS
+    :return: extracted clusters.
+    """
+    pairs = cKDTree(pts_in).query_pairs(bandwidth, output_type='ndarray')
+    density = kernel_density(pts_in, bandwidth, pairs)
+    keep = density / np.sum(density) > threshold
+    new_ids = np.cumsum(keep) - 1
+    pairs = new_ids[pairs[np.logical_and(keep[pairs[:, 0]], keep[pairs[:, 1]])]]
+    return nms_meanshift_grid(pts_in[keep], density[keep], bandwidth, pairs)
@@ -0,0 +1,239 @@
+#-------------------------------------------------------------------------------
+# Name:        cluster_utils_torch.py
+# Purpose:     utilize functions for clustering in pytorch, running on the device of the joint network
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+import torch
+
+
+def pairwise_distances(x, y):
+    #Input: x is a Nxd matrix
+    #       y is an optional Mxd matirx
+    #Output: dist is a NxM matrix where dist[i,j] is the square norm between x[i,:] and y[j,:]
+    #        if y is not given then use 'y=x'.
+    #i.e. dist[i,j] = ||x[i,:]-y[j,:]||^2
+    x_norm = (x ** 2).sum(1).view(-1, 1)
+    y_t = torch.transpose(y, 0, 1)
+    y_norm = (y ** 2).sum(1).view(1, -1)
+    dist = x_norm + y_norm - 2.0 * torch.mm(x, y_t)
+    return torch.clamp(dist, 0.0, np.inf)
+
+
+def _mesh_ptr(batch):
+    """
+    :return: start index of every mesh in points sorted by mesh, plus the number of points
+    """
+    if batch is None:
+        return None
+    counts = torch.bincount(batch)
+    return torch.cat((counts.new_zeros(1), torch.cumsum(counts, dim=0))).tolist()
+
+
+def _chunk_distances(pts, rows, batch, ptr):
+    """
+    squared distances between a chunk of points and all points of the same meshes
+    :param rows: slice of the chunk
+    :return: len(rows)*C squared distances, slice of the C columns, and mask of pairs in the same mesh (None if
+             there is a single mesh)
+    """
+    if batch is None:
+        cols = slice(0, len(pts))
+    else:
+        # points are sorted by mesh, so the meshes of the chunk cover a contiguous range of columns
+        cols = slice(ptr[batch[rows.start].item()], ptr[batch[rows.stop - 1].item() + 1])
+    Y = pairwise_distances(pts[rows], pts[cols])
+    same_mesh = batch[rows].view(-1, 1) == batch[cols].view(1, -1) if batch is not None else None
+    return Y, cols, same_mesh
+
+
+def _chunk_kernel(pts, rows, bandwidth, batch, ptr):
+    """
+    meanshift kernel max(bandwidth^2 - d^2, 0) between a chunk of points and all points of the same meshes
+    :return: len(rows)*C kernel, and slice of the C columns
+    """
+    Y, cols, same_mesh = _chunk_distances(pts, rows, batch, ptr)
+    K = torch.nn.functional.relu(bandwidth ** 2 - Y)
+    if same_mesh is not None:
+        K = K * same_mesh
+    return K, cols
+
+
+def meanshift_step(pts, bandwidth, weights=None, step_size=0.3, batch=None, chunk_size=1024):
+    """
+    one meanshift step, computed over chunks of chunk_size points, so the kernel is never built for all pairs
+    :param pts: input points, sorted by mesh if batch is given
+    :param weights: weights per point, N or N*1
+    :param batch: optional mesh index of each point. Points only attract points of the same mesh.
+    :return: shifted points
+    """
+    if len(pts) == 0:
+        return pts
+    ptr = _mesh_ptr(batch)
+    pts_shifted = []
+    for r in range(0, len(pts), chunk_size):
+        rows = slice(r, min(r + chunk_size, len(pts)))
+        K, cols = _chunk_kernel(pts, rows, bandwidth, batch, ptr)
+        if weights is not None:
+            K = K * weights[cols].view(1, -1)
+        # same as normalizing the kernel to sum 1 per shifted point (F.normalize with p=1, eps=1e-10)
+        pts_mean = torch.matmul(K, pts[cols]) / torch.clamp(torch.sum(K, dim=1, keepdim=True), min=1e-10)
+        pts_shifted.append(step_size * (pts_mean - pts[rows]) + pts[rows])
+    return torch.cat(pts_shifted, dim=0)
+
+
+def meanshift_cluster(pts, bandwidth, weights, args, chunk_size=1024):
+    """
+    meanshift written in pytorch
+    :param pts: input points
+    :param weights: weight per point during clustering
+    :return: clustered points
+    """
+    pts_steps = []
+    for i in range(args.meanshift_step):
+        pts = meanshift_step(pts, bandwidth, weights, args.step_size, chunk_size=chunk_size)
+        pts_steps.append(pts)
+    return pts_steps
+
+
+def meanshift_cluster_converge(pts, bandwidth, weights=None, max_iter=20, batch=None, chunk_size=1024):
+    """
+    meanshift until convergence, with the same stopping rule as cluster_utils.meanshift_cluster, applied per mesh
+    :param pts: input points, sorted by mesh if batch is given
+    :param bandwidth: bandwidth
+    :param weights: weights per pts indicting its importance in the clustering
+    :param batch: optional mesh index of each point. Each mesh stops shifting once it has converged.
+    :return: points after clustering
+    """
+    if batch is None:
+        batch = torch.zeros(len(pts), dtype=torch.long, device=pts.device)
+    num_mesh = int(batch.max().item()) + 1 if len(batch) > 0 else 0
+    active = torch.ones(num_mesh, dtype=torch.bool, device=pts.device)
+    num_iter = 1
+    while num_iter < max_iter and active.any():
+        sel = active[batch]
+        pts_prim = meanshift_step(pts[sel], bandwidth, weights[sel] if weights is not None else None,
+                                  batch=batch[sel] if num_mesh > 1 else None, chunk_size=chunk_size)
+        diff = torch.zeros(num_mesh, dtype=pts.dtype, device=pts.device)
+        diff.index_add_(0, batch[sel], torch.sum((pts_prim - pts[sel]) ** 2, dim=1))
+        pts = pts.clone()
+        pts[sel] = pts_prim
+        active &= torch.sqrt(diff) > 1e-3
+        num_iter += 1
+    return pts
+
+
+def inside_check(pts, vox_data, vox_translate, vox_scale):
+    """
+    Check where points are inside or outside the mesh based on its voxelization.
+    :param pts: points to be checked
+    :param vox_data: occupancy grid as a bool tensor on the device of pts
+    :param vox_translate: translation of the voxel grid
+    :param vox_scale: scale of the voxel grid
+    :return: mask of internal points
+    """
+    dims = vox_data.shape[0]
+    vc = torch.round((pts - pts.new_tensor(vox_translate)) / vox_scale * dims).long()
+    ind1 = torch.logical_and(torch.all(vc >= 0, dim=1), torch.all(vc < dims, dim=1))
+    vc = torch.clamp(vc, 0, dims - 1)
+    ind2 = vox_data[vc[:, 0], vc[:, 1], vc[:, 2]]
+    return torch.logical_and(ind1, ind2)
+
+
+def density_nms(pts, bandwidth, threshold, batch=None, chunk_size=1024):
+    """
+    Density filtering and NMS after meanshift. Greedy NMS is evaluated in rounds: a point is kept once none of its
+    denser neighbors is undecided, which gives the same modes as cluster_utils.nms_meanshift. Distances are computed
+    over chunks of chunk_size points, so no matrix over all pairs is kept.
+    :param pts: points after meanshift, sorted by mesh if batch is given
+    :param bandwidth: bandwidth used in meanshift. Used here as neighbor region for NMS
+    :param threshold: points with density / total density (of their mesh) below it are discarded before NMS
+    :param batch: optional mesh index of each point. Density and NMS only involve points of the same mesh.
+    :return: extracted clusters, and their mesh index
+    """
+    if batch is None:
+        batch = torch.zeros(len(pts), dtype=torch.long, device=pts.device)
+    if len(pts) == 0:
+        return pts, batch
+    num_mesh = int(batch.max().item()) + 1
+    ptr = _mesh_ptr(batch)
+    chunks = [slice(r, min(r + chunk_size, len(pts))) for r in range(0, len(pts), chunk_size)]
+    density = torch.cat([torch.sum(_chunk_kernel(pts, rows, bandwidth, batch, ptr)[0], dim=1) for rows in chunks])
+    total_density = torch.zeros(num_mesh, dtype=density.dtype, device=pts.device).index_add_(0, batch, density)
+    keep = density / total_density[batch] > threshold
+    pts, density, batch = pts[keep], density[keep], batch[keep]
+
+    ptr = _mesh_ptr(batch)
+    chunks = [slice(r, min(r + chunk_size, len(pts))) for r in range(0, len(pts), chunk_size)]
+    rank = torch.empty_like(density, dtype=torch.long)
+    rank[torch.argsort(density, descending=True)] = torch.arange(len(density), device=pts.device)
+    undecided = torch.ones(len(pts), dtype=torch.bool, device=pts.device)
+    unique = torch.zeros(len(pts), dtype=torch.bool, device=pts.device)
+    while undecided.any():
+        blocked = torch.zeros(len(pts), dtype=torch.bool, device=pts.device)
+        for rows in chunks:
+            adjacent, cols = _chunk_adjacent(pts, rows, bandwidth, batch, ptr)
+            denser = rank[cols].view(1, -1) < rank[rows].view(-1, 1)
+            blocked[rows] = torch.any(adjacent & denser & undecided[cols].view(1, -1), dim=1)
+        new_unique = undecided & ~blocked
+        unique |= new_unique
+        suppressed = torch.zeros(len(pts), dtype=torch.bool, device=pts.device)
+        for rows in chunks:
+            adjacent, cols = _chunk_adjacent(pts, rows, bandwidth, batch, ptr)
+            suppressed[rows] = torch.any(adjacent & new_unique[cols].view(1, -1), dim=1)
+        undecided &= ~(new_unique | suppressed)
+    return pts[unique], batch[unique]
+
+
+def _chunk_adjacent(pts, rows, bandwidth, batch, ptr):
+    """
+    :return: if points of the chunk are within bandwidth of the points of the same meshes, and slice of these columns
+    """
+    Y, cols, same_mesh = _chunk_distances(pts, rows, batch, ptr)
+    return (torch.sqrt(Y) <= bandwidth) & same_mesh, cols
+
+
+def cluster_joints(y_pred, attn_pred, vox, threshold, bandwidth, max_iter=40, chunk_size=1024):
+    """
+    extract joints from the shifted vertices of one mesh. Same steps as RigPredictor.cluster_joints, in float32
+    on the device of the inputs.
+    :param y_pred: shifted vertices
+    :param attn_pred: predicted attention per vertex
+    :param vox: voxelized mesh
+    :param threshold: density threshold to filter out shifted points
+    :param bandwidth: bandwidth for meanshift clustering
+    :return: clustered joints before symmetrization, J*3 numpy array
+    """
+    batch = torch.zeros(len(y_pred), dtype=torch.long, device=y_pred.device)
+    return cluster_joints_batch(y_pred, attn_pred, batch, [vox], threshold, bandwidth, max_iter, chunk_size)[0]
+
+
+def cluster_joints_batch(y_pred, attn_pred, batch, voxes, threshold, bandwidth, max_iter=40, chunk_size=1024):
+    """
+    batched version of cluster_joints, taking the output of the joint network on a batch of meshes. Meanshift and
+    NMS run on the points of all meshes together, with kernels masked between different meshes and each mesh
+    stopping on its own convergence.
+    :param batch: mesh index of each vertex
+    :param voxes: voxelized meshes
+    :return: list of clustered joints, one J*3 numpy array per mesh
+    """
+    pts, weights, pts_batch = [], [], []
+    for i, vox in enumerate(voxes):
+        y_pred_i, attn_pred_i = y_pred[batch == i], attn_pred[batch == i]
+        vox_data = torch.from_numpy(np.ascontiguousarray(vox.data, dtype=bool)).to(y_pred.device)
+        index_inside = inside_check(y_pred_i, vox_data, vox.translate, vox.scale)
+        y_pred_i, attn_pred_i = y_pred_i[index_inside], attn_pred_i[index_inside]
+        y_pred_i, attn_pred_i = y_pred_i[attn_pred_i[:, 0] > 1e-3], attn_pred_i[attn_pred_i[:, 0] > 1e-3]
+        # symmetrize points by reflecting
+        pts.append(torch.cat((y_pred_i, y_pred_i * y_pred_i.new_tensor([[-1, 1, 1]])), dim=0))
+        weights.append(attn_pred_i.repeat(2, 1))
+        pts_batch.append(torch.full((2 * len(y_pred_i),), i, dtype=torch.long, device=y_pred.device))
+    pts, weights, pts_batch = torch.cat(pts, dim=0), torch.cat(weights, dim=0), torch.cat(pts_batch, dim=0)
+    pts = meanshift_cluster_converge(pts, bandwidth, weights, max_iter=max_iter, batch=pts_batch,
+                                     chunk_size=chunk_size)
+    joints, joints_batch = density_nms(pts, bandwidth, threshold, batch=pts_batch, chunk_size=chunk_size)
+    joints, joints_batch = joints.double().cpu().numpy(), joints_batch.cpu().numpy()
+    return [joints[joints_batch == i] for i in range(len(voxes))]
@@ -9,7 +9,6 @@
 import os
 import numpy as np
 from utils.os_utils import mkdir_p
-from utils.tree_utils import TreeNode
 from utils.rig_parser import Info
 from geometric_proc.compute_volumetric_geodesic import get_bones
 
@@ -56,37 +55,17 @@ def output_point_cloud_ply(xyzs, name, output_folder):
 
 
 def add_duplicate_joints(skel):
-    this_level = [skel.root]
-    while this_level:
-        next_level = []
-        for p_node in this_level:
-            if len(p_node.children) > 1:
-                new_children = []
-                for dup_id in range(len(p_node.children)):
-                    p_node_new = TreeNode(p_node.name + '_dup_{:d}'.format(dup_id), p_node.pos)
-                    p_node_new.overlap=True
-                    p_node_new.parent = p_node
-                    p_node_new.children = [p_node.children[dup_id]]
-                    # for user interaction, we move overlapping joints a bit to its children
-                    p_node_new.pos = np.array(p_node_new.pos) + 0.03 * np.linalg.norm(np.array(p_node.children[dup_id].pos) - np.array(p_node_new.pos))
-                    p_node_new.pos = (p_node_new.pos[0], p_node_new.pos[1], p_node_new.pos[2])
-                    p_node.children[dup_id].parent = p_node_new
-                    new_children.append(p_node_new)
-                p_node.children = new_children
-            p_node.overlap = False
-            next_level += p_node.children
-        this_level = next_level
+    """
+    give every child of a joint with several children its own copy of that joint, see
+    SkeletonArray.add_duplicate_joints. The skeleton is modified in place.
+    """
+    skel.set_skeleton_array(skel.get_skeleton_array().add_duplicate_joints())
     return skel
 
 
 def mapping_bone_index(bones_old, bones_new):
-    bone_map = {}
-    for i in range(len(bones_old)):
-        bone_old = bones_old[i][np.newaxis, :]
-        dist = np.linalg.norm(bones_new - bone_old, axis=1)
-        ni = np.argmin(dist)
-        bone_map[i] = ni
-    return bone_map
+    dist = np.linalg.norm(bones_new[np.newaxis, :, :] - bones_old[:, np.newaxis, :], axis=2)
+    return dict(enumerate(np.argmin(dist, axis=1).tolist()))
 
 
 def assemble_skel_skin(skel, attachment):
@@ -95,21 +74,11 @@ def assemble_skel_skin(skel, attachment):
     bones_new, bone_names_new, _ = get_bones(skel_new)
     bone_map = mapping_bone_index(bones_old, bones_new)
     skel_new.joint_pos = skel_new.get_joint_dict()
-    skel_new.joint_skin = []
 
-    for v in range(len(attachment)):
-        vi_skin = [str(v)]
-        skw = attachment[v]
-        skw = skw / (np.sum(skw) + 1e-10)
-        for i in range(len(skw)):
-            if i == len(bones_old):
-                break
-            if skw[i] > 1e-5:
-                bind_joint_name = bone_names_new[bone_map[i]][0]
-                bind_weight = skw[i]
-                vi_skin.append(bind_joint_name)
-                vi_skin.append(str(bind_weight))
-        skel_new.joint_skin.append(vi_skin)
+    skw = attachment / (np.sum(attachment, axis=1, keepdims=True) + 1e-10)
+    skw = skw[:, :len(bones_old)]
+    bind_joint_names = [bone_names_new[bone_map[i]][0] for i in range(skw.shape[1])]
+    skel_new.set_skin_arrays(np.arange(len(attachment)), skw, bind_joint_names, min_weight=1e-5)
     return skel_new
 
 
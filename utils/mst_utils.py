@@ -21,8 +21,8 @@ def inside_check(pts, vox):
     """
     vc = (pts - vox.translate) / vox.scale * vox.dims[0]
     vc = np.round(vc).astype(int)
-    ind1 = np.logical_and(np.all(vc >= 0, axis=1), np.all(vc < 88, axis=1))
-    vc = np.clip(vc, 0, 87)
+    ind1 = np.logical_and(np.all(vc >= 0, axis=1), np.all(vc < vox.dims[0], axis=1))
+    vc = np.clip(vc, 0, vox.dims[0] - 1)
     ind2 = vox.data[vc[:, 0], vc[:, 1], vc[:, 2]]
     ind = np.logical_and(ind1, ind2)
     pts = pts[ind]
@@ -46,6 +46,51 @@ def sample_on_bone(p_pos, ch_pos):
     return res
 
 
+def segment_occupancy(p_pos, ch_pos, vox, chunk_size=20000):
+    """
+    sample all segments at once in the same way as sample_on_bone, and check samples against the voxelization
+    :param p_pos: S*3 starting positions
+    :param ch_pos: S*3 ending positions
+    :param vox: voxelized mesh
+    :param chunk_size: number of segments sampled together, to bound memory
+    :return: number of samples and number of samples inside the mesh, per segment
+    """
+    num_samples = np.zeros(len(p_pos), dtype=int)
+    num_inside = np.zeros(len(p_pos), dtype=int)
+    for s_start in range(0, len(p_pos), chunk_size):
+        p_chunk = p_pos[s_start:s_start + chunk_size]
+        ch_chunk = ch_pos[s_start:s_start + chunk_size]
+        ray = ch_chunk - p_chunk
+        bone_length = np.sqrt(np.sum((p_chunk - ch_chunk) ** 2, axis=1))
+        num_step = np.round(bone_length / 0.01)
+        unit_step = ray / (num_step[:, np.newaxis] + 1e-30)
+        # ragged samples of all segments, i_step runs from 1 to num_step in each segment
+        num_step = num_step.astype(int)
+        seg_id = np.repeat(np.arange(len(p_chunk)), num_step)
+        i_step = np.arange(len(seg_id)) - np.repeat(np.cumsum(num_step) - num_step, num_step) + 1
+        samples = p_chunk[seg_id] + unit_step[seg_id] * i_step[:, np.newaxis]
+
+        samples_vox = (samples - vox.translate) / vox.scale * vox.dims[0]
+        samples_vox = np.round(samples_vox).astype(int)
+        ind1 = np.logical_and(np.all(samples_vox >= 0, axis=1), np.all(samples_vox < vox.dims[0], axis=1))
+        samples_vox = np.clip(samples_vox, 0, vox.dims[0] - 1)
+        ind2 = vox.data[samples_vox[:, 0], samples_vox[:, 1], samples_vox[:, 2]]
+        in_flags = np.logical_and(ind1, ind2)
+        num_samples[s_start:s_start + chunk_size] = num_step
+        num_inside[s_start:s_start + chunk_size] = np.bincount(seg_id[in_flags], minlength=len(p_chunk))
+    return num_samples, num_inside
+
+
+def pair_occupancy(joint_pos, vox):
+    """
+    segment_occupancy of all joint pairs (i < j), in the order of itertools.combinations
+    :return: pair indices P*2, number of samples and number of samples inside the mesh per pair
+    """
+    pairs = np.stack(np.triu_indices(len(joint_pos), k=1), axis=1)
+    num_samples, num_inside = segment_occupancy(joint_pos[pairs[:, 0]], joint_pos[pairs[:, 1]], vox)
+    return pairs, num_samples, num_inside
+
+
 def minKey(key, mstSet, nV):
     # Initilaize min value
     min = sys.maxsize
@@ -98,21 +143,27 @@ def primMST_symmetry(graph, init_id, joints):
     """
     my modified prim algorithm to generate a tree as symmetric as possible.
     Not guaranteed to be symmetric. All heuristics.
+    When a joint on one side is added to the tree, its mirrored joint is added at the same time, with the mirrored
+    parent. Next vertex is picked by one argmin over the keys of the vertices not yet in the tree, and keys are
+    relaxed with the cost rows of both joints at once.
     :param graph: pairwise cost matrix
     :param init_id: init node ID as root
     :param joints: joint positions J*3
     :return:
     """
-    joint_mapping = {}
-    left_joint_ids = np.argwhere(joints[:, 0] < -2e-2).squeeze(1).tolist()
-    middle_joint_ids = np.argwhere(np.abs(joints[:, 0]) <= 2e-2).squeeze(1).tolist()
-    right_joint_ids = np.argwhere(joints[:, 0] > 2e-2).squeeze(1).tolist()
-    for i in range(len(left_joint_ids)):
-        joint_mapping[left_joint_ids[i]] = right_joint_ids[i]
-    for i in range(len(right_joint_ids)):
-        joint_mapping[right_joint_ids[i]] = left_joint_ids[i]
-
-    if init_id not in middle_joint_ids:
+    left_joint_ids = np.argwhere(joints[:, 0] < -2e-2).squeeze(1)
+    middle_joint_ids = np.argwhere(np.abs(joints[:, 0]) <= 2e-2).squeeze(1)
+    right_joint_ids = np.argwhere(joints[:, 0] > 2e-2).squeeze(1)
+    is_middle = np.zeros(len(joints), dtype=bool)
+    is_middle[middle_joint_ids] = True
+    is_side = np.zeros(len(joints), dtype=bool)
+    is_side[left_joint_ids] = True
+    is_side[right_joint_ids] = True
+    joint_mapping = np.full(len(joints), -1)
+    joint_mapping[left_joint_ids] = right_joint_ids[:len(left_joint_ids)]
+    joint_mapping[right_joint_ids] = left_joint_ids[:len(right_joint_ids)]
+
+    if not is_middle[init_id]:
         #find nearest joint in the middle to be root
         if len(middle_joint_ids) > 0:
             nearest_id = np.argmin(np.linalg.norm(joints[middle_joint_ids, :] - joints[init_id, :][np.newaxis, :], axis=1))
@@ -120,79 +171,42 @@ def primMST_symmetry(graph, init_id, joints):
 
     nV = graph.shape[0]
     # Key values used to pick minimum weight edge in cut
-    key = [sys.maxsize] * nV
-    parent = [None] * nV  # Array to store constructed MST
-    mstSet = [False] * nV
+    key = np.full(nV, float(sys.maxsize))
+    parent = np.full(nV, -2)  # Array to store constructed MST, -2 for not reached
+    mstSet = np.zeros(nV, dtype=bool)
     # Make key init_id so that this vertex is picked as first vertex
     key[init_id] = 0
     parent[init_id] = -1  # First node is always the root of
-
-    while not all(mstSet):
-        # Pick the minimum distance vertex from
-        # the set of vertices not yet processed.
-        # u is always equal to src in first iteration
-        u = minKey(key, mstSet, nV)
-        # left cases
-        if u in left_joint_ids and parent[u] in middle_joint_ids:
-            u2 = joint_mapping[u]
-            if mstSet[u2] is False:
-                mstSet[u2] = True
-                parent[u2] = parent[u]
-                key[u2] = graph[u2, parent[u2]]
-        elif u in left_joint_ids and parent[u] in left_joint_ids:
-            u2 = joint_mapping[u]
-            if mstSet[u2] is False:
-                mstSet[u2] = True
-                parent[u2] = joint_mapping[parent[u]]
-                key[u2] = graph[u2, parent[u2]]
-        elif u in left_joint_ids and parent[u] in right_joint_ids:
+    # keys of the vertices not yet processed, inf for the ones in the tree
+    open_key = key.copy()
+
+    while not mstSet.all():
+        # Pick the minimum distance vertex from the set of vertices not yet processed.
+        # argmin breaks ties by the smaller vertex id, as minKey.
+        u = int(np.argmin(open_key))
+        # a side joint whose parent is a joint brings its mirrored joint
+        if is_side[u] and parent[u] >= 0:
             u2 = joint_mapping[u]
-            if mstSet[u2] is False:
+            if not mstSet[u2]:
                 mstSet[u2] = True
-                parent[u2] = joint_mapping[parent[u]]
+                open_key[u2] = np.inf
+                parent[u2] = parent[u] if is_middle[parent[u]] else joint_mapping[parent[u]]
                 key[u2] = graph[u2, parent[u2]]
-
-        # right cases
-        elif u in right_joint_ids and parent[u] in middle_joint_ids:
-            u2 = joint_mapping[u]
-            if mstSet[u2] is False:
-                mstSet[u2] = True
-                parent[u2] = parent[u]
-                key[u2] = graph[u2, parent[u2]]
-        elif u in right_joint_ids and parent[u] in right_joint_ids:
-            u2 = joint_mapping[u]
-            if mstSet[u2] is False:
-                mstSet[u2] = True
-                parent[u2] = joint_mapping[parent[u]]
-                key[u2] = graph[u2, parent[u2]]
-        elif u in right_joint_ids and parent[u] in left_joint_ids:
-            u2 = joint_mapping[u]
-            if mstSet[u2] is False:
-                mstSet[u2] = True
-                parent[u2] = joint_mapping[parent[u]]
-                key[u2] = graph[u2, parent[u2]]
-        # middle case
         else:
             u2 = None
 
         mstSet[u] = True
+        open_key[u] = np.inf
 
-        # Update dist value of the adjacent vertices
-        # of the picked vertex only if the current
-        # distance is greater than new distance and
-        # the vertex in not in the shotest path tree
-        for v in range(nV):
-            # graph[u][v] is non zero only for adjacent vertices of m
-            # mstSet[v] is false for vertices not yet included in MST
-            # Update the key only if graph[u][v] is smaller than key[v]
-            if graph[u,v] > 0 and mstSet[v] == False and key[v] > graph[u,v]:
-                key[v] = graph[u,v]
-                parent[v] = u
-            if u2 is not None and graph[u2,v] > 0 and mstSet[v] == False and key[v] > graph[u2,v]:
-                key[v] = graph[u2, v]
-                parent[v] = u2
+        # Update key of the vertices not in the tree if the picked vertex (then its mirror) is closer
+        for w in ([u] if u2 is None else [u, u2]):
+            update = np.logical_and(np.logical_and(graph[w] > 0, ~mstSet), key > graph[w])
+            key[update] = graph[w, update]
+            open_key[update] = key[update]
+            parent[update] = w
 
-    return parent, key, init_id
+    parent = [None if p == -2 else int(p) for p in parent]
+    return parent, key.tolist(), init_id
 
 
 def loadSkel_recur(p_node, parent_id, joint_name, joint_pos, parent):
@@ -225,28 +239,22 @@ def unique_rows(a):
     return unique_a.view(a.dtype).reshape((unique_a.shape[0], a.shape[1]))
 
 
-def increase_cost_for_outside_bone(cost_matrix, joint_pos, vox):
+def increase_cost_for_outside_bone(cost_matrix, joint_pos, vox, num_outside=None):
     """
     increase connectivity cost for bones outside the meshs
+    :param num_outside: number of bone samples outside the mesh for all joint pairs (i < j), in the order of
+                        itertools.combinations. Computed from joint_pos and vox if not given.
     """
-    for i in range(len(joint_pos)):
-        for j in range(i+1, len(joint_pos)):
-            bone_samples = sample_on_bone(joint_pos[i], joint_pos[j])
-            bone_samples_vox = (bone_samples - vox.translate) / vox.scale * vox.dims[0]
-            bone_samples_vox = np.round(bone_samples_vox).astype(int)
-
-            ind1 = np.logical_and(np.all(bone_samples_vox >= 0, axis=1), np.all(bone_samples_vox < vox.dims[0], axis=1))
-            bone_samples_vox = np.clip(bone_samples_vox, 0, vox.dims[0]-1)
-            ind2 = vox.data[bone_samples_vox[:, 0], bone_samples_vox[:, 1], bone_samples_vox[:, 2]]
-            in_flags = np.logical_and(ind1, ind2)
-            outside_bone_sample = np.sum(in_flags == False)
-
-            if outside_bone_sample > 1:
-                cost_matrix[i, j] = 2 * outside_bone_sample
-                cost_matrix[j, i] = 2 * outside_bone_sample
-            if np.abs(joint_pos[i, 0]) < 2e-2 and np.abs(joint_pos[j, 0]) < 2e-2:
-                cost_matrix[i, j] *= 0.5
-                cost_matrix[j, i] *= 0.5
+    if num_outside is None:
+        _, num_samples, num_inside = pair_occupancy(joint_pos, vox)
+        num_outside = num_samples - num_inside
+    i, j = np.triu_indices(len(joint_pos), k=1)
+    outside = num_outside > 1
+    cost_matrix[i[outside], j[outside]] = 2 * num_outside[outside]
+    cost_matrix[j[outside], i[outside]] = 2 * num_outside[outside]
+    middle = np.logical_and(np.abs(joint_pos[i, 0]) < 2e-2, np.abs(joint_pos[j, 0]) < 2e-2)
+    cost_matrix[i[middle], j[middle]] *= 0.5
+    cost_matrix[j[middle], i[middle]] *= 0.5
     return cost_matrix
 
 
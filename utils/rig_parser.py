@@ -7,11 +7,7 @@
 #-------------------------------------------------------------------------------
 
 import numpy as np
-from utils.tree_utils import TreeNode
-try:
-    import Queue as Q  # ver. < 3.0
-except ImportError:
-    import queue as Q
+from utils.tree_utils import TreeNode, SkeletonArray
 
 
 class Info:
@@ -26,28 +22,80 @@ class Info:
             self.load(filename)
 
     def load(self, filename):
+        """
+        read the rig in a single pass over the lines. Hierarchy lines are collected in a parent -> children index,
+        and the tree is assembled once all joints are known.
+        """
         with open(filename, 'r') as f_txt:
             lines = f_txt.readlines()
+        root_name = None
+        children = {}
         for line in lines:
             word = line.split()
             if word[0] == 'joints':
                 self.joint_pos[word[1]] = [float(word[2]), float(word[3]), float(word[4])]
             elif word[0] == 'root':
-                root_pos = self.joint_pos[word[1]]
-                self.root = TreeNode(word[1], (root_pos[0], root_pos[1], root_pos[2]))
+                root_name = word[1]
             elif word[0] == 'skin':
                 skin_item = word[1:]
                 self.joint_skin.append(skin_item)
-        self.loadHierarchy_recur(self.root, lines, self.joint_pos)
+            elif word[0] == 'hier':
+                children.setdefault(word[1], []).append(word[2])
+        if root_name is not None:
+            root_pos = self.joint_pos[root_name]
+            self.root = TreeNode(root_name, (root_pos[0], root_pos[1], root_pos[2]))
+            self.loadHierarchy(self.root, children, self.joint_pos)
 
-    def loadHierarchy_recur(self, node, lines, joint_pos):
-        for li in lines:
-            if li.split()[0] == 'hier' and li.split()[1] == node.name:
-                pos = joint_pos[li.split()[2]]
-                ch_node = TreeNode(li.split()[2], tuple(pos))
+    def loadHierarchy(self, root, children, joint_pos):
+        """
+        build the tree below root iteratively
+        :param children: dict from joint name to the names of its children, in the order of the hier lines
+        """
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for ch_name in children.get(node.name, []):
+                ch_node = TreeNode(ch_name, tuple(joint_pos[ch_name]))
                 node.children.append(ch_node)
                 ch_node.parent = node
-                self.loadHierarchy_recur(ch_node, lines, joint_pos)
+                stack.append(ch_node)
+
+    def get_skin_arrays(self, joint_names=None):
+        """
+        bulk representation of joint_skin
+        :param joint_names: column order of the weight matrix. By default joints in order of first appearance.
+        :return: vertex id of every skin line, V*J skinning weight matrix (one row per skin line) and joint names
+        """
+        num_bind = np.array([(len(skin_v) - 1) // 2 for skin_v in self.joint_skin], dtype=int)
+        vert_ids = np.array([int(skin_v[0]) for skin_v in self.joint_skin], dtype=int)
+        names = [name for skin_v in self.joint_skin for name in skin_v[1::2]]
+        weights = np.array([w for skin_v in self.joint_skin for w in skin_v[2::2]], dtype=np.float64)
+        if joint_names is None:
+            joint_names = list(dict.fromkeys(names))
+        joint_ids = {name: i for i, name in enumerate(joint_names)}
+        skin = np.zeros((len(self.joint_skin), len(joint_names)))
+        skin[np.repeat(np.arange(len(self.joint_skin)), num_bind), [joint_ids[name] for name in names]] = weights
+        return vert_ids, skin, list(joint_names)
+
+    def set_skin_arrays(self, vert_ids, skin, joint_names, min_weight=0.0, append=False):
+        """
+        fill joint_skin from a skinning weight matrix, inverse of get_skin_arrays
+        :param vert_ids: vertex id of every row
+        :param skin: V*J skinning weight matrix
+        :param joint_names: joint name of every column
+        :param min_weight: only weights above it are kept
+        :param append: add the rows to the existing joint_skin instead of replacing it, to fill it chunk by chunk
+        """
+        rows, cols = np.nonzero(skin > min_weight)
+        weights = skin[rows, cols].astype(str)
+        row_start = np.searchsorted(rows, np.arange(len(skin) + 1))
+        if not append:
+            self.joint_skin = []
+        for i in range(len(skin)):
+            skin_v = [str(vert_ids[i])]
+            for j in range(row_start[i], row_start[i + 1]):
+                skin_v += [joint_names[cols[j]], weights[j]]
+            self.joint_skin.append(skin_v)
 
     def save(self, filename):
         with open(filename, 'w') as file_info:
@@ -90,20 +138,19 @@ class Info:
         fout.close()
 
     def normalize(self, scale, trans):
-        for k, v in self.joint_pos.items():
-            self.joint_pos[k] /= scale
-            self.joint_pos[k] -= trans
+        skeleton = self.get_skeleton_array()
+        skeleton.normalize(scale, trans)
+        self.set_skeleton_array(skeleton)
 
+    def get_skeleton_array(self):
+        return SkeletonArray.from_tree(self.root)
 
-        this_level = [self.root]
-        while this_level:
-            next_level = []
-            for node in this_level:
-                node.pos /= scale
-                node.pos = (node.pos[0] - trans[0], node.pos[1] - trans[1], node.pos[2] - trans[2])
-                for ch in node.children:
-                    next_level.append(ch)
-            this_level = next_level
+    def set_skeleton_array(self, skeleton):
+        """
+        replace the joint tree, and joint positions, by the given SkeletonArray
+        """
+        self.root = skeleton.to_tree()
+        self.joint_pos = {name: list(pos) for name, pos in skeleton.joint_dict().items()}
 
     def get_joint_dict(self):
         joint_dict = {}
@@ -117,22 +164,7 @@ class Info:
         return joint_dict
 
     def adjacent_matrix(self):
-        joint_pos = self.get_joint_dict()
-        joint_name_list = list(joint_pos.keys())
-        num_joint = len(joint_pos)
-        adj_matrix = np.zeros((num_joint, num_joint))
-        this_level = [self.root]
-        while this_level:
-            next_level = []
-            for p_node in this_level:
-                for c_node in p_node.children:
-                    index_parent = joint_name_list.index(p_node.name)
-                    index_children = joint_name_list.index(c_node.name)
-                    adj_matrix[index_parent, index_children] = 1.
-                next_level += p_node.children
-            this_level = next_level
-        adj_matrix = adj_matrix + adj_matrix.transpose()
-        return adj_matrix
+        return self.get_skeleton_array().adjacent_matrix()
 
 
 class Skel:
@@ -145,43 +177,46 @@ class Skel:
             self.load(filename)
 
     def load(self, filename):
+        """
+        read the skeleton in a single pass over the lines, collecting the children of every joint, then assemble the
+        tree iteratively. With an order column, children are sorted by it.
+        """
         with open(filename, 'r') as fin:
             lines = fin.readlines()
+        self.root = None
+        has_order = False
+        children = {}
         for li in lines:
             words = li.split()
             if words[5] == "None":
-                self.root = TreeNode(words[1], (float(words[2]), float(words[3]), float(words[4])))
-                if len(words) == 7:
-                    has_order = True
-                    self.root.order = int(words[6])
-                else:
-                    has_order = False
-                break
-        self.loadSkel_recur(self.root, lines, has_order)
-
-    def loadSkel_recur(self, node, lines, has_order):
+                if self.root is None:
+                    self.root = TreeNode(words[1], (float(words[2]), float(words[3]), float(words[4])))
+                    has_order = len(words) == 7
+                    if has_order:
+                        self.root.order = int(words[6])
+            else:
+                children.setdefault(words[5], []).append((li, words))
         if has_order:
-            ch_queue = Q.PriorityQueue()
-            for li in lines:
-                words = li.split()
-                if words[5] == node.name:
-                    ch_queue.put((int(li.split()[6]), li))
-            while not ch_queue.empty():
-                item = ch_queue.get()
-                li = item[1]
-                ch_node = TreeNode(li.split()[1], (float(li.split()[2]), float(li.split()[3]), float(li.split()[4])))
-                ch_node.order = int(li.split()[6])
+            # same order as the priority queue of (order, line) used before
+            for ch_list in children.values():
+                ch_list.sort(key=lambda ch: (int(ch[1][6]), ch[0]))
+        self.loadSkel(self.root, children, has_order)
+
+    def loadSkel(self, root, children, has_order):
+        """
+        build the tree below root iteratively
+        :param children: dict from joint name to the lines (and their words) of its children
+        """
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            for _, words in children.get(node.name, []):
+                ch_node = TreeNode(words[1], (float(words[2]), float(words[3]), float(words[4])))
+                if has_order:
+                    ch_node.order = int(words[6])
                 node.children.append(ch_node)
                 ch_node.parent = node
-                self.loadSkel_recur(ch_node, lines, has_order)
-        else:
-            for li in lines:
-                words = li.split()
-                if words[5] == node.name:
-                    ch_node = TreeNode(words[1], (float(words[2]), float(words[3]), float(words[4])))
-                    node.children.append(ch_node)
-                    ch_node.parent = node
-                    self.loadSkel_recur(ch_node, lines, has_order)
+                stack.append(ch_node)
 
     def save(self, filename):
         fout = open(filename, 'w')
@@ -201,15 +236,15 @@ class Skel:
         fout.close()
 
     def normalize(self, scale, trans):
-        this_level = [self.root]
-        while this_level:
-            next_level = []
-            for node in this_level:
-                node.pos /= scale
-                node.pos = (node.pos[0] - trans[0], node.pos[1] - trans[1], node.pos[2] - trans[2])
-                for ch in node.children:
-                    next_level.append(ch)
-            this_level = next_level
+        skeleton = self.get_skeleton_array()
+        skeleton.normalize(scale, trans)
+        self.set_skeleton_array(skeleton)
+
+    def get_skeleton_array(self):
+        return SkeletonArray.from_tree(self.root)
+
+    def set_skeleton_array(self, skeleton):
+        self.root = skeleton.to_tree()
 
     def get_joint_pos(self):
         joint_pos = {}
@@ -223,19 +258,4 @@ class Skel:
         return joint_pos
 
     def adjacent_matrix(self):
-        joint_pos = self.get_joint_pos()
-        joint_name_list = list(joint_pos.keys())
-        num_joint = len(joint_pos)
-        adj_matrix = np.zeros((num_joint, num_joint))
-        this_level = [self.root]
-        while this_level:
-            next_level = []
-            for p_node in this_level:
-                for c_node in p_node.children:
-                    index_parent = joint_name_list.index(p_node.name)
-                    index_children = joint_name_list.index(c_node.name)
-                    adj_matrix[index_parent, index_children] = 1.
-                next_level += p_node.children
-            this_level = next_level
-        adj_matrix = adj_matrix + adj_matrix.transpose()
-        return adj_matrix
+        return self.get_skeleton_array().adjacent_matrix()
@@ -0,0 +1,50 @@
+#-------------------------------------------------------------------------------
+# Name:        skin_utils.py
+# Purpose:     parsing of _skin.txt files and assembly of the skinning network input, without torch
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+
+
+def read_skin_txt(filename):
+    """
+    parse a _skin.txt file written by gen_dataset. Lines are classified once by their first word, then all "bind" and
+    all "influence" rows are converted to numbers in one call each.
+    :return: dict of arrays: bones B*6, and per vertex and nearest bone skin_bone (-1 as padding), skin_dist,
+             skin_leaf and skin_label
+    """
+    with open(filename, 'r') as fin:
+        lines = fin.read().splitlines()
+    bones = [li.split()[3:] for li in lines if li.startswith('bones')]
+    binds = [li[4:] for li in lines if li.startswith('bind')]
+    labels = [li[9:] for li in lines if li.startswith('influence')]
+    bones = np.array(bones, dtype=np.float64).reshape(-1, 6)
+    # first column of bind rows is the vertex id, followed by (bone_id, 1 / D_g, is_leaf) per nearest bone
+    binds = np.array(' '.join(binds).split(), dtype=np.float64).reshape(len(binds), -1)
+    binds = binds[:, 1:].reshape(len(binds), -1, 3)
+    labels = np.array(' '.join(labels).split(), dtype=np.float64).reshape(len(labels), -1)
+    return {'bones': bones, 'skin_bone': binds[:, :, 0].astype(int), 'skin_dist': binds[:, :, 1],
+            'skin_leaf': binds[:, :, 2].astype(int), 'skin_label': labels}
+
+
+def assemble_skin_input(bones, skin_bone, skin_dist, skin_leaf):
+    """
+    build the skinning network input from the nearest bones of each vertex, as SkinDataset.load_skin does per line.
+    Missing bones (-1) are replaced by the nearest bone and masked out of the loss.
+    :param bones: B*6 starting and ending points of bones
+    :param skin_bone: N*K ids of the K nearest bones
+    :param skin_dist: N*K 1 / volumetric geodesic distance to these bones
+    :param skin_leaf: N*K if these bones are leaf bones
+    :return: N*(8K) input, N*K nearest bone ids and N*K loss mask
+    """
+    skin_bone = skin_bone.astype(int)
+    invalid = skin_bone == -1
+    ## walk-round. however the nearest bone may also be invalid.
+    skin_bone = np.where(invalid, skin_bone[:, :1], skin_bone)
+    skin_dist = np.where(invalid, skin_dist[:, :1], skin_dist)
+    skin_leaf = np.where(invalid, skin_leaf[:, :1], skin_leaf).astype(int)
+    skin_input = np.concatenate((bones[skin_bone], skin_dist[:, :, np.newaxis], skin_leaf[:, :, np.newaxis]), axis=2)
+    return skin_input.reshape(len(skin_input), -1), skin_bone, (~invalid).astype(int)
@@ -6,6 +6,8 @@
 # Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
 #-------------------------------------------------------------------------------
 
+import numpy as np
+
 
 class Node(object):
     def __init__(self, name, pos):
@@ -18,3 +20,146 @@ class TreeNode(Node):
         super(TreeNode, self).__init__(name, pos)
         self.children = []
         self.parent = None
+
+
+class SkeletonArray(object):
+    """
+    Skeleton stored as arrays instead of linked TreeNodes. Joints are in BFS order from the root (index 0), with
+    siblings in the order of their parent's children list, i.e. the order of the level-by-level loops over TreeNodes.
+    names: list of J joint names
+    pos: J*3 joint positions
+    parent: J parent indices, -1 for the root
+    overlap: optional J bool array, set for duplicated joints by add_duplicate_joints
+    """
+    def __init__(self, names, pos, parent, overlap=None):
+        self.names = list(names)
+        self.pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+        self.parent = np.asarray(parent, dtype=int)
+        self.overlap = overlap
+        self._name_index = None
+
+    @classmethod
+    def from_tree(cls, root):
+        names, pos, parent = [], [], []
+        this_level = [(root, -1)]
+        while this_level:
+            next_level = []
+            for node, p_id in this_level:
+                names.append(node.name)
+                pos.append(node.pos)
+                parent.append(p_id)
+                next_level += [(c_node, len(names) - 1) for c_node in node.children]
+            this_level = next_level
+        return cls(names, np.array(pos, dtype=np.float64), parent)
+
+    def to_tree(self):
+        """
+        :return: root TreeNode of the same skeleton
+        """
+        pos = self.pos.tolist()
+        nodes = [TreeNode(self.names[i], tuple(pos[i])) for i in range(len(self))]
+        for i in range(1, len(self)):
+            nodes[i].parent = nodes[self.parent[i]]
+            nodes[self.parent[i]].children.append(nodes[i])
+        if self.overlap is not None:
+            for node, overlap in zip(nodes, self.overlap):
+                node.overlap = bool(overlap)
+        return nodes[0]
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def name_index(self):
+        if self._name_index is None:
+            self._name_index = {name: i for i, name in enumerate(self.names)}
+        return self._name_index
+
+    def num_children(self):
+        return np.bincount(self.parent[1:], minlength=len(self))
+
+    def joint_dict(self):
+        pos = self.pos.tolist()
+        return {name: tuple(pos[i]) for i, name in enumerate(self.names)}
+
+    def adjacent_matrix(self):
+        """
+        :return: J*J symmetric matrix, 1 between parent and child
+        """
+        adj_matrix = np.zeros((len(self), len(self)))
+        adj_matrix[self.parent[1:], np.arange(1, len(self))] = 1.
+        return adj_matrix + adj_matrix.transpose()
+
+    def get_bones(self):
+        """
+        bones in the order of geometric_proc.common_ops.get_bones: one per child joint, followed by a virtual "leaf"
+        bone if the child is a leaf
+        :return: B*6 array of starting and ending points, B pairs of joint names, and B leaf flags
+        """
+        child = np.arange(1, len(self))
+        is_leaf = self.num_children()[child] == 0
+        # every child joint gives a bone, leaf joints give a second one
+        bone_child = np.repeat(child, 1 + is_leaf)
+        leaf_bones = np.zeros(len(bone_child), dtype=bool)
+        leaf_bones[np.cumsum(1 + is_leaf)[is_leaf] - 1] = True
+        bone_start = np.where(leaf_bones, bone_child, self.parent[bone_child])
+        bones = np.concatenate((self.pos[bone_start], self.pos[bone_child]), axis=1)
+        bone_name = [[self.names[c], self.names[c] + '_leaf'] if leaf else [self.names[p], self.names[c]]
+                     for p, c, leaf in zip(bone_start.tolist(), bone_child.tolist(), leaf_bones.tolist())]
+        return bones, bone_name, leaf_bones.tolist()
+
+    def normalize(self, scale, trans):
+        self.pos = self.pos / scale - np.asarray(trans)
+
+    def add_duplicate_joints(self):
+        """
+        give every child of a joint with several children its own copy of that joint, named {name}_dup_{k}. For user
+        interaction, the copies are moved a bit towards their child.
+        :return: new SkeletonArray
+        """
+        child = np.arange(1, len(self))
+        p = self.parent[child]
+        dup = self.num_children()[p] > 1
+        dup_child, dup_parent = child[dup], p[dup]
+        # rank of each child among its siblings
+        order = np.argsort(dup_parent, kind='stable')
+        rank = np.empty(len(dup_parent), dtype=int)
+        rank[order] = np.arange(len(dup_parent)) - np.searchsorted(dup_parent[order], dup_parent[order])
+        dup_pos = self.pos[dup_parent] + 0.03 * np.linalg.norm(self.pos[dup_child] - self.pos[dup_parent],
+                                                              axis=1)[:, np.newaxis]
+        dup_names = ['{:s}_dup_{:d}'.format(self.names[pi], k) for pi, k in zip(dup_parent.tolist(), rank.tolist())]
+        dup_ids = len(self) + np.arange(len(dup_child))
+        parent = np.concatenate((self.parent, dup_parent))
+        parent[dup_child] = dup_ids
+        overlap = np.concatenate((np.zeros(len(self), dtype=bool), np.ones(len(dup_child), dtype=bool)))
+        skeleton = SkeletonArray(self.names + dup_names, np.concatenate((self.pos, dup_pos), axis=0), parent, overlap)
+        return skeleton.reorder(bfs_order(parent))
+
+    def reorder(self, order):
+        """
+        :param order: new order of joints, as indices into the current one
+        :return: new SkeletonArray
+        """
+        inverse = np.empty(len(order), dtype=int)
+        inverse[order] = np.arange(len(order))
+        parent = np.where(self.parent[order] >= 0, inverse[self.parent[order]], -1)
+        overlap = self.overlap[order] if self.overlap is not None else None
+        return SkeletonArray([self.names[i] for i in order], self.pos[order], parent, overlap)
+
+
+def bfs_order(parent):
+    """
+    BFS order of a tree given by parent indices (-1 for the root). Siblings keep the order of their indices.
+    """
+    parent = np.asarray(parent, dtype=int)
+    level = np.flatnonzero(parent == -1)
+    order = [level]
+    level_id = np.full(len(parent), -1)
+    while len(level):
+        level_id[:] = -1
+        level_id[level] = np.arange(len(level))
+        # children of this level, grouped by the position of their parent in the level
+        child = np.flatnonzero((parent >= 0) & (level_id[np.maximum(parent, 0)] >= 0))
+        level = child[np.argsort(level_id[parent[child]], kind='stable')]
+        order.append(level)
+    return np.concatenate(order)
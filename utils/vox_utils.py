@@ -0,0 +1,82 @@
+#-------------------------------------------------------------------------------
+# Name:        vox_utils.py
+# Purpose:     in-process voxelization of triangle meshes, replacing the binvox executable
+# RigNet Copyright 2020 University of Massachusetts
+# RigNet is made available under General Public License Version 3 (GPLv3), or under a Commercial License.
+# Please see the LICENSE README.txt file in the main directory for more information and instruction on using and licensing RigNet.
+#-------------------------------------------------------------------------------
+
+import numpy as np
+from utils import binvox_rw
+
+
+def barycentric_grid(n):
+    """
+    barycentric coordinates of a regular grid on a triangle, with n segments per edge
+    :return: P*3 array, P = (n+1)(n+2)/2
+    """
+    i, j = np.meshgrid(np.arange(n + 1), np.arange(n + 1), indexing='ij')
+    i, j = i[i + j <= n], j[i + j <= n]
+    return np.stack((i, j, n - i - j), axis=1) / n
+
+
+def rasterize_surface(tris, dim, max_points=4000000):
+    """
+    mark the voxels crossed by the triangles. Every triangle is sampled with a spacing of at most half a voxel.
+    :param tris: T*3*3 array of triangle corners in voxel units, i.e. voxel (i,j,k) spans [i,i+1)x[j,j+1)x[k,k+1)
+    :param dim: grid resolution
+    :param max_points: max number of samples held in memory at once
+    :return: dim^3 bool array
+    """
+    occ = np.zeros((dim, dim, dim), dtype=bool)
+    edge_len = np.linalg.norm(tris - np.roll(tris, 1, axis=1), axis=2).max(axis=1)
+    num_seg = np.maximum(np.ceil(edge_len * 2), 1).astype(int)
+    # triangles with the same number of segments share one sampling pattern
+    for n in np.unique(num_seg):
+        bary = barycentric_grid(n)
+        tris_n = tris[num_seg == n]
+        chunk_size = max(max_points // len(bary), 1)
+        for t in range(0, len(tris_n), chunk_size):
+            pts = np.einsum('pk,tkd->tpd', bary, tris_n[t:t + chunk_size]).reshape(-1, 3)
+            vc = np.clip(np.floor(pts).astype(int), 0, dim - 1)
+            occ[vc[:, 0], vc[:, 1], vc[:, 2]] = True
+    return occ
+
+
+def carve(surface):
+    """
+    binvox-style carving: a voxel is outside if it can be seen from the border of the grid along one of the 6 axis
+    directions, i.e. no surface voxel lies between it and the border. Holes in the surface only carve the voxels in
+    line with them, so the interior of non-watertight meshes is kept.
+    :param surface: dim^3 bool array of surface voxels
+    :return: dim^3 bool array of surface and interior voxels
+    """
+    outside = np.zeros_like(surface)
+    for axis in range(3):
+        # voxels before the first surface voxel, from either end of the axis
+        outside |= ~np.logical_or.accumulate(surface, axis=axis)
+        flipped = np.flip(surface, axis=axis)
+        outside |= np.flip(~np.logical_or.accumulate(flipped, axis=axis), axis=axis)
+    return ~outside
+
+
+def voxelize(mesh_v, mesh_f, dim=88, fill=True):
+    """
+    voxelize a triangle mesh with the conventions of binvox: the grid is a cube of dim^3 voxels, placed at the minimum
+    corner of the bounding box and as large as its longest side. Surface voxels are rasterized, then the interior is
+    filled by carving along the 6 axis directions, which tolerates holes in the mesh.
+    :param mesh_v: vertices
+    :param mesh_f: triangles
+    :param dim: grid resolution
+    :param fill: fill the interior. Otherwise only the surface voxels are set.
+    :return: binvox_rw.Voxels, in 'xyz' order as returned by binvox_rw.read_as_3d_array
+    """
+    mesh_v = np.asarray(mesh_v, dtype=np.float64)
+    mesh_f = np.asarray(mesh_f)
+    translate = mesh_v.min(axis=0)
+    scale = float((mesh_v.max(axis=0) - translate).max())
+    tris = (mesh_v[mesh_f] - translate) / scale * dim
+    data = rasterize_surface(tris, dim)
+    if fill:
+        data = carve(data)
+    return binvox_rw.Voxels(data, [dim, dim, dim], translate.tolist(), scale, 'xyz')